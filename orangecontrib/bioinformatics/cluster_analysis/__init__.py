@@ -1,10 +1,11 @@
 """ Cluster analysis module """
 import numpy as np
+import scipy.stats
+import scipy.sparse as sp
 import threading
 import concurrent.futures
 
 from typing import Union
-from operator import attrgetter
 from functools import partial
 
 
@@ -15,14 +16,146 @@ from Orange.widgets.utils.concurrent import ThreadExecutor, FutureWatcher, metho
 from Orange.widgets.gui import ProgressBar
 
 from orangecontrib.bioinformatics.geneset import GeneSet
+from orangecontrib.bioinformatics.utils import SharedArrays, process_pool
 from orangecontrib.bioinformatics.widgets.utils.gui import gene_scoring_method
-from orangecontrib.bioinformatics.utils.statistics import FDR, ALT_GREATER
+from orangecontrib.bioinformatics.utils.statistics import (
+    ALT_GREATER, false_discovery_rate, GroupStatistics, group_statistics, score_t_test, score_hypergeometric_test,
+    score_welch_t_test, score_moderated_t_test, t_test_from_statistics, hypergeometric_test_from_statistics,
+    welch_t_test_from_statistics, moderated_t_test_from_statistics
+)
 from orangecontrib.bioinformatics.ncbi.gene import Gene
 
 DISPLAY_GENE_COUNT = 20
 DISPLAY_GENE_SETS_COUNT = 5
 
 
+#: Scoring functions which can be computed from sufficient statistics of (cluster, batch) groups
+STATISTICS_SCORE_FUNCTIONS = {
+    score_t_test: t_test_from_statistics,
+    score_welch_t_test: welch_t_test_from_statistics,
+    score_moderated_t_test: moderated_t_test_from_statistics,
+    score_hypergeometric_test: hypergeometric_test_from_statistics,
+}
+
+
+def _any_nonzero(x):
+    return x.count_nonzero() > 0 if sp.issparse(x) else x.any()
+
+
+def cluster_batch_statistics(table_x, rows_by_cluster, rows_by_batch=None):
+    # type: (Union[np.ndarray, sp.spmatrix], np.ndarray, Union[np.ndarray, None]) -> tuple
+    """ Compute sufficient statistics of each (cluster, batch) group in one pass over `table_x`.
+
+    :return: (cluster labels, batch labels, :class:`GroupStatistics` with leading dimensions (clusters, batches))
+    """
+    if not isinstance(rows_by_batch, np.ndarray):
+        rows_by_batch = np.zeros((table_x.shape[0],))
+
+    clusters, cluster_index = np.unique(rows_by_cluster, return_inverse=True)
+    batches, batch_index = np.unique(rows_by_batch, return_inverse=True)
+    shape = (len(clusters), len(batches))
+
+    stats = group_statistics(table_x, cluster_index * len(batches) + batch_index, n_groups=shape[0] * shape[1])
+    stats = GroupStatistics(stats.counts.reshape(shape), *(field.reshape(shape + (-1,)) for field in stats[1:]))
+    return clusters, batches, stats
+
+
+AGGREGATIONS = ['max', 'min', 'median', 'mean', 'fisher', 'stouffer']
+
+
+def aggregate_scores(calculated_scores, calculated_p_values, aggregation='max'):
+    # type: (np.ndarray, np.ndarray, str) -> tuple
+    """ Aggregate scores and p-values of shape (genes, other clusters, batches) over
+    other clusters and batches with a single reduction.
+
+    Comparisons that were not tested (NaN p-values, see :func:`Cluster.compute_scores`) are ignored.
+    'max', 'min' and 'median' select one comparison per gene (and its score); ties are resolved
+    by the order of comparisons. 'mean' averages scores and p-values. 'fisher' and 'stouffer'
+    combine p-values with Fisher's and Stouffer's method, the score is the combined statistic.
+    Genes without tested comparisons get score 0 and p-value 1.
+
+    :return: scores, p-values and FDR values of genes
+    """
+    n_genes = calculated_p_values.shape[0]
+    p_values = calculated_p_values.reshape((n_genes, -1))
+    scores = calculated_scores.reshape((n_genes, -1))
+
+    if aggregation not in AGGREGATIONS:
+        raise NotImplementedError("Aggregation %s is not implemented" % aggregation)
+
+    # number of tested comparisons of each gene
+    tested = ~np.isnan(p_values)
+    n_tests = tested.sum(axis=1)
+    has_tests = n_tests > 0
+    aggregated_scores = np.zeros(n_genes)
+    aggregated_p_values = np.ones(n_genes)
+
+    if not has_tests.any():
+        # there is nothing to compare the cluster with
+        return aggregated_scores, aggregated_p_values, np.ones(n_genes)
+
+    p_values, scores, tested, n_tests = p_values[has_tests], scores[has_tests], tested[has_tests], n_tests[has_tests]
+    if aggregation in ('max', 'min', 'median'):
+        if aggregation == 'max':
+            selected = np.argmax(np.where(tested, p_values, -np.inf), axis=1)
+        elif aggregation == 'min':
+            selected = np.argmin(np.where(tested, p_values, np.inf), axis=1)
+        else:
+            # untested comparisons (NaN) are sorted last
+            order = np.argsort(p_values, axis=1, kind='stable')
+            selected = order[np.arange(len(order)), (n_tests - 1) // 2]
+        selected = selected[:, np.newaxis]
+        scores = np.take_along_axis(scores, selected, axis=1)[:, 0]
+        p_values = np.take_along_axis(p_values, selected, axis=1)[:, 0]
+    elif aggregation == 'mean':
+        scores = np.where(tested, scores, 0).sum(axis=1) / n_tests
+        p_values = np.nansum(p_values, axis=1) / n_tests
+    elif aggregation in ('fisher', 'stouffer'):
+        # keep p-values away from 0 and 1, where the transformations are infinite
+        p_values = np.clip(p_values, np.finfo(float).tiny, 1 - np.finfo(float).epsneg)
+        if aggregation == 'fisher':
+            scores = -2 * np.nansum(np.log(p_values), axis=1)
+            p_values = scipy.stats.chi2.sf(scores, 2 * n_tests)
+        else:
+            scores = np.nansum(scipy.stats.norm.isf(p_values), axis=1) / np.sqrt(n_tests)
+            p_values = scipy.stats.norm.sf(scores)
+
+    aggregated_scores[has_tests] = scores
+    aggregated_p_values[has_tests] = p_values
+    return aggregated_scores, aggregated_p_values, false_discovery_rate(aggregated_p_values)
+
+
+def filter_results(p_values, fdr_values, p_val=None, fdr=None, max_count=None):
+    # type: (np.ndarray, np.ndarray, Union[float, None], Union[float, None], Union[int, None]) -> np.ndarray
+    """ Select and order results (genes or gene sets) stored in columns.
+
+    Results are sorted by p-value if no threshold is given, otherwise by FDR. Only `max_count`
+    best results are partitioned out (`np.argpartition`) before sorting; ties are resolved by
+    the original order.
+
+    :return: indices of selected results
+    """
+    keys = p_values if p_val is None and fdr is None else fdr_values
+    selected = np.arange(len(keys))
+
+    if p_val is not None:
+        selected = selected[p_values[selected] < p_val]
+
+    if fdr is not None:
+        selected = selected[fdr_values[selected] < fdr]
+
+    if max_count is not None and max_count < len(selected):
+        if max_count <= 0:
+            return selected[:0]
+
+        selected_keys = keys[selected]
+        threshold = selected_keys[np.argpartition(selected_keys, max_count - 1)[max_count - 1]]
+        below = selected[selected_keys < threshold]
+        selected = np.concatenate((below, selected[selected_keys == threshold][:max_count - len(below)]))
+
+    return selected[np.argsort(keys[selected], kind='stable')]
+
+
 class ClusterGene(Gene):
     __slots__ = ['score', 'p_val', 'fdr']
 
@@ -54,177 +187,269 @@ class Cluster:
         self.name = name
         self.index = index
 
-        # gene enrichment
-        self.genes = []
-        self.filtered_genes = []
-
-        # set enrichment
-        self.gene_sets = []
-        self.filtered_gene_sets = []
+        # gene enrichment, one entry per gene
+        self.gene_names = np.array([], dtype=object)
+        self.gene_ids = np.array([], dtype=object)
+        self.scores = np.array([])
+        self.p_values = np.array([])
+        self.fdr_values = np.array([])
+        self.filtered_gene_indices = np.array([], dtype=int)
+
+        # set enrichment, one entry per gene set
+        self.gene_set_names = np.array([], dtype=object)
+        self.gene_set_ids = np.array([], dtype=object)
+        self.gene_set_counts = np.array([], dtype=int)
+        self.gene_set_p_values = np.array([])
+        self.gene_set_fdr_values = np.array([])
+        self.filtered_gene_set_indices = np.array([], dtype=int)
 
         # Statistical method used when performing analysis
         self.method_used = None
 
-    def set_genes(self, gene_names, gene_ids):
-        self.genes = []
-
-        for name, entrez in zip(gene_names, gene_ids):
-            self.genes.append(ClusterGene(name, entrez))
+        # scores and p-values of genes vs. other clusters in batches, see `compute_scores`
+        self.calculated_scores = None
+        self.calculated_p_values = None
+        self.aggregation = None
 
-    @staticmethod
-    def apply_filter(obj, p_val, fdr):
-        filter_status = []
-
-        if p_val is not None:
-            filter_status.append(obj.p_val < p_val)
-
-        if fdr is not None:
-            filter_status.append(obj.fdr < fdr)
+    def set_genes(self, gene_names, gene_ids):
+        self.gene_names = np.asarray(gene_names, dtype=object)
+        self.gene_ids = np.asarray(gene_ids, dtype=object)
+        self.filtered_gene_indices = np.array([], dtype=int)
 
-        return all(filter_status)
+        # default values
+        self.scores = np.zeros(len(self.gene_names))
+        self.p_values = np.ones(len(self.gene_names))
+        self.fdr_values = np.ones(len(self.gene_names))
+
+    @property
+    def filtered_genes(self):
+        """ Gene objects of genes that pass the filter, created on access """
+        genes = []
+        for index in self.filtered_gene_indices:
+            gene = ClusterGene(self.gene_names[index], self.gene_ids[index])
+            gene.score = self.scores[index]
+            gene.p_val = self.p_values[index]
+            gene.fdr = self.fdr_values[index]
+            genes.append(gene)
+        return genes
+
+    @property
+    def filtered_gene_sets(self):
+        """ Gene set objects of gene sets that pass the filter, created on access """
+        gene_sets = []
+        for index in self.filtered_gene_set_indices:
+            gs = ClusterGeneSet()
+            gs.name = self.gene_set_names[index]
+            gs.gs_id = self.gene_set_ids[index]
+            gs.count = self.gene_set_counts[index]
+            gs.p_val = self.gene_set_p_values[index]
+            gs.fdr = self.gene_set_fdr_values[index]
+            gene_sets.append(gs)
+        return gene_sets
 
     def filter_enriched_genes(self, p_val, fdr, max_gene_count=None):
-        all_args_none = all(arg is None for arg in [p_val, fdr])
-        filter_function = partial(self.apply_filter, p_val=p_val, fdr=fdr)
-        sorted_list = sorted(self.genes, key=attrgetter('p_val' if all_args_none else 'fdr'))
-        filtered_list = list(filter(filter_function, sorted_list))
-
-        if max_gene_count is not None:
-            self.filtered_genes = filtered_list[:max_gene_count]
-        else:
-            self.filtered_genes = filtered_list
+        self.filtered_gene_indices = filter_results(self.p_values, self.fdr_values, p_val, fdr, max_gene_count)
 
     def filter_gene_sets(self, p_val, fdr, max_set_count=None):
-        all_args_none = all(arg is None for arg in [p_val, fdr])
-        filter_function = partial(self.apply_filter, p_val=p_val, fdr=fdr)
-        sorted_list = sorted(self.gene_sets, key=attrgetter('p_val' if all_args_none else 'fdr'))
-        filtered_list = list(filter(filter_function, sorted_list))
-
-        if max_set_count is not None:
-            self.filtered_gene_sets = filtered_list[:max_set_count]
-        else:
-            self.filtered_gene_sets = filtered_list
+        self.filtered_gene_set_indices = filter_results(
+            self.gene_set_p_values, self.gene_set_fdr_values, p_val, fdr, max_set_count)
 
     def gene_set_enrichment(self, gene_sets, selected_sets, genes, ref_genes):
-        self.gene_sets = []
-
-        if not genes:
-            return
+        names, ids, counts, p_values = [], [], [], []
 
         # calculate gene set enrichment
-        for gene_set in gene_sets:
+        for gene_set in gene_sets if genes else []:
 
             if gene_set.hierarchy not in selected_sets:
                 continue
 
-            gs = ClusterGeneSet()
             enrichment_result = gene_set.set_enrichment(ref_genes, genes.intersection(genes))
-            gs.count = len(enrichment_result.query)
-            gs.p_val = enrichment_result.p_value
-            gs.name = gene_set.name
-            gs.gs_id = gene_set.gs_id
-            self.gene_sets.append(gs)
-
+            names.append(gene_set.name)
+            ids.append(gene_set.gs_id)
+            counts.append(len(enrichment_result.query))
+            p_values.append(enrichment_result.p_value)
+
+        self.gene_set_names = np.array(names, dtype=object)
+        self.gene_set_ids = np.array(ids, dtype=object)
+        self.gene_set_counts = np.array(counts, dtype=int)
+        self.gene_set_p_values = np.array(p_values, dtype=float)
         # calculate FDR
-        p_vals = [gs.p_val for gs in self.gene_sets]
-        fdr_values = FDR(p_vals)
-
-        for gs, fdr in zip(self.gene_sets, fdr_values):
-            gs.fdr = fdr
+        self.gene_set_fdr_values = false_discovery_rate(self.gene_set_p_values)
+        self.filtered_gene_set_indices = np.array([], dtype=int)
 
-    def __update_gene_objects(self, scores, p_vals, fdr_vals):
+    def set_scores(self, scores, p_vals, fdr_vals):
         # type: (Union[np.ndarray, list], Union[np.ndarray, list], Union[np.ndarray, list]) ->  None
-        """ update gene objects with computed results
+        """ Store computed results of genes
 
+        :param scores:   Computed scores
         :param p_vals:   Computed p-values
         :param fdr_vals: Computed fdr-values
 
         """
-        for score, p_val, fdr, gene in zip(scores, p_vals, fdr_vals, self.genes):
-            gene.score = score
-            gene.p_val = p_val
-            gene.fdr = fdr
+        self.scores = np.asarray(scores, dtype=float)
+        self.p_values = np.asarray(p_vals, dtype=float)
+        self.fdr_values = np.asarray(fdr_vals, dtype=float)
 
     def cluster_scores(self, table_x, rows_by_cluster, method, design, **kwargs):
         # type: (np.ndarray, np.ndarray, gene_scoring_method, str) -> None
+        """ Score genes in the cluster and update gene objects with the results.
+
+        See :func:`Cluster.compute_scores` for parameters.
+
+        :param aggregation: One of `AGGREGATIONS`, how to aggregate scores over
+                            other clusters and batches (default 'max').
+        """
+        self.set_score_cube(*self.compute_scores(table_x, rows_by_cluster, method, design, **kwargs))
+        self.aggregate(kwargs.get('aggregation', 'max'))
+
+    def set_score_cube(self, calculated_scores, calculated_p_values):
+        # type: (np.ndarray, np.ndarray) -> None
+        """ Store scores and p-values of shape (genes, other clusters, batches) """
+        self.calculated_scores = calculated_scores
+        self.calculated_p_values = calculated_p_values
+
+    def aggregate(self, aggregation):
+        # type: (str) -> None
+        """ Aggregate stored scores over other clusters and batches and update gene objects.
+        Genes are not scored again, so the aggregation can be changed cheaply.
+        """
+        if self.calculated_p_values is None:
+            return
+
+        self.aggregation = aggregation
+        self.set_scores(*aggregate_scores(self.calculated_scores, self.calculated_p_values, aggregation))
+
+    def compute_scores(self, table_x, rows_by_cluster, method, design, **kwargs):
+        # type: (np.ndarray, np.ndarray, gene_scoring_method, str) -> tuple
         """
         General scoring of genes in the cluster.
         Ways to score genes are determined by design.
         If a batch variable index is defined, it is accounted for in gene scoring.
 
-        :param table_x:
+        Methods listed in `STATISTICS_SCORE_FUNCTIONS` are computed from per (cluster, batch)
+        sufficient statistics, the others on slices of `table_x`.
+
+        :param table_x: dense or sparse (scipy.sparse) expression matrix
         :param rows_by_cluster:
         :param method:
         :param design:
         :param kwargs:
-        :param aggregation:
         :param rows_by_batch:
-        :return:
+        :param group_statistics: precomputed result of :func:`cluster_batch_statistics`
+        :return: scores and p-values of shape (genes, other clusters, batches), NaN for (other cluster, batch)
+                 pairs that were not tested because a group contains only zeros
         """
-        aggregation = kwargs.get('aggregation', 'max')
         alternative = kwargs.get('alternative', ALT_GREATER)
         rows_by_batch = kwargs.get('rows_by_batch', None)
         if not isinstance(rows_by_batch, np.ndarray):
-            rows_by_batch = np.zeros((len(table_x),))
-        uniq_batches = set(rows_by_batch)
+            rows_by_batch = np.zeros((table_x.shape[0],))
 
-        # Determine clusters
         self.method_used = method.name
-        uniq_clusters = set(rows_by_cluster) - {self.index}
+        statistics_function = STATISTICS_SCORE_FUNCTIONS.get(method.score_function, None)
+
+        if statistics_function is not None:
+            statistics = kwargs.get('group_statistics', None)
+            if statistics is None:
+                statistics = cluster_batch_statistics(table_x, rows_by_cluster, rows_by_batch)
+            calculated_scores, calculated_p_values = self.__scores_from_statistics(
+                statistics, statistics_function, design, alternative)
+        else:
+            calculated_scores, calculated_p_values = self.__scores_from_data(
+                table_x, rows_by_cluster, rows_by_batch, method, design, alternative)
+
+        return calculated_scores, calculated_p_values
+
+    def __scores_from_statistics(self, group_statistics, statistics_function, design, alternative):
+        """ Derive scores of all (other cluster, batch) pairs at once from sufficient statistics.
+
+        :return: scores and p-values of shape (genes, other clusters, batches)
+        """
+        clusters, _, stats = group_statistics
+        this_cluster = clusters == self.index
+
+        # statistics of this cluster, shape: (batches, ...)
+        cluster = GroupStatistics(*(field[this_cluster].sum(axis=0) for field in stats))
+        if design == self.CLUSTER_VS_REST:
+            rest = GroupStatistics(*((field.sum(axis=0) - cluster_field)[np.newaxis]
+                                     for field, cluster_field in zip(stats, cluster)))
+        else:
+            rest = GroupStatistics(*(field[~this_cluster] for field in stats))
+
+        scores, p_values = statistics_function(cluster, rest, alternative=alternative)
+        scores = np.broadcast_to(scores, rest.sums.shape).copy()
+        p_values = np.broadcast_to(p_values, rest.sums.shape).copy()
+        scores[np.isnan(p_values)] = 0
+        p_values[np.isnan(p_values)] = 1
+
+        # test only pairs where both groups contain non-zero values, the others are not tested (NaN)
+        valid = (cluster.nonzero.sum(axis=-1) > 0) & (rest.nonzero.sum(axis=-1) > 0)
+        scores[~valid] = np.nan
+        p_values[~valid] = np.nan
+
+        return np.moveaxis(scores, -1, 0), np.moveaxis(p_values, -1, 0)
+
+    def __scores_from_data(self, table_x, rows_by_cluster, rows_by_batch, method, design, alternative):
+        """ Score genes on slices of `table_x` for each (other cluster, batch) pair.
+
+        :return: scores and p-values of shape (genes, other clusters, batches)
+        """
+        uniq_batches = np.unique(rows_by_batch)
+        uniq_clusters = np.setdiff1d(np.unique(rows_by_cluster), [self.index])
         this_cluster = self.index
         if design == self.CLUSTER_VS_REST:
             rows_by_cluster = rows_by_cluster == self.index
-            uniq_clusters = {False}
+            uniq_clusters = [False]
             this_cluster = True
 
-        calculated_p_values = np.ones((table_x.shape[1],      # genes
-                                      len(uniq_clusters),     # other clusters
-                                      len(uniq_batches)))     # batches
+        # pairs where a group contains only zeros are not tested (NaN)
+        calculated_p_values = np.full((table_x.shape[1],      # genes
+                                       len(uniq_clusters),    # other clusters
+                                       len(uniq_batches)),    # batches
+                                      np.nan)
 
-        calculated_scores = np.ones((table_x.shape[1],       # genes
+        calculated_scores = np.full((table_x.shape[1],       # genes
                                      len(uniq_clusters),     # other clusters
-                                     len(uniq_batches)))     # batches
+                                     len(uniq_batches)),     # batches
+                                    np.nan)
 
+        cluster_rows = rows_by_cluster == this_cluster
         for bi, b in enumerate(uniq_batches):
+            batch_rows = rows_by_batch == b
+            cluster = table_x[np.logical_and(cluster_rows, batch_rows)]
+            if not _any_nonzero(cluster):
+                continue
+
             for ci, c in enumerate(uniq_clusters):
-                cluster = table_x[np.logical_and(rows_by_cluster == this_cluster, rows_by_batch == b)]
-                rest = table_x[np.logical_and(rows_by_cluster == c, rows_by_batch == b)]
-                if cluster.any() and rest.any():
+                rest = table_x[np.logical_and(rows_by_cluster == c, batch_rows)]
+                if _any_nonzero(rest):
                     scores, p_values = method.score_function(cluster, rest, alternative=alternative)
                     scores[np.isnan(p_values)] = 0
                     calculated_scores[:, ci, bi] = scores
                     p_values[np.isnan(p_values)] = 1
                     calculated_p_values[:, ci, bi] = p_values
 
-        if aggregation == 'max':
-            max_p_values = np.max(calculated_p_values, axis=(1, 2))
-            max_p_indexes = np.where(np.max(calculated_p_values, axis=(1, 2), keepdims=True) == calculated_p_values)
-            # this holds true only if max_p_indexes.ndim == 3
-            scores = calculated_scores[max_p_indexes[0], max_p_indexes[1], max_p_indexes[2]]
-            fdr_values = FDR(max_p_values.tolist())
-            self.__update_gene_objects(scores, max_p_values, fdr_values)
-        else:
-            raise NotImplementedError("Aggregation %s is not implemented" % aggregation)
-        return
+        return calculated_scores, calculated_p_values
 
     def to_html(self):
         gene_sets = '(no enriched gene sets)'
-        if self.filtered_gene_sets:
-            sets_to_display = self.filtered_gene_sets[:DISPLAY_GENE_SETS_COUNT]
-            gene_sets = '<br>'.join(['<b>{}</b> (FDR={:0.2e}, n={})'.format(g_set.name, g_set.fdr, g_set.count)
-                                    for g_set in sets_to_display])
-
-            if len(self.filtered_gene_sets) > len(sets_to_display):
+        if len(self.filtered_gene_set_indices):
+            sets_to_display = self.filtered_gene_set_indices[:DISPLAY_GENE_SETS_COUNT]
+            gene_sets = '<br>'.join(['<b>{}</b> (FDR={:0.2e}, n={})'.format(self.gene_set_names[index],
+                                                                           self.gene_set_fdr_values[index],
+                                                                           self.gene_set_counts[index])
+                                    for index in sets_to_display])
+
+            if len(self.filtered_gene_set_indices) > len(sets_to_display):
                 gene_sets += \
-                    '<br> ... ({} more gene sets)'.format(len(self.filtered_gene_sets) - DISPLAY_GENE_SETS_COUNT)
+                    '<br> ... ({} more gene sets)'.format(len(self.filtered_gene_set_indices) - DISPLAY_GENE_SETS_COUNT)
 
         genes = '(all genes are filtered out)'
-        if self.filtered_genes:
-            genes_to_display = [gene.input_name for gene in self.filtered_genes[:DISPLAY_GENE_COUNT]]
+        if len(self.filtered_gene_indices):
+            genes_to_display = self.gene_names[self.filtered_gene_indices[:DISPLAY_GENE_COUNT]]
 
             genes = ', '.join(genes_to_display)
-            if len(self.filtered_genes) > len(genes_to_display):
-                genes += ', ... ({} more genes)'.format(len(self.filtered_genes) - DISPLAY_GENE_COUNT)
+            if len(self.filtered_gene_indices) > len(genes_to_display):
+                genes += ', ... ({} more genes)'.format(len(self.filtered_gene_indices) - DISPLAY_GENE_COUNT)
 
         html_string = """
         <html>
@@ -252,6 +477,12 @@ class Cluster:
         return html_string
 
 
+def _score_cluster(index, method, shared_arrays, kwargs):
+    """ Score genes of one cluster in a worker process. """
+    kwargs = dict(kwargs, **shared_arrays.load())
+    return Cluster(None, index).compute_scores(method=gene_scoring_method(*method), **kwargs)
+
+
 class Task:
     future = None
     watcher = None
@@ -314,10 +545,44 @@ class ClusterModel(QAbstractListModel):
             raise ex
 
     def _score_genes(self, callback, **kwargs):
+        if kwargs['method'].score_function in STATISTICS_SCORE_FUNCTIONS:
+            # sufficient statistics are shared by all clusters
+            kwargs['group_statistics'] = cluster_batch_statistics(
+                kwargs['table_x'], kwargs['rows_by_cluster'], kwargs.get('rows_by_batch', None))
+
         for item in self.get_rows():
             item.cluster_scores(**kwargs)
             callback()
 
+    def _score_genes_processes(self, callback, processes, **kwargs):
+        """ Score clusters in a pool of (at most) `processes` worker processes, see :func:`process_pool`.
+
+        The expression matrix is shared through memory-mapped files instead of being pickled for each task.
+        """
+        method = kwargs.pop('method')
+        aggregation = kwargs.pop('aggregation', 'max')
+        shared_arrays = SharedArrays(table_x=kwargs.pop('table_x'),
+                                     rows_by_cluster=kwargs.pop('rows_by_cluster'),
+                                     rows_by_batch=kwargs.pop('rows_by_batch', None))
+        try:
+            with process_pool(processes) as executor:
+                futures = {executor.submit(_score_cluster, item.index, tuple(method), shared_arrays, kwargs): item
+                           for item in self.get_rows()}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        item = futures[future]
+                        item.method_used = method.name
+                        item.set_score_cube(*future.result())
+                        item.aggregate(aggregation)
+                        callback()
+                except BaseException:
+                    # do not start pending clusters after cancellation or an error
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            shared_arrays.close()
+
     @Slot(bool)
     def progress_advance(self, finish):
         # GUI should be updated in main thread. That's why wex are calling advance method here
@@ -345,7 +610,9 @@ class ClusterModel(QAbstractListModel):
         :param data_x:
         :param rows_by_cluster:
         :param method:
-
+        :param processes: Number of worker processes (opt-in). Clusters are scored in a single
+                          thread if None (default) or if the method is computed from sufficient
+                          statistics (already vectorized over all clusters).
 
         Note:
             We do not apply filter nor notify view that data is changed. This is done after filters
@@ -363,7 +630,11 @@ class ClusterModel(QAbstractListModel):
             progress_advance(self._task.cancelled)
 
         self.parent.progress_bar = ProgressBar(self.parent, iterations=len(self.get_rows()))
-        f = partial(self._score_genes, callback=callback, **kwargs)
+        processes = kwargs.pop('processes', None)
+        if processes and kwargs['method'].score_function not in STATISTICS_SCORE_FUNCTIONS:
+            f = partial(self._score_genes_processes, callback=callback, processes=processes, **kwargs)
+        else:
+            f = partial(self._score_genes, callback=callback, **kwargs)
         self._task = Task()
         self._task.future = self._executor.submit(f)
 
@@ -383,12 +654,20 @@ class ClusterModel(QAbstractListModel):
         """
 
         for item in self.get_rows():
-            genes = [gene.ncbi_id for gene in item.filtered_genes]
+            genes = item.gene_ids[item.filtered_gene_indices]
             item.gene_set_enrichment(gs_object,
                                      gene_sets,
                                      set(genes),
                                      reference_genes)
 
+    @property
+    def scoring_in_progress(self):
+        return self._task is not None
+
+    def apply_aggregation(self, aggregation):
+        """ Aggregate already computed scores of all clusters with a different `aggregation` """
+        [item.aggregate(aggregation) for item in self.get_rows()]
+
     def apply_gene_filters(self, p_val=None, fdr=None, count=None):
         [item.filter_enriched_genes(p_val, fdr, max_gene_count=count) for item in self.get_rows()]
         self.dataChanged.emit(self.createIndex(0, 0), self.createIndex(self.rowCount(0), 0))
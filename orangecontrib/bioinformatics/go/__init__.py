@@ -1,22 +1,40 @@
 """  Gene Ontology module """
 import os
+import json
+import hashlib
 import tarfile
+import concurrent.futures
+import itertools
 import re
 import sys
 import six
+import threading
 import warnings
 
-from collections import defaultdict
+import numpy as np
+import scipy.sparse as sp
+
+from collections import defaultdict, OrderedDict
 from collections import namedtuple
+from collections.abc import Mapping
 
 
 from orangecontrib.bioinformatics.utils import progress_bar_milestones, serverfiles, statistics
 from orangecontrib.bioinformatics.ncbi import taxonomy
 
 from orangecontrib.bioinformatics.go.config import DOMAIN, FILENAME_ANNOTATION, FILENAME_ONTOLOGY
+from orangecontrib.bioinformatics.go.compiled import (
+    CompiledOntology, compiled_path, source_stamp, gather_rows, save_matrix, load_matrix
+)
+from orangecontrib.bioinformatics.go.columns import AnnotationTable, RecordIndex, RecordSequence
+from orangecontrib.bioinformatics.go.registry import Registry
+from orangecontrib.bioinformatics.go import topology
 
 
 intern = sys.intern
+
+# shared Ontology and Annotations instances (see Ontology.shared and Annotations.shared)
+_registry = Registry()
 default_database_path = os.path.join(serverfiles.localpath(), "GO")
 
 _CVS_REVISION_RE = re.compile(r"^(rev)?(\d+\.\d+)+$")
@@ -127,48 +145,105 @@ domain: OBO:TERM
 definition: Indicates that a term is the intersection of several others [OBO:defs]"""]
 
 
+def _parse_tag_line(line, intern_tags=frozenset(["id", "name", "namespace", "alt_id", "is_a"])):
+    """ Parse a `tag: value {modifiers} ! comment` line of a stanza.
+
+    Return a (tag, value, modifiers, comment) tuple or `None` if the line
+    is not a tag line.
+    """
+    if ":" not in line:
+        return None
+    tag, rest = line.split(":", 1)
+    value, modifiers, comment = "", "", ""
+    if "!" in rest:
+        rest, comment = rest.split("!")
+    if "{" in rest:
+        value, modifiers = rest.split("{", 1)
+        modifiers = modifiers.strip("}")
+    else:
+        value = rest
+    tag = intern(tag)
+    value = value.strip()
+    comment = comment.strip()
+    if tag in intern_tags:
+        value, comment = intern(value), intern(comment)
+    return tag, value, modifiers, comment
+
+
 class OBOObject:
     """ Represents a generic OBO object (e.g. Term, Typedef, Instance, ...)
+
+    Only the id, name, namespace and links to related objects (tuples of
+    (typeId, id) pairs) are kept as attributes, the stanza is kept as a single
+    string. Other tags are parsed from the stanza when first accessed (e.g.
+    ``term.def_`` or ``term.alt_id``) and kept in `values`.
     """
+    __slots__ = ("ontology", "id", "name", "namespace", "related", "related_to", "_stanza", "_values")
+
     _INTERN_TAGS = ["id", "name", "namespace", "alt_id", "is_a"]
 
     def __init__(self, stanza=None, ontology=None):
         self.ontology = ontology
-        self._lines = []
-        self.values = {}
-        self.related = set()
-        self.related_to = set()
+        self._stanza = ""
+        self._values = None
+        self.related = ()
+        self.related_to = ()
         if stanza:
             self.parse_stanza(stanza)
 
     def parse_stanza(self, stanza):
-        intern_tags = set(self._INTERN_TAGS)
-        for line in stanza.splitlines():
-            if ":" not in line:
+        """ Parse a stanza given as a string or as a list of its lines.
+        """
+        lines = stanza.splitlines() if isinstance(stanza, str) else stanza
+        self._stanza = "\n".join(lines)
+        self._values = None
+
+        for line in lines:
+            parsed = _parse_tag_line(line)
+            if parsed is None:
                 continue
-            tag, rest = line.split(":", 1)
-            value, modifiers, comment = "", "", ""
-            if "!" in rest:
-                rest, comment = rest.split("!")
-            if "{" in rest:
-                value, modifiers = rest.split("{", 1)
-                modifiers = modifiers.strip("}")
-            else:
-                value = rest
-            tag = intern(tag)
-            value = value.strip()
-            comment = comment.strip()
-            if tag in intern_tags:
-                value, comment = intern(value), intern(comment)
-            self._lines.append((tag, value, modifiers, comment))
+            tag, value = parsed[:2]
+            if tag == "id":
+                self.id = value
+            elif tag == "name":
+                self.name = value
+            elif tag == "namespace":
+                self.namespace = value
+        self.related = tuple(OrderedDict.fromkeys(self.related_objects()))
+
+    @property
+    def _lines(self):
+        """ (tag, value, modifiers, comment) tuples of the stanza lines. """
+        return [parsed for parsed in map(_parse_tag_line, self._stanza.split("\n")) if parsed is not None]
+
+    def _parse_values(self):
+        values = {}
+        for tag, value, _, _ in self._lines:
             if tag in multipleTagSet:
-                self.values.setdefault(tag, []).append(value)
+                values.setdefault(tag, []).append(value)
             else:
-                self.values[tag] = value
-        self.related = set(self.related_objects())
-        self.__dict__.update(self.values)
-        if "def" in self.__dict__:
-            self.__dict__["def_"] = self.__dict__["def"]
+                values[tag] = value
+        return values
+
+    @property
+    def values(self):
+        """ A dictionary of tag values (lists for tags in `multipleTagSet`).
+
+        The stanza is parsed on the first access; changes of the dictionary are
+        seen by later accesses (and attributes), but not in the stanza (`repr`).
+        """
+        if self._values is None:
+            self._values = self._parse_values()
+        return self._values
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in OBOObject.__slots__:
+            raise AttributeError(name)
+        values = self.values
+        tag = "def" if name == "def_" else name
+        if tag in values:
+            return values[tag]
+        raise AttributeError("%r object has no attribute %r" % (type(self).__name__, name))
 
     def related_objects(self):
         """Return a list of tuple pairs where the first element is relationship
@@ -177,8 +252,10 @@ class OBOObject:
         """
         # TODO: add other defined Typedef ids
         typeIds = [intern("is_a")]
-        result = [(typeId, id) for typeId in typeIds for id in self.values.get(typeId, [])]
-        result = result + [tuple(map(intern, r.split(None, 1))) for r in self.values.get("relationship", [])]
+        # do not keep the parsed values of all objects while the ontology is loaded
+        values = self._values if self._values is not None else self._parse_values()
+        result = [(typeId, id) for typeId in typeIds for id in values.get(typeId, [])]
+        result = result + [tuple(map(intern, r.split(None, 1))) for r in values.get("relationship", [])]
         return result
 
     def __repr__(self):
@@ -207,15 +284,122 @@ class OBOObject:
 
 
 class Term(OBOObject):
-    pass
+    __slots__ = ()
 
 
 class Typedef(OBOObject):
-    pass
+    __slots__ = ()
 
 
 class Instance(OBOObject):
-    pass
+    __slots__ = ()
+
+
+def _open_obo(file):
+    """ Return an open OBO file (or file like object), its size in bytes
+    (`None` if unknown) and whether it should be closed after parsing.
+    """
+    if isinstance(file, str):
+        if os.path.isfile(file) and tarfile.is_tarfile(file):
+            tar = tarfile.open(file)
+            member = tar.getmember("gene_ontology_edit.obo")
+            return tar.extractfile(member), member.size, True
+        elif os.path.isfile(file):
+            return open(file, "rb"), os.path.getsize(file), True
+        elif os.path.isdir(file):
+            file = os.path.join(file, "gene_ontology_edit.obo")
+            return open(file, "rb"), os.path.getsize(file), True
+        else:
+            raise ValueError("Cannot open %r for parsing" % file)
+
+    try:
+        size = os.fstat(file.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        try:
+            position = file.tell()
+            size = file.seek(0, os.SEEK_END) - position
+            file.seek(position)
+        except (AttributeError, OSError, ValueError):
+            size = None
+    return file, size, False
+
+
+def _iter_stanzas(lines):
+    """ Yield lists of lines (without line endings) of stanzas in OBO `lines`.
+
+    A stanza starts with a ``[...]`` line and ends with an empty line (or a
+    start of another stanza). Lines before the first stanza are skipped.
+    """
+    stanza = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.startswith("["):
+            if stanza:
+                yield stanza
+            stanza = [line]
+        elif not line.strip():
+            if stanza:
+                yield stanza
+            stanza = None
+        elif stanza is not None:
+            stanza.append(line)
+    if stanza:
+        yield stanza
+
+
+def _serverfiles_info(filename, server_filename=FILENAME_ONTOLOGY):
+    """ Return serverfiles info of `filename` if it is the `server_filename` file from serverfiles, else `None`. """
+    try:
+        if os.path.samefile(filename, serverfiles.localpath(DOMAIN, server_filename)):
+            return serverfiles.info(DOMAIN, server_filename)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _source_key(filename, server_filename):
+    """ Return a hashable description of the version of the (serverfiles) file `filename`. """
+    stamp = source_stamp(filename, _serverfiles_info(filename, server_filename))
+    return os.path.abspath(filename), json.dumps(stamp, sort_keys=True)
+
+
+class CompiledTerms(Mapping):
+    """ A read-only mapping of term ids to :class:`Term` objects of a compiled ontology.
+
+    Terms are created (and kept) on first access. Iteration follows the order of terms in the ontology file.
+    """
+
+    def __init__(self, compiled, ontology):
+        self._compiled = compiled
+        self._ontology = ontology
+        self._terms = {}
+
+    def __getitem__(self, term_id):
+        term = self._terms.get(term_id)
+        if term is None:
+            index = self._compiled.index(term_id)
+            if index is None:
+                raise KeyError(term_id)
+            term = self._terms[term_id] = self._make_term(index)
+        return term
+
+    def _make_term(self, index):
+        compiled = self._compiled
+        term = Term(compiled.stanzas[index].split("\n"), self._ontology)
+        types, children = compiled.children.links(index)
+        term.related_to = tuple((intern(compiled.relation_types[type_index]), intern(compiled.term_id(child)))
+                                for type_index, child in zip(types, children))
+        return term
+
+    def __contains__(self, term_id):
+        return term_id in self._terms or (isinstance(term_id, str) and self._compiled.index(term_id) is not None)
+
+    def __iter__(self):
+        ids = self._compiled.ids
+        return (ids[index].decode() for index in self._compiled.order)
+
+    def __len__(self):
+        return len(self._compiled)
 
 
 class Ontology:
@@ -227,6 +411,13 @@ class Ontology:
     :param progress_callback:
         Optional `float -> None` function.
 
+    A parsed ontology file is compiled (see :mod:`~orangecontrib.bioinformatics.go.compiled`) and stored next to
+    it as ``<filename>.compiled`` (for any `filename`, not only downloaded files; nothing is written if the
+    directory is read-only); further instances are loaded from the compiled file until the ontology file changes.
+
+    Use :func:`Ontology.shared` to get a (read-only) instance shared with other users (e.g. widgets) of the
+    ontology.
+
 
     Example
     --------
@@ -247,12 +438,14 @@ class Ontology:
         self.alias_mapper = {}
         self.reverse_alias_mapper = defaultdict(set)
         self.header = ""
+        self._compiled = None
+        self._slim_mask = None
+        self._stamp = None
+        self._shared = False
 
-        if filename is not None:
-            self.parse_file(filename, progress_callback)
-        else:
+        if filename is None:
             filename = serverfiles.localpath_download(DOMAIN, FILENAME_ONTOLOGY)
-            self.parse_file(filename, progress_callback)
+        self._load(filename, progress_callback)
 
     @classmethod
     def load(cls, progress_callback=None):
@@ -268,59 +461,147 @@ class Ontology:
 
     Load = load
 
+    @classmethod
+    def shared(cls, progress_callback=None):
+        """
+        Return the current ontology (downloading it if necessary), shared by all callers.
+
+        The instance is loaded once for each version of the ontology file (concurrent calls wait for it) and
+        freed when it is no longer used. The shared ontology is read-only: setting its slims subset raises a
+        `TypeError`.
+
+        """
+        filename = serverfiles.localpath_download(DOMAIN, FILENAME_ONTOLOGY)
+
+        def load():
+            ontology = cls(filename, progress_callback=progress_callback)
+            ontology._shared = True
+            return ontology
+
+        key = (cls, ) + _source_key(filename, FILENAME_ONTOLOGY)
+        return _registry.get(key, load)
+
+    def _load(self, filename, progress_callback=None):
+        """
+        Load the ontology from the compiled file of `filename` if it is up to
+        date. Otherwise parse `filename` and (re)write the compiled file.
+        """
+        if not (isinstance(filename, str) and os.path.isfile(filename)):
+            self.parse_file(filename, progress_callback)
+            return
+
+        path = compiled_path(filename)
+        stamp = self._stamp = source_stamp(filename, _serverfiles_info(filename))
+        compiled = CompiledOntology.load(path, stamp)
+        if compiled is not None:
+            self._set_compiled(compiled)
+            return
+
+        self.parse_file(filename, progress_callback)
+        try:
+            self.compiled.save(path, stamp)
+        except OSError:
+            # e.g. a read-only location; the file is parsed again next time
+            pass
+
+    def _set_compiled(self, compiled):
+        self._compiled = compiled
+        self.header = compiled.header
+        self.terms = CompiledTerms(compiled, self)
+        self.typedefs = {typedef.id: typedef for typedef in
+                         (Typedef(stanza.split("\n"), self) for stanza in compiled.typedefs)}
+        self.instances = {instance.id: instance for instance in
+                          (Instance(stanza.split("\n"), self) for stanza in compiled.instances)}
+
+        self.alias_mapper = {alt_id: compiled.term_id(index) for alt_id, index in compiled.aliases()}
+        self.reverse_alias_mapper = defaultdict(set)
+        for alt_id, term_id in self.alias_mapper.items():
+            self.reverse_alias_mapper[term_id].add(alt_id)
+
+    @property
+    def compiled(self):
+        """
+        The ontology in flat arrays (:class:`~orangecontrib.bioinformatics.go.compiled.CompiledOntology`).
+        """
+        if self._compiled is None:
+            self._compiled = CompiledOntology.from_ontology(self)
+        return self._compiled
+
     def parse_file(self, file, progress_callback=None):
         """
         Parse the file. file can be a filename string or an open file like
         object. The optional progressCallback will be called with a single
         argument to report on the progress.
+
+        The file is parsed line by line and the progress is reported by the
+        number of bytes read.
         """
-        if isinstance(file, str):
-            if os.path.isfile(file) and tarfile.is_tarfile(file):
-                f = tarfile.open(file).extractfile("gene_ontology_edit.obo")
-            elif os.path.isfile(file):
-                f = open(file)
-            elif os.path.isdir(file):
-                f = open(os.path.join(file, "gene_ontology_edit.obo"))
-            else:
-                raise ValueError("Cannot open %r for parsing" % file)
-        else:
-            f = file
-
-        data = [line.decode() if not isinstance(line, str) else line for line in f.readlines()]
-        data = "".join([line for line in data if not line.startswith("!")])
-        self.header = data[: data.index("[Term]")]
-        c = re.compile("\[.+?\].*?\n\n", re.DOTALL)
-        data = c.findall(data)
-
-        milestones = progress_bar_milestones(len(data), 90)
-        for i, block in enumerate(builtinOBOObjects + data):
-            if block.startswith("[Term]"):
-                term = Term(block, self)
-                self.terms[term.id] = term
-            elif block.startswith("[Typedef]"):
-                typedef = Typedef(block, self)
-                self.typedefs[typedef.id] = typedef
-            elif block.startswith("[Instance]"):
-                instance = Instance(block, self)
-                self.instances[instance.id] = instance
-            if progress_callback and i in milestones:
-                progress_callback(90.0 * i / len(data))
+        f, size, close = _open_obo(file)
+        header = []
+        bytes_read = [0]
+        reported = [0]
+
+        def lines():
+            in_header = True
+            for line in f:
+                bytes_read[0] += len(line)
+                if not isinstance(line, str):
+                    line = line.decode()
+                if line.startswith("!"):
+                    continue
+                if in_header:
+                    if line.startswith("[Term]"):
+                        in_header = False
+                    else:
+                        header.append(line)
+                yield line
+
+        try:
+            for stanza in itertools.chain((block.splitlines() for block in builtinOBOObjects),
+                                          _iter_stanzas(lines())):
+                self._add_stanza(stanza)
+                if progress_callback and size:
+                    progress = int(90 * bytes_read[0] / size)
+                    if progress > reported[0]:
+                        reported[0] = progress
+                        progress_callback(float(progress))
+        finally:
+            if close:
+                f.close()
+
+        self.header = "".join(header)
 
         self.alias_mapper = {}
         self.reverse_alias_mapper = defaultdict(set)
+        related_to = defaultdict(list)
         milestones = progress_bar_milestones(len(self.terms), 10)
         for i, (id, term) in enumerate(six.iteritems(self.terms)):
             for typeId, parent in term.related:
-                self.terms[parent].related_to.add((typeId, id))
+                related_to[parent].append((typeId, id))
             try:
                 self.alias_mapper.update([(alt_id, id)
                                           for alt_id in term.alt_id])
-                self.reverse_alias_mapper[id].union_update(term.alt_id)
+                self.reverse_alias_mapper[id].update(term.alt_id)
             except AttributeError:
                 pass
             if progress_callback and i in milestones:
                 progress_callback(90.0 + 10.0 * i / len(self.terms))
 
+        for id, links in related_to.items():
+            self.terms[id].related_to = tuple(links)
+
+    def _add_stanza(self, lines):
+        stanza_type = lines[0] if lines else ""
+        if stanza_type.startswith("[Term]"):
+            term = Term(lines, self)
+            self.terms[term.id] = term
+        elif stanza_type.startswith("[Typedef]"):
+            typedef = Typedef(lines, self)
+            self.typedefs[typedef.id] = typedef
+        elif stanza_type.startswith("[Instance]"):
+            instance = Instance(lines, self)
+            self.instances[instance.id] = instance
+
     def defined_slims_subsets(self):
         """
         Return a list of defined subsets in the ontology.
@@ -353,12 +634,20 @@ class Ontology:
         `subset` may also be a string, in which case the call is equivalent
         to ``ont.set_slims_subsets(ont.named_slims_subset(subset))``
 
+        Raises `TypeError` for the shared ontology (see :func:`Ontology.shared`).
+
         """
+        if self._shared:
+            raise TypeError('Shared ontology is read-only')
         if isinstance(subset, str):
             self.slims_subset = set(self.named_slims_subset(subset))
         else:
             self.slims_subset = set(subset)
 
+    def _term_indices(self, terms, missing=None):
+        """ Return compiled indices of `terms` (alternative ids are resolved). """
+        return self.compiled.indices([self.alias_mapper.get(term, term) for term in terms], missing=missing)
+
     def slims_for_term(self, term):
         """
         Return a list of slim term IDs for `term`.
@@ -368,18 +657,29 @@ class Ontology:
         :param str term: Term ID.
 
         """
-        queue = set([term])
-        visited = set()
-        slims = set()
-        while queue:
-            term = queue.pop()
-            visited.add(term)
-            if term in self.slims_subset:
-                slims.add(term)
-            else:
-                queue.update(set(tid for _, tid in self[term].related) -
-                             visited)
-        return slims
+        return self.slims_for_terms([term])[term]
+
+    def slims_for_terms(self, terms):
+        """
+        Return a dictionary mapping each of `terms` to a set of its `most
+        specific` slim term IDs (see :func:`slims_for_term`).
+
+        :param list terms: A list of term IDs.
+
+        """
+        compiled = self.compiled
+        subset = frozenset(self.slims_subset)
+        if self._slim_mask is None or self._slim_mask[0] != subset:
+            slim_mask = np.zeros(len(compiled), dtype=bool)
+            slim_mask[compiled.indices([term for term in subset if term in self.terms])] = True
+            self._slim_mask = (subset, slim_mask)
+
+        slims, counts = gather_rows(compiled.closure.slims(self._slim_mask[1]), self._term_indices(terms))
+        term_ids = compiled.term_ids
+        result = {}
+        for term, row in zip(terms, np.split(slims, np.cumsum(counts)[:-1])):
+            result[term] = {term} if term in subset else set(term_ids[i] for i in row)
+        return result
 
     def extract_super_graph(self, terms):
         """
@@ -388,15 +688,11 @@ class Ontology:
         :param list terms: A list of term IDs.
 
         """
-        terms = [terms] if isinstance(terms, str) else terms
-        visited = set()
-        queue = set(terms)
-        while queue:
-            term = queue.pop()
-            visited.add(term)
-            queue.update(set(tid for _, tid in self[term].related) -
-                         visited)
-        return visited
+        terms = [terms] if isinstance(terms, str) else list(terms)
+        compiled = self.compiled
+        ancestors = compiled.closure.ancestors_of(self._term_indices(terms))
+        term_ids = compiled.term_ids
+        return set(terms).union(term_ids[i] for i in ancestors)
 
     def extract_sub_graph(self, terms):
         """
@@ -405,28 +701,20 @@ class Ontology:
         :param list terms: A list of term IDs.
 
         """
-        terms = [terms] if type(terms) == str else terms
-        visited = set()
-        queue = set(terms)
-        while queue:
-            term = queue.pop()
-            visited.add(term)
-            queue.update(set(tid for _, tid in self[term].related_to) -
-                         visited)
-        return visited
+        terms = [terms] if isinstance(terms, str) else list(terms)
+        compiled = self.compiled
+        descendants = compiled.closure.descendants_of(self._term_indices(terms))
+        term_ids = compiled.term_ids
+        return set(terms).union(term_ids[i] for i in descendants)
 
-    def term_depth(self, term, cache_={}):
+    def term_depth(self, term):
         """
         Return the minimum depth of a `term`.
 
         (length of the shortest path to this term from the top level term).
 
         """
-        if term not in cache_:
-            cache_[term] = min([self.term_depth(parent) + 1
-                                for _, parent in self[term].related] or
-                               [1])
-        return cache_[term]
+        return int(self.compiled.closure.depths[self._term_indices([term])[0]])
 
     def __getitem__(self, termid):
         """
@@ -492,6 +780,86 @@ class AnnotationRecord(_AnnotationRecordBase):
         return AnnotationRecord._make(map(intern, string.strip().split('\t')))
 
 
+def _read_columns(file, n_fields):
+    """ Read tab separated records from `file` into a list of `n_fields` columns.
+    """
+    data = file.read().strip('\n')
+    if not data:
+        return [[] for _ in range(n_fields)]
+
+    values = data.replace('\n', '\t').split('\t')
+    if len(values) != n_fields * (data.count('\n') + 1):
+        # irregular (blank or malformed) lines; split line by line
+        rows = [line.strip().split('\t') for line in data.split('\n') if line.strip()]
+        for row in rows:
+            if len(row) != n_fields:
+                raise ValueError('Malformed annotation record: {!r}'.format('\t'.join(row)))
+        return [list(column) for column in zip(*rows)] if rows else [[] for _ in range(n_fields)]
+    return [values[i::n_fields] for i in range(n_fields)]
+
+
+def _evidence_bitmask(evidence_codes):
+    """ Return a bitmask of `evidence_codes` (a sum of their :obj:`evidenceDict` values) and a frozenset of
+    codes that are not in :obj:`evidenceDict`.
+    """
+    bits = [evidenceDict.get(code, 0) for code in evidence_codes]
+    return sum(set(bits)), frozenset(code for code, bit in zip(evidence_codes, bits) if not bit)
+
+
+class _AnnotationIndex:
+    """ Annotations filtered by evidence codes and aspects.
+
+    :param table: :class:`AnnotationTable` with annotations.
+    :param tuple key: A tuple of an evidence bitmask, a frozenset of other evidence codes
+        (see :func:`_evidence_bitmask`) and a frozenset of aspects (or None for all aspects).
+
+    """
+
+    def __init__(self, table, key):
+        bitmask, other_evidence, aspects = key
+        evidence = table.column('evidence')
+        bits = np.array([evidenceDict.get(code, 0) for code in table.levels['evidence']], dtype=np.int64)
+
+        #: A boolean mask of the table rows that pass the filter.
+        self.rows = (bits[evidence] & bitmask).astype(bool) if len(bits) else np.zeros(len(table), dtype=bool)
+        if other_evidence:
+            self.rows |= table.isin('evidence', other_evidence)
+        if aspects is not None:
+            self.rows &= table.isin('aspect', aspects)
+
+        self.table = table
+        self.key = key
+
+        #: The propagated annotations (see :func:`propagate`), once computed or loaded.
+        self.propagated = None
+
+    def propagate(self, ontology, term_indices):
+        """ Return a sparse boolean (terms x genes) matrix of annotations propagated to all ancestors of the
+        annotated terms.
+
+        Row `i` marks all genes annotated to the `i`-th term of the (compiled) `ontology` or any of its
+        descendants; columns correspond to levels of the `gene_id` column.
+
+        :param term_indices: The ontology index of each level of the `go_id` column (-1 for unknown terms).
+        """
+        compiled = ontology.compiled
+        terms = term_indices[self.table.column('go_id')[self.rows]]
+        genes = self.table.column('gene_id')[self.rows]
+        known = terms >= 0
+        direct = sp.csr_matrix((np.ones(np.count_nonzero(known), dtype=bool), (terms[known], genes[known])),
+                               shape=(len(compiled), len(self.table.levels['gene_id'])))
+        descendants = compiled.closure.descendants + sp.identity(len(compiled), dtype=bool, format='csr')
+        propagated = (descendants @ direct).tocsr()
+        propagated.sort_indices()
+        return propagated
+
+    def describe(self):
+        """ Return a JSON serializable description of the filter. """
+        bitmask, other_evidence, aspects = self.key
+        return {'evidence': bitmask, 'other_evidence': sorted(other_evidence),
+                'aspects': sorted(aspects) if aspects is not None else None}
+
+
 class Annotations:
     """ :class:`Annotations` object holds the annotations.
 
@@ -501,29 +869,45 @@ class Annotations:
     :param ontology: :class:`Ontology` object for annotations
     :type ontology: :class:`Ontology`
 
+    Use :func:`Annotations.shared` to get (read-only) annotations shared with other users.
+
     """
 
+    #: The number of memoized evidence code and aspect filtered annotation indices
+    MAX_INDICES = 4
+
+    #: The number of files kept in each cache directory (e.g. of propagated annotations) of an annotation file
+    MAX_CACHED_FILES = 8
+
+    #: The number of P-values computed between two reports of progress (and checks for cancellation)
+    P_VALUES_CHUNK = 1000
+
     def __init__(self, organism, ontology=None, progress_callback=None):
+        self._shared = False
+        self._lock = threading.RLock()
+        self._table = AnnotationTable(AnnotationRecord)
+        self._indices = OrderedDict()
+        self._term_indices = None
+        self._source = None
+
         self.ontology = ontology
 
-        #: A dictionary mapping a gene (gene_id) to a set of all annotations of that gene.
-        self.gene_annotations = defaultdict(list)
+        #: A mapping from a gene (gene_id) to a list of all annotations of that gene.
+        self.gene_annotations = RecordIndex(self._table, 'gene_id')
 
-        #: A dictionary mapping a GO term id to a set of annotations that are directly annotated to that term
-        self.term_anotations = defaultdict(list)
+        #: A mapping from a GO term id to a list of annotations that are directly annotated to that term
+        self.term_anotations = RecordIndex(self._table, 'go_id')
 
         self.all_annotations = defaultdict(list)
 
         self._gene_names = None
         self._gene_names_dict = None
 
-        #: A list of all :class:`AnnotationRecords` instances.
-        self.annotations = []
+        #: A sequence of all :class:`AnnotationRecords` instances.
+        self.annotations = RecordSequence(self._table)
         self.header = ''
         self.taxid = organism
 
-        self._ontology = None
-
         try:
             path = serverfiles.localpath_download(DOMAIN,
                                                   FILENAME_ANNOTATION.format(organism),
@@ -533,6 +917,32 @@ class Annotations:
 
         self._parse_file(path)
 
+    @classmethod
+    def shared(cls, organism, progress_callback=None):
+        """ Return annotations of `organism` (with the shared ontology, see :func:`Ontology.shared`), shared by
+        all callers.
+
+        The instance is loaded once for each version of the annotation and ontology files (concurrent calls wait
+        for it) and freed when it is no longer used. Shared annotations are read-only: adding annotations or
+        setting another ontology raises a `TypeError`.
+
+        :param str organism: An organism specifier (e.g. ``'9606'``).
+        """
+        filename = FILENAME_ANNOTATION.format(organism)
+        try:
+            path = serverfiles.localpath_download(DOMAIN, filename, progress_callback=progress_callback)
+        except FileNotFoundError:
+            raise taxonomy.UnknownSpeciesIdentifier(organism)
+        ontology = Ontology.shared()
+
+        def load():
+            annotations = cls(organism, ontology=ontology)
+            annotations._shared = True
+            return annotations
+
+        key = (cls, organism) + _source_key(path, filename) + (json.dumps(ontology._stamp, sort_keys=True), )
+        return _registry.get(key, load)
+
     @property
     def ontology(self):
         return self._ontology
@@ -541,8 +951,30 @@ class Annotations:
     def ontology(self, ontology):
         """ Set the ontology to use in the annotations mapping.
         """
-        self.all_annotations = defaultdict(list)
+        if self._shared and ontology is not self._ontology:
+            raise TypeError('Shared annotations are read-only')
         self._ontology = ontology
+        self._invalidate()
+
+    def _invalidate(self):
+        """ Clear all derived (cached) annotation indices. """
+        self.all_annotations = defaultdict(list)
+        self._indices.clear()
+        self._term_indices = None
+
+    def _index(self, evidence_codes, aspects=None):
+        """ Return a (memoized) :class:`_AnnotationIndex` of annotations with `evidence_codes` and `aspects`.
+        """
+        bitmask, other_evidence = _evidence_bitmask(evidence_codes)
+        key = (bitmask, other_evidence, frozenset(aspects) if aspects is not None else None)
+        with self._lock:
+            index = self._indices.pop(key, None)
+            if index is None:
+                index = _AnnotationIndex(self._table, key)
+            self._indices[key] = index
+            while len(self._indices) > self.MAX_INDICES:
+                self._indices.popitem(last=False)
+        return index
 
     def _ensure_ontology(self):
         if self.ontology is None:
@@ -552,23 +984,32 @@ class Annotations:
 
         with open(file_path, 'r') as anno_file:
             self.header = anno_file.readline()
+            columns = _read_columns(anno_file, len(AnnotationRecord._fields))
+
+        # skip records without a gene or a term and negative annotations (see add_annotation)
+        table = self._table
+        table.extend(columns)
+        table.compress(~(table.isin('gene_id', ['']) | table.isin('go_id', ['']) | table.isin('qualifier', ['NOT'])))
+        self._invalidate()
 
-            for line in anno_file.readlines():
-                self.add_annotation(AnnotationRecord.from_string(line))
+        info = _serverfiles_info(file_path, FILENAME_ANNOTATION.format(self.taxid))
+        self._source = (file_path, source_stamp(file_path, info))
 
     def add_annotation(self, a):
         """ Add a single :class:`AnotationRecord` instance to this object.
         """
+        if self._shared:
+            raise TypeError('Shared annotations are read-only')
         if not isinstance(a, AnnotationRecord):
             a = AnnotationRecord(a)
         if not a.gene_id or not a.go_id or a.qualifier == 'NOT':
             return
 
-        self.gene_annotations[a.gene_id].append(a)
-        self.term_anotations[a.go_id].append(a)
-
-        self.annotations.append(a)
-        self.all_annotations = defaultdict(list)
+        self._table.append(a)
+        # the annotations no longer match the file; do not use (or write) its propagated annotations
+        self._source = None
+        if self.all_annotations or self._indices or self._term_indices is not None:
+            self._invalidate()
 
     def get_genes_with_known_annotation(self, genes):
         """ Return only genes with known annotation
@@ -576,7 +1017,7 @@ class Annotations:
         :param genes: List of genes
 
         """
-        return {gene for gene in genes if self.gene_annotations[gene]}
+        return {gene for gene in genes if gene in self.gene_annotations}
 
     def _collect_annotations(self, go_id, visited):
         """ Recursive function collects and caches all annotations for id
@@ -629,7 +1070,21 @@ class Annotations:
         return list(set([int(ann.gene_id) for ann in annotations if ann.evidence in evidence_codes]))
 
     def genes(self):
-        return set([ann.gene_id for ann in self.annotations])
+        return set(self.gene_annotations)
+
+    def evidence_counts(self):
+        """ Return a dictionary mapping evidence codes to tuples of (number of annotations, number of
+        annotated genes).
+        """
+        table = self._table
+        evidence, genes = table.column('evidence'), table.column('gene_id')
+        n_genes = len(table.levels['gene_id'])
+        n_evidences = len(table.levels['evidence'])
+        annotations = np.bincount(evidence, minlength=n_evidences)
+        pairs = np.unique(evidence.astype(np.int64) * n_genes + genes)
+        annotated_genes = np.bincount(pairs // max(n_genes, 1), minlength=n_evidences)
+        return {code: (int(annotations[i]), int(annotated_genes[i]))
+                for i, code in enumerate(table.levels['evidence'])}
 
     def get_enriched_terms(self, genes,
                            reference=None,
@@ -638,7 +1093,8 @@ class Annotations:
                            aspect=None,
                            prob=statistics.Binomial(),
                            use_fdr=True,
-                           progress_callback=None):
+                           progress_callback=None,
+                           algorithm='classic'):
         """
         Return a dictionary of enriched terms, with tuples of
         (list_of_genes, p_value, reference_count) for items and term
@@ -654,10 +1110,48 @@ class Annotations:
         :param prob:
         :param use_fdr:
         :param progress_callback:
+        :param algorithm: `'classic'` (test each term independently), or one of topology-aware algorithms
+                          (see :mod:`~orangecontrib.bioinformatics.go.topology`): `'elim'`, `'weight'` or
+                          `'parent-child'`. With `'elim'`, genes and reference counts are those that were not
+                          removed from the term.
+        """
+
+        return self.get_enriched_terms_batch([genes], reference=reference, evidence_codes=evidence_codes,
+                                             slims_only=slims_only, aspect=aspect, prob=prob, use_fdr=use_fdr,
+                                             progress_callback=progress_callback, algorithm=algorithm)[0]
+
+    def get_enriched_terms_batch(self, gene_lists,
+                                 reference=None,
+                                 evidence_codes=None,
+                                 slims_only=False,
+                                 aspect=None,
+                                 prob=statistics.Binomial(),
+                                 use_fdr=True,
+                                 progress_callback=None,
+                                 n_jobs=None,
+                                 algorithm='classic'):
         """
+        Return a list of enriched terms (as returned by :func:`get_enriched_terms`) for each list of genes
+        in `gene_lists`, using a shared `reference`.
+
+        Term counts for all lists are computed at once; P-values are FDR adjusted (if use_fdr is True) within
+        each list.
+
+        :param gene_lists: A list of lists of genes (e.g. genes of clusters)
+        :param reference: List of genes (if None all genes included in the annotations will be used).
+        :param evidence_codes:  List of evidence codes to consider.
+        :param slims_only: If `True` return only slim terms.
+        :param aspect: Which aspects to use (see :func:`get_enriched_terms`).
+        :param prob:
+        :param use_fdr:
+        :param progress_callback:
+        :param n_jobs: The number of threads computing P-values (default: the number of CPUs).
+        :param algorithm: The enrichment algorithm (see :func:`get_enriched_terms`).
+        """
+        if algorithm not in topology.ALGORITHMS:
+            raise ValueError('Unknown enrichment algorithm {!r}'.format(algorithm))
+        gene_lists = list(gene_lists)
 
-        all_genes = set(genes)
-        
         if aspect is None:
             aspects_set = {'Process', 'Component', 'Function'}
         elif isinstance(aspect, str):
@@ -665,67 +1159,268 @@ class Annotations:
         else:
             aspects_set = aspect
 
-        if reference is None:
-            reference = self.genes()
-
         evidence_codes = set(evidence_codes or evidenceDict.keys())
-        annotations = [ann for gene in genes for ann in self.gene_annotations[gene]
-                       if ann.evidence in evidence_codes and ann.aspect in aspects_set]
-
-        ref_annotations = set([ann for gene in reference for ann in self.gene_annotations[gene]
-                               if ann.evidence in evidence_codes and ann.aspect in aspects_set])
-
-        annotations_dict = defaultdict(set)
-        for ann in annotations:
-            annotations_dict[ann.go_id].add(ann)
 
         self._ensure_ontology()
 
-        if slims_only and not self.ontology.slims_subset:
+        slims_subset = self.ontology.slims_subset
+        if slims_only and not slims_subset:
+            # the ontology may be shared (see :func:`Ontology.shared`), so the default is not stored in it
             warnings.warn("Unspecified slims subset in the ontology! " "Using 'goslim_generic' subset", UserWarning)
-            self.ontology.set_slims_subset('goslim_generic')
-
-        terms = annotations_dict.keys()
-        filtered_terms = [term for term in terms if term in self.ontology]
-
-        if len(terms) != len(filtered_terms):
-            term_diff = set(terms) - set(filtered_terms)
-            warnings.warn("%s terms in the annotations were not found in the "
-                          "ontology." % ",".join(map(repr, term_diff)), UserWarning)
+            slims_subset = set(self.ontology.named_slims_subset('goslim_generic'))
 
-        terms = self.ontology.extract_super_graph(filtered_terms)
-        res = {}
-
-        milestones = progress_bar_milestones(len(terms), 100)
-
-        for i, term in enumerate(terms):
-            if slims_only and term not in self.ontology.slims_subset:
-                continue
-            all_annotations = self.get_annotations_by_go_id(term).intersection(ref_annotations)
-            all_annotated_genes = set([ann.gene_id for ann in all_annotations])
-            mapped_genes = all_genes.intersection(all_annotated_genes)
-
-            if len(reference) > len(all_annotated_genes):
-                mapped_reference_genes = reference.intersection(all_annotated_genes)
+        table = self._table
+        n_genes = len(table.levels['gene_id'])
+        if reference is None:
+            reference = self.genes()
+            in_reference = np.ones(n_genes, dtype=bool)
+        else:
+            in_reference = self._gene_mask(reference)
+
+        # (genes x lists) membership of genes in the lists and of the genes in the reference
+        queries = [np.flatnonzero(self._gene_mask(genes)) for genes in gene_lists]
+        columns = np.repeat(np.arange(len(queries)), [len(query) for query in queries])
+        rows = np.concatenate(queries + [np.zeros(0, dtype=int)])
+        membership = sp.csc_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)),
+                                   shape=(n_genes, len(queries)))
+        mapped = in_reference[rows]
+        mapped_membership = sp.csc_matrix((np.ones(np.count_nonzero(mapped), dtype=np.int32),
+                                           (rows[mapped], columns[mapped])), shape=(n_genes, len(queries)))
+
+        index = self._index(evidence_codes, aspects_set)
+        query_rows = membership.sum(axis=1).A1.astype(bool)
+        self._warn_unknown_terms(index.rows & query_rows[table.column('gene_id')])
+
+        # terms annotated (directly or through their descendants) by genes of each list
+        incidence = self._propagated(index)
+        annotated = (incidence @ membership).tocsc()
+        mapped_counts = (incidence @ mapped_membership).tocsc()
+        reference_counts = incidence @ in_reference.astype(np.int32)
+
+        term_ids = self.ontology.compiled.term_ids
+        if slims_only:
+            is_slim = np.array([term_id in slims_subset for term_id in term_ids], dtype=bool)
+        annotated_terms, terms = [], []
+        for j in range(len(queries)):
+            list_terms = annotated.indices[annotated.indptr[j]:annotated.indptr[j + 1]]
+            list_terms = np.sort(list_terms[annotated.data[annotated.indptr[j]:annotated.indptr[j + 1]] > 0])
+            annotated_terms.append(list_terms)
+            terms.append(list_terms[is_slim[list_terms]] if slims_only else list_terms)
+
+        # progress: counts 0-10%, P-values of the classic test 10-80% and results of lists up to 100%; the
+        # topology-aware algorithms report the progress of each list (by levels of terms) from 10% on
+        def report(start, end):
+            return progress_callback and (lambda fraction: progress_callback(start + (end - start) * fraction))
+
+        if progress_callback:
+            progress_callback(10.0)
+
+        if algorithm == topology.CLASSIC:
+            k = np.concatenate([mapped_counts[:, j].toarray().ravel()[list_terms]
+                                for j, list_terms in enumerate(terms)] + [[]])
+            m = np.concatenate([reference_counts[list_terms] for list_terms in terms] + [[]])
+            n = np.repeat([len(genes) for genes in gene_lists], [len(list_terms) for list_terms in terms])
+            p_values = self._p_values(prob, k.astype(int), len(reference), m.astype(int), n, n_jobs,
+                                      progress_callback=report(10.0, 80.0))
+            offsets = np.cumsum([0] + [len(list_terms) for list_terms in terms])
+            list_progress = [report(80.0 + 20.0 * j / len(terms), 80.0 + 20.0 * (j + 1) / len(terms))
+                             for j in range(len(terms))]
+        else:
+            # annotations of reference genes and links between terms, shared by all lists
+            reference_columns = np.flatnonzero(in_reference)
+            parents = self.ontology.compiled.parents.to_matrix()
+            list_progress = [report(10.0 + 90.0 * j / len(terms), 10.0 + 90.0 * (j + 1) / len(terms))
+                             for j in range(len(terms))]
+
+        gene_ids = table.levels['gene_id']
+        results = []
+        for j, list_terms in enumerate(terms):
+            mapped_columns = queries[j][in_reference[queries[j]]]
+            if algorithm == topology.CLASSIC:
+                list_p_values = p_values[offsets[j]:offsets[j + 1]]
+                mapped = incidence[list_terms][:, mapped_columns].tocsr()
+                list_reference_counts = reference_counts[list_terms]
             else:
-                mapped_reference_genes = all_annotated_genes.intersection(reference)
+                list_p_values, mapped, list_reference_counts = self._topology_enrichment(
+                    algorithm, incidence, reference_columns, parents, annotated_terms[j], list_terms,
+                    mapped_columns, len(reference), len(gene_lists[j]),
+                    lambda k, N, m, n, progress=None: self._p_values(prob, k, N, m, n, n_jobs, progress),
+                    list_progress[j])
+            if use_fdr:
+                list_p_values = statistics.FDR(list_p_values)
+
+            mapped_genes = [gene_ids[gene] for gene in mapped_columns[mapped.indices].tolist()]
+            indptr = mapped.indptr.tolist()
+            results.append({
+                term_ids[term]: (mapped_genes[start:end], p_value, reference_count)
+                for term, start, end, p_value, reference_count in zip(
+                    list_terms.tolist(), indptr[:-1], indptr[1:], list_p_values.tolist(),
+                    list_reference_counts.tolist())
+            })
+
+            if progress_callback:
+                list_progress[j](1.0)
+        return results
+
+    def _topology_enrichment(self, algorithm, incidence, reference_columns, parents, tested, terms, query,
+                             N, n, p_values, progress_callback=None):
+        """ Return P-values of `terms` computed with a topology-aware `algorithm`, a sparse (terms x `query`
+        genes) matrix of the terms' list genes and the terms' reference counts.
+
+        :param incidence: Propagated annotations (a sparse terms x genes matrix).
+        :param reference_columns: Indices (levels of the `gene_id` column) of the reference genes.
+        :param parents: A sparse boolean matrix of links to parents of all terms.
+        :param tested: Indices of terms annotated by genes of the list (which include their ancestors).
+        :param terms: Indices of the reported terms (a subset of `tested`).
+        :param query: Indices of genes of the list in the reference.
+        :param progress_callback: A function called with the fraction (0 to 1) of tested terms.
+        """
+        closure = self.ontology.compiled.closure
+        graph = topology.TermGenes(incidence[tested][:, reference_columns], parents[tested][:, tested],
+                                   closure.ancestors[tested][:, tested], closure.levels[tested])
+        query_mask = np.zeros(len(reference_columns), dtype=bool)
+        query_mask[np.searchsorted(reference_columns, query)] = True
+
+        genes = graph.incidence
+        if algorithm == topology.ELIM:
+            p, active = topology.elim(graph, query_mask, N, n, p_values, progress_callback=progress_callback)
+            genes = sp.csr_matrix((active, genes.indices, genes.indptr), shape=genes.shape)
+            genes.eliminate_zeros()
+        elif algorithm == topology.WEIGHT:
+            p = topology.weight(graph, query_mask, N, n, p_values, progress_callback=progress_callback)
+        else:
+            p = topology.parent_child(graph, query_mask, N, n,
+                                      lambda k, N, m, n: p_values(k, N, m, n, progress_callback))
 
-            res[term] = ([gene for gene in mapped_genes],
-                         prob.p_value(len(mapped_genes),
-                                      len(reference),
-                                      len(mapped_reference_genes),
-                                      len(genes)),
-                                      len(mapped_reference_genes))
+        selected = np.searchsorted(tested, terms)
+        genes = genes[selected]
+        return p[selected], genes[:, np.searchsorted(reference_columns, query)].tocsr(), np.diff(genes.indptr)
 
-            if progress_callback and i in milestones:
-                progress_callback(100.0 * i / len(terms))
+    @staticmethod
+    def _p_values(prob, k, N, m, n, n_jobs=None, progress_callback=None):
+        """ Return an array of `prob` P-values for arrays (or scalars) `k`, `N`, `m` and `n`, computed in parallel
+        chunks.
 
-        if use_fdr:
-            res = sorted(res.items(), key=lambda x: x[1][1])
-            res = dict([(id, (genes, p, ref))
-                        for (id, (genes, _, ref)), p in
-                        zip(res, statistics.FDR([p for _, (_, p, _) in res]))])
-        return res
+        :param progress_callback: A function called with the fraction (0 to 1) of computed P-values after each
+            chunk (of at most :obj:`P_VALUES_CHUNK` values). An exception raised by the callback (e.g. to cancel
+            the computation) stops the computation of the remaining chunks.
+        """
+        k, N, m, n = np.broadcast_arrays(k, N, m, n)
+        if hasattr(prob, 'p_values'):
+            def compute(chunk):
+                return np.asarray(prob.p_values(k[chunk], N[chunk], m[chunk], n[chunk]), dtype=float)
+        else:
+            def compute(chunk):
+                return np.array([prob.p_value(*args) for args in zip(k[chunk].tolist(), N[chunk].tolist(),
+                                                                     m[chunk].tolist(), n[chunk].tolist())],
+                                dtype=float)
+
+        n_jobs = n_jobs or os.cpu_count() or 1
+        n_chunks = max(1, min(n_jobs, len(k) // 10000))
+        if progress_callback or not hasattr(prob, 'p_values'):
+            n_chunks = max(n_chunks, -(-len(k) // Annotations.P_VALUES_CHUNK))
+        chunks = np.array_split(np.arange(len(k)), n_chunks)
+        parts = [None] * len(chunks)
+        done = 0
+
+        def store(i, part):
+            nonlocal done
+            parts[i] = part
+            done += len(part)
+            if progress_callback:
+                progress_callback(done / max(len(k), 1))
+
+        if len(chunks) == 1 or n_jobs == 1 or not hasattr(prob, 'p_values'):
+            for i, chunk in enumerate(chunks):
+                store(i, compute(chunk))
+        else:
+            # numpy and scipy release the GIL in the (vectorized) distribution functions
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(n_jobs, len(chunks))) as executor:
+                futures = {executor.submit(compute, chunk): i for i, chunk in enumerate(chunks)}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        store(futures[future], future.result())
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        return np.concatenate(parts)
+
+    def _propagated(self, index):
+        """ Return the propagated annotations of `index` (see :func:`_AnnotationIndex.propagate`).
+
+        The matrix is stored in the cache directory next to the annotation file, for each version of the
+        annotation file, the ontology and the filter, and is memory mapped from there if available.
+        """
+        # the lock makes concurrent users (e.g. of shared annotations) wait for one computation
+        with self._lock:
+            if index.propagated is None:
+                index.propagated = self._cached(
+                    'propagated', index.describe(),
+                    lambda: index.propagate(self.ontology, self._annotated_term_indices()))
+        return index.propagated
+
+    def _cached(self, kind, description, compute):
+        """ Return a matrix (see :func:`~orangecontrib.bioinformatics.go.compiled.save_matrix`) derived from the
+        annotations and the ontology, memory mapped from the cache directory of `kind` next to the annotation file.
+        If it is not there, `compute()` it and store it.
+
+        :param str kind: The kind of data (the name of the cache directory).
+        :param description: A JSON serializable description of the data (besides the annotations and ontology).
+        :param compute: A function that computes the matrix.
+        """
+        if self._source is None or self.ontology._stamp is None:
+            return compute()
+
+        filename, annotations_stamp = self._source
+        stamp = {'organism': self.taxid, 'annotations': annotations_stamp,
+                 'ontology': self.ontology._stamp, kind: description}
+        directory = '{}.{}'.format(filename, kind)
+        path = os.path.join(directory, hashlib.sha1(json.dumps(stamp, sort_keys=True).encode('utf-8')).hexdigest())
+
+        matrix = load_matrix(path, stamp)
+        if matrix is None:
+            matrix = compute()
+            try:
+                os.makedirs(directory, exist_ok=True)
+                save_matrix(path, matrix, stamp)
+                self._prune_cache(directory)
+            except OSError:
+                # e.g. a read-only location; the matrix is computed again next time
+                pass
+        return matrix
+
+    def _prune_cache(self, directory):
+        """ Remove all but the :obj:`MAX_CACHED_FILES` most recent files from `directory`. """
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[self.MAX_CACHED_FILES:]:
+            os.remove(path)
+
+    def _gene_mask(self, genes):
+        """ Return a boolean mask of annotated genes (levels of the `gene_id` column) in `genes`. """
+        table = self._table
+        mask = np.zeros(len(table.levels['gene_id']), dtype=bool)
+        codes = [table.code('gene_id', gene) for gene in genes]
+        mask[[code for code in codes if code is not None]] = True
+        return mask
+
+    def _annotated_term_indices(self):
+        """ Return an array with the ontology (compiled) index of each annotated term (levels of the `go_id`
+        column); terms that are not in the ontology have index -1.
+        """
+        if self._term_indices is None:
+            self._term_indices = self.ontology._term_indices(self._table.levels['go_id'], missing=-1)
+        return self._term_indices
+
+    def _warn_unknown_terms(self, rows):
+        """ Warn about terms of annotations (in `rows` mask) that are not in the ontology. """
+        terms = np.unique(self._table.column('go_id')[rows])
+        unknown = terms[self._annotated_term_indices()[terms] < 0]
+        if len(unknown):
+            term_diff = [self._table.levels['go_id'][i] for i in unknown]
+            warnings.warn("%s terms in the annotations were not found in the "
+                          "ontology." % ",".join(map(repr, term_diff)), UserWarning)
 
     def get_annotated_terms(self, genes, direct_annotation_only=False, evidence_codes=None, progress_callback=None):
         """ Return all terms that are annotated by genes with evidence_codes.
@@ -735,25 +1430,26 @@ class Annotations:
         genes = set([gene for gene in genes])
 
         evidence_codes = set(evidence_codes or evidenceDict.keys())
-        annotations = [ann for gene in genes for ann in self.gene_annotations[gene] if ann.evidence in evidence_codes]
+        table = self._table
+        query = self._gene_mask(genes)
+        rows = self._index(evidence_codes).rows & query[table.column('gene_id')]
 
         dd = defaultdict(set)
-        for ann in annotations:
-            dd[ann.go_id].add(ann.gene_id)
+        term_ids, gene_ids = table.levels['go_id'], table.levels['gene_id']
+        for term, gene in zip(table.column('go_id')[rows].tolist(), table.column('gene_id')[rows].tolist()):
+            dd[term_ids[term]].add(gene_ids[gene])
 
         if not direct_annotation_only:
             self._ensure_ontology()
-            terms = dd.keys()
-            filtered_terms = [term for term in terms if term in self.ontology]
-            if len(terms) != len(filtered_terms):
-                term_diff = set(terms) - set(filtered_terms)
-                warnings.warn("%s terms in the annotations were not found in the " 
-                              "ontology." % ",".join(map(repr, term_diff)), UserWarning)
-
-            terms = self.ontology.extract_super_graph(filtered_terms)
-            for i, term in enumerate(terms):
-                term_annotations = self.get_annotations_by_go_id(term).intersection(annotations)
-                dd[term].update([ann.gene_id for ann in term_annotations])
+            self._warn_unknown_terms(rows)
+
+            incidence = self._propagated(self._index(evidence_codes))
+            columns = np.flatnonzero(query)
+            mapped = incidence[:, columns].tocsr()
+            term_ids = self.ontology.compiled.term_ids
+            for term in np.flatnonzero(np.diff(mapped.indptr)).tolist():
+                term_genes = columns[mapped.indices[mapped.indptr[term]:mapped.indptr[term + 1]]].tolist()
+                dd[term_ids[term]].update(gene_ids[gene] for gene in term_genes)
         return dict(dd)
 
     def __add__(self, iterable):
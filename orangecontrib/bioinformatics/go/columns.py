@@ -0,0 +1,226 @@
+""" Columnar storage of GO annotations
+
+An :class:`AnnotationTable` stores annotation records (rows of a gene2go file) column by column. The values of
+each column are interned to integer codes (indices into the column's `levels`, the distinct values in the order
+of their first appearance), so a table is built without creating a Python object per record. Records are
+created on demand (and cached) when accessed through the :class:`RecordSequence` and :class:`RecordIndex` views.
+"""
+from collections import defaultdict
+from collections.abc import Mapping, Sequence
+from itertools import islice
+
+import numpy as np
+
+
+class AnnotationTable:
+    """ Records of `record_type` (a namedtuple) stored as integer coded columns.
+
+    :param record_type: A namedtuple class; its fields are the columns of the table.
+
+    """
+
+    def __init__(self, record_type):
+        self.record_type = record_type
+        self.fields = tuple(record_type._fields)
+
+        #: Distinct values of each column; `column(field)` are indices into `levels[field]`.
+        self.levels = {field: [] for field in self.fields}
+
+        self._lookup = {field: _interning_dict() for field in self.fields}
+        self._codes = {field: np.zeros(0, dtype=np.int32) for field in self.fields}
+        self._pending = {field: [] for field in self.fields}
+        self._records = None
+        self._groups = {}
+
+    def __len__(self):
+        return len(self._codes[self.fields[0]]) + len(self._pending[self.fields[0]])
+
+    def __contains__(self, row):
+        if len(row) != len(self.fields):
+            return False
+        mask = np.ones(len(self), dtype=bool)
+        for field, value in zip(self.fields, row):
+            code = self._lookup[field].get(value)
+            if code is None:
+                return False
+            mask &= self.column(field) == code
+        return bool(mask.any())
+
+    def code(self, field, value):
+        """ Return the integer code of `value` in column `field` (or None if the value is not in the table). """
+        return self._lookup[field].get(value)
+
+    def extend(self, columns):
+        """ Append rows given as `columns` (a sequence of equally long sequences of values, one for each field).
+        """
+        if len(columns) != len(self.fields) or len(set(map(len, columns))) > 1:
+            raise ValueError('Expected {} columns of equal length'.format(len(self.fields)))
+        n_rows = len(columns[0])
+        if not n_rows:
+            return
+
+        self._flush()
+        for field, column in zip(self.fields, columns):
+            lookup, levels = self._lookup[field], self.levels[field]
+            codes = np.fromiter(map(lookup.__getitem__, column), dtype=np.int32, count=n_rows)
+            levels.extend(islice(lookup, len(levels), None))
+            self._codes[field] = np.concatenate((self._codes[field], codes))
+
+        if self._records is not None:
+            self._records.extend([None] * n_rows)
+        self._groups.clear()
+
+    def isin(self, field, values):
+        """ Return a boolean mask of rows with one of `values` in column `field`. """
+        codes = [self.code(field, value) for value in values]
+        return np.isin(self.column(field), [code for code in codes if code is not None])
+
+    def compress(self, mask):
+        """ Keep only the rows selected by a boolean `mask`. Values that no longer appear in the table are
+        removed from the levels (and the remaining values are recoded).
+        """
+        self._flush()
+        mask = np.asarray(mask, dtype=bool)
+        for field in self.fields:
+            codes, levels = self._codes[field][mask], self.levels[field]
+            # remaining values, in the order of their first appearance
+            first = np.full(len(levels), len(codes))
+            np.minimum.at(first, codes, np.arange(len(codes)))
+            used = np.argsort(first, kind='stable')[:np.count_nonzero(first < len(codes))]
+            recode = np.zeros(len(levels), dtype=np.int32)
+            recode[used] = np.arange(len(used), dtype=np.int32)
+
+            self.levels[field] = [levels[i] for i in used.tolist()]
+            self._lookup[field] = _interning_dict(self.levels[field])
+            self._codes[field] = recode[codes]
+
+        if self._records is not None:
+            self._records = [record for record, keep in zip(self._records, mask.tolist()) if keep]
+        self._groups.clear()
+
+    def append(self, record):
+        """ Append a single record (a sequence of values of all columns).
+
+        Appended records are collected and merged into the column arrays on the next access.
+        """
+        if len(record) != len(self.fields):
+            raise ValueError('Rows must have {} values'.format(len(self.fields)))
+
+        for field, value in zip(self.fields, record):
+            lookup = self._lookup[field]
+            code = lookup[value]
+            if code == len(self.levels[field]):
+                self.levels[field].append(value)
+            self._pending[field].append(code)
+
+        if self._records is not None:
+            self._records.append(record if isinstance(record, self.record_type) else None)
+        self._groups.clear()
+
+    def _flush(self):
+        if self._pending[self.fields[0]]:
+            for field in self.fields:
+                codes = np.array(self._pending[field], dtype=np.int32)
+                self._codes[field] = np.concatenate((self._codes[field], codes))
+                self._pending[field] = []
+
+    def column(self, field):
+        """ Return an array of integer codes of the values in column `field`. """
+        self._flush()
+        return self._codes[field]
+
+    def group(self, field):
+        """ Return a tuple `(order, indptr)`, such that `order[indptr[i]:indptr[i + 1]]` are indices of
+        (in table order) rows with the `i`-th level of column `field`.
+        """
+        self._flush()
+        if field not in self._groups:
+            codes = self._codes[field]
+            indptr = np.zeros(len(self.levels[field]) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(codes, minlength=len(self.levels[field])), out=indptr[1:])
+            self._groups[field] = (np.argsort(codes, kind='stable').astype(np.int32), indptr)
+        return self._groups[field]
+
+    def rows(self, field, value):
+        """ Return indices of the rows with `value` in column `field`. """
+        code = self.code(field, value)
+        if code is None:
+            return np.zeros(0, dtype=np.int32)
+        order, indptr = self.group(field)
+        return order[indptr[code]:indptr[code + 1]]
+
+    def records(self, indices):
+        """ Return a list of records at `indices`. """
+        self._flush()
+        indices = np.arange(len(self))[indices] if isinstance(indices, slice) else np.asarray(indices, dtype=np.intp)
+        indices = indices.tolist()
+        if self._records is None:
+            self._records = [None] * len(self)
+
+        cache = self._records
+        missing = [i for i in indices if cache[i] is None]
+        if missing:
+            columns = [map(self.levels[field].__getitem__, self._codes[field][missing].tolist())
+                       for field in self.fields]
+            make = self.record_type._make
+            for i, values in zip(missing, zip(*columns)):
+                cache[i] = make(values)
+        return [cache[i] for i in indices]
+
+
+def _interning_dict(values=()):
+    """ Return a dictionary mapping `values` to their indices, which adds a missing key with the next index.
+    """
+    lookup = defaultdict(None, zip(values, range(len(values))))
+    lookup.default_factory = lookup.__len__
+    return lookup
+
+
+class RecordSequence(Sequence):
+    """ A read-only sequence view of the records in an :class:`AnnotationTable`. """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.table.records(index)
+        if not -len(self.table) <= index < len(self.table):
+            raise IndexError('record index out of range')
+        return self.table.records([index])[0]
+
+    def __iter__(self):
+        chunk = 4096
+        for start in range(0, len(self.table), chunk):
+            yield from self.table.records(slice(start, start + chunk))
+
+    def __contains__(self, record):
+        return record in self.table
+
+
+class RecordIndex(Mapping):
+    """ A read-only mapping view from values of a column of an :class:`AnnotationTable` to lists of records
+    with that value. Like in a `defaultdict(list)`, a value that is not in the table maps to an empty list.
+    """
+
+    def __init__(self, table, field):
+        self.table = table
+        self.field = field
+
+    def __getitem__(self, value):
+        return self.table.records(self.table.rows(self.field, value))
+
+    def __contains__(self, value):
+        return self.table.code(self.field, value) is not None
+
+    def get(self, value, default=None):
+        return self[value] if value in self else default
+
+    def __iter__(self):
+        return iter(list(self.table.levels[self.field]))
+
+    def __len__(self):
+        return len(self.table.levels[self.field])
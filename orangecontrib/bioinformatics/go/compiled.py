@@ -0,0 +1,508 @@
+""" Compiled (pre-parsed) ontology format
+
+A compiled ontology stores the terms of an :class:`~orangecontrib.bioinformatics.go.Ontology` in flat arrays:
+
+- term ids are interned to integers (indices into the sorted `ids` array), the order of terms in the source
+  file is kept in `order`,
+- parent (`is_a` and `relationship`) and child links are stored as CSR adjacency,
+- names, raw stanzas and other strings are stored in string tables.
+
+The arrays are written to a single binary file next to the source OBO file and are memory mapped on load, so
+loading a compiled ontology takes milliseconds. The file is invalidated by a change of the source file (its
+modification time and size) or of its serverfiles info.
+
+The same file format stores other (sparse or dense) matrices (:func:`save_matrix`, :func:`load_matrix`), e.g.
+annotations propagated through the ontology.
+"""
+import os
+import json
+import struct
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+
+
+#: Version of the compiled format. Files of other versions are ignored (and rewritten).
+FORMAT_VERSION = 2
+
+MAGIC = b'ORANGE-GO-COMPILED\0'
+ALIGNMENT = 16
+
+
+class StringTable:
+    """ A sequence of strings stored as utf-8 encoded bytes and offsets.
+
+    :param offsets: An array of `len(self) + 1` offsets of the strings in `data`.
+    :param data: An `uint8` array with the concatenated encoded strings.
+
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class CSRGraph:
+    """ Adjacency of a directed graph (of terms) in a compressed sparse row format.
+
+    Links of the node `i` are `indices[indptr[i]:indptr[i + 1]]` with the corresponding relation
+    `types` (indices into the ontology's `relation_types`).
+
+    """
+
+    def __init__(self, indptr, indices, types):
+        self.indptr = indptr
+        self.indices = indices
+        self.types = types
+
+    @classmethod
+    def from_links(cls, n_nodes, sources, targets, types):
+        sources, targets, types = (np.asarray(a, dtype=dtype) for a, dtype in
+                                   ((sources, np.int32), (targets, np.int32), (types, np.int16)))
+        order = np.lexsort((targets, sources))
+        indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=n_nodes), out=indptr[1:])
+        return cls(indptr, targets[order], types[order])
+
+    def transpose(self):
+        sources = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int32), np.diff(self.indptr))
+        return self.from_links(len(self.indptr) - 1, self.indices, sources, self.types)
+
+    def links(self, node):
+        """ Return `(types, nodes)` arrays of links of `node`. """
+        start, end = self.indptr[node], self.indptr[node + 1]
+        return self.types[start:end], self.indices[start:end]
+
+    def to_matrix(self):
+        """ Return the adjacency as a boolean `scipy.sparse.csr_matrix`. """
+        n = len(self.indptr) - 1
+        return sp.csr_matrix((np.ones(len(self.indices), dtype=bool), self.indices, self.indptr), shape=(n, n))
+
+
+def topological_levels(adjacency):
+    """ Return the length of the longest path from each node to a node without links (a root).
+
+    :param adjacency: A sparse (csr) adjacency matrix of a directed acyclic graph.
+    """
+    adjacency = adjacency.tocoo()
+    sources, targets = adjacency.row, adjacency.col
+    levels = np.zeros(adjacency.shape[0], dtype=np.int32)
+    for _ in range(adjacency.shape[0] + 1):
+        updated = levels.copy()
+        np.maximum.at(updated, sources, levels[targets] + 1)
+        if np.array_equal(updated, levels):
+            return levels
+        levels = updated
+    raise ValueError('The graph has cycles')
+
+
+def transitive_closure(adjacency, levels=None):
+    """ Return the (strict) transitive closure of a directed acyclic graph.
+
+    Rows of the closure are computed level by level (see :func:`topological_levels`), each level with one sparse
+    product of the nodes' links with the closure of the previous levels.
+
+    :param adjacency: A sparse (csr) adjacency matrix of a directed acyclic graph.
+    :return: A boolean `scipy.sparse.csr_matrix` with the nodes reachable from the node `i` in the row `i`.
+    """
+    adjacency = sp.csr_matrix(adjacency, dtype=bool)
+    n = adjacency.shape[0]
+    if levels is None:
+        levels = topological_levels(adjacency)
+
+    closure = sp.csr_matrix((n, n), dtype=bool)
+    order = np.argsort(levels, kind='stable')
+    bounds = np.flatnonzero(np.diff(levels[order])) + 1
+    for rows in np.split(order, bounds):
+        links = adjacency[rows]
+        if not links.nnz:
+            continue
+        block = (links + links @ closure).tocoo()
+        closure = closure + sp.csr_matrix((block.data, (rows[block.row], block.col)), shape=(n, n), dtype=bool)
+    return closure
+
+
+def row_positions(indptr, rows):
+    """ Return concatenated positions (in the `indices` and `data` arrays of a csr matrix with `indptr`) of
+    elements in `rows` and the number of elements in each row.
+    """
+    rows = np.asarray(rows, dtype=int)
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum()), lengths
+
+
+def gather_rows(matrix, rows):
+    """ Return concatenated column indices of `rows` of a csr `matrix` and the number of indices in each row. """
+    positions, lengths = row_positions(matrix.indptr, rows)
+    return matrix.indices[positions], lengths
+
+
+def minimum_depths(adjacency):
+    """ Return the length of the shortest path from each node to a root plus one (roots have depth 1). """
+    adjacency = adjacency.tocoo()
+    sources, targets = adjacency.row, adjacency.col
+    n = adjacency.shape[0]
+    depths = np.where(np.bincount(sources, minlength=n) > 0, n + 1, 1)
+    for _ in range(n + 1):
+        updated = depths.copy()
+        np.minimum.at(updated, sources, depths[targets] + 1)
+        if np.array_equal(updated, depths):
+            return depths
+        depths = updated
+    raise ValueError('The graph has cycles')
+
+
+class TermClosure:
+    """ Transitive closure of parent links (`Term.related`) of a compiled ontology.
+
+    Ancestors and descendants are stored as sparse boolean (csr) matrices, so queries for lists of terms are row
+    selections. Ancestors and descendants do not include the term itself.
+
+    :param parents: Parent links (:class:`CSRGraph`).
+
+    """
+
+    def __init__(self, parents):
+        self._parents = parents.to_matrix()
+        self.levels = topological_levels(self._parents)
+        self.ancestors = transitive_closure(self._parents, self.levels)
+        self.descendants = self.ancestors.T.tocsr()
+        self.depths = minimum_depths(self._parents)
+        self._slims = None
+
+    def ancestors_of(self, indices):
+        """ Return sorted indices of all ancestors of terms with `indices`. """
+        return np.unique(gather_rows(self.ancestors, indices)[0])
+
+    def descendants_of(self, indices):
+        """ Return sorted indices of all descendants of terms with `indices`. """
+        return np.unique(gather_rows(self.descendants, indices)[0])
+
+    def slims(self, slim_mask):
+        """ Return a (terms x terms) boolean csr matrix with the most specific slim terms of term `i` in row `i`.
+
+        These are slim terms reachable from the term without passing another slim term; a slim term maps to itself.
+
+        :param slim_mask: Boolean mask of slim terms.
+        """
+        slim_mask = np.asarray(slim_mask, dtype=bool)
+        if self._slims is None or not np.array_equal(self._slims[0], slim_mask):
+            n = len(slim_mask)
+            # do not follow links of the slim terms
+            links = self._parents.tocoo()
+            keep = ~slim_mask[links.row]
+            parents = sp.csr_matrix((links.data[keep], (links.row[keep], links.col[keep])), shape=(n, n))
+
+            reachable = (transitive_closure(parents, self.levels) + sp.identity(n, dtype=bool, format='csr')).tocoo()
+            keep = slim_mask[reachable.col]
+            slims = sp.csr_matrix((reachable.data[keep], (reachable.row[keep], reachable.col[keep])), shape=(n, n))
+            self._slims = (slim_mask.copy(), slims)
+        return self._slims[1]
+
+
+class CompiledOntology:
+    """ Terms of an ontology in flat (possibly memory mapped) arrays.
+
+    :ivar ids: Sorted term ids (a fixed width bytes array); term index is its position in this array.
+    :ivar order: Term indices in the order of terms in the source ontology.
+    :ivar names: Term names (:class:`StringTable`).
+    :ivar namespaces: Namespace codes of terms (indices into `namespace_names`).
+    :ivar obsolete: Boolean array marking obsolete terms.
+    :ivar parents: Parent links (:class:`CSRGraph`), i.e. `Term.related`.
+    :ivar children: Child links (:class:`CSRGraph`), i.e. `Term.related_to`.
+    :ivar stanzas: Raw stanzas of terms (:class:`StringTable`).
+
+    """
+
+    def __init__(self, arrays, meta):
+        self.meta = meta
+        self.header = meta['header']
+        self.relation_types = meta['relation_types']
+        self.namespace_names = meta['namespace_names']
+
+        self.ids = arrays['ids']
+        self.order = arrays['order']
+        self.names = StringTable(arrays['names_offsets'], arrays['names_data'])
+        self.namespaces = arrays['namespaces']
+        self.obsolete = arrays['obsolete'].view(bool)
+        self.parents = CSRGraph(arrays['parents_indptr'], arrays['parents_indices'], arrays['parents_types'])
+        self.children = CSRGraph(arrays['children_indptr'], arrays['children_indices'], arrays['children_types'])
+        self.stanzas = StringTable(arrays['stanzas_offsets'], arrays['stanzas_data'])
+        self.typedefs = StringTable(arrays['typedefs_offsets'], arrays['typedefs_data'])
+        self.instances = StringTable(arrays['instances_offsets'], arrays['instances_data'])
+        self.alt_ids = arrays['alt_ids']
+        self.alt_targets = arrays['alt_targets']
+
+        self._term_ids = None
+        self._closure = None
+
+    @classmethod
+    def from_ontology(cls, ontology):
+        """ Compile a parsed :class:`~orangecontrib.bioinformatics.go.Ontology`. """
+        term_ids = sorted(ontology.terms)
+        index = {term_id: i for i, term_id in enumerate(term_ids)}
+        order = np.array([index[term_id] for term_id in ontology.terms], dtype=np.int32)
+        terms = [ontology.terms[term_id] for term_id in term_ids]
+
+        relation_types = sorted({type_id for term in terms for type_id, _ in term.related})
+        relation_codes = {type_id: i for i, type_id in enumerate(relation_types)}
+        namespace_names = sorted({getattr(term, 'namespace', '') for term in terms})
+        namespace_codes = {name: i for i, name in enumerate(namespace_names)}
+
+        links = [(i, index[parent], relation_codes[type_id])
+                 for i, term in enumerate(terms) for type_id, parent in term.related if parent in index]
+        sources, targets, types = zip(*links) if links else ((), (), ())
+        parents = CSRGraph.from_links(len(terms), sources, targets, types)
+        children = parents.transpose()
+
+        aliases = sorted(ontology.alias_mapper.items())
+        names = StringTable.from_strings(getattr(term, 'name', '') for term in terms)
+        stanzas = StringTable.from_strings(_stanza(term) for term in terms)
+        typedefs = StringTable.from_strings(_stanza(typedef) for typedef in ontology.typedefs.values())
+        instances = StringTable.from_strings(_stanza(instance) for instance in ontology.instances.values())
+
+        arrays = {
+            'ids': _bytes_array(term_ids),
+            'order': order,
+            'names_offsets': names.offsets, 'names_data': names.data,
+            'namespaces': np.array([namespace_codes[getattr(term, 'namespace', '')] for term in terms],
+                                   dtype=np.int16),
+            'obsolete': np.array([getattr(term, 'is_obsolete', '') == 'true' for term in terms], dtype=np.uint8),
+            'parents_indptr': parents.indptr, 'parents_indices': parents.indices, 'parents_types': parents.types,
+            'children_indptr': children.indptr, 'children_indices': children.indices,
+            'children_types': children.types,
+            'stanzas_offsets': stanzas.offsets, 'stanzas_data': stanzas.data,
+            'typedefs_offsets': typedefs.offsets, 'typedefs_data': typedefs.data,
+            'instances_offsets': instances.offsets, 'instances_data': instances.data,
+            'alt_ids': _bytes_array([alt_id for alt_id, _ in aliases]),
+            'alt_targets': np.array([index[term_id] for _, term_id in aliases], dtype=np.int32),
+        }
+        meta = {'header': ontology.header,
+                'relation_types': relation_types,
+                'namespace_names': namespace_names}
+        return cls(arrays, meta)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, term_id, default=None):
+        """ Return the index of the term with `term_id` or `default` if there is no such term. """
+        key = term_id.encode('utf-8')
+        i = np.searchsorted(self.ids, key)
+        if i < len(self.ids) and self.ids[i] == key:
+            return int(i)
+        return default
+
+    def indices(self, term_ids, missing=None):
+        """ Return an array of indices of terms with `term_ids`.
+
+        :param missing: The index of terms that are not in the ontology (if None, raise a KeyError).
+        :raises KeyError: if a term is not in the ontology and `missing` is None.
+        """
+        keys = np.array([term_id.encode('utf-8') for term_id in term_ids], dtype=bytes)
+        if not len(keys) or not len(self.ids):
+            if len(keys) and missing is None:
+                raise KeyError(term_ids[0])
+            return np.full(len(keys), missing if missing is not None else 0, dtype=int)
+        indices = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+        not_found = self.ids[indices] != keys
+        if np.any(not_found):
+            if missing is None:
+                raise KeyError(term_ids[int(np.flatnonzero(not_found)[0])])
+            indices[not_found] = missing
+        return indices
+
+    def term_id(self, index):
+        return self.ids[index].decode('utf-8')
+
+    @property
+    def term_ids(self):
+        """ A list of all term ids (in the order of indices). """
+        if self._term_ids is None:
+            self._term_ids = np.char.decode(self.ids, 'utf-8').tolist()
+        return self._term_ids
+
+    @property
+    def closure(self):
+        """ The transitive closure index of parent links (:class:`TermClosure`), computed on first use. """
+        if self._closure is None:
+            self._closure = TermClosure(self.parents)
+        return self._closure
+
+    def aliases(self):
+        """ Return a list of `(alternative id, term index)` pairs. """
+        return list(zip((alt_id.decode('utf-8') for alt_id in self.alt_ids), self.alt_targets.tolist()))
+
+    def arrays(self):
+        return {
+            'ids': self.ids,
+            'order': self.order,
+            'names_offsets': self.names.offsets, 'names_data': self.names.data,
+            'namespaces': self.namespaces,
+            'obsolete': self.obsolete.view(np.uint8),
+            'parents_indptr': self.parents.indptr, 'parents_indices': self.parents.indices,
+            'parents_types': self.parents.types,
+            'children_indptr': self.children.indptr, 'children_indices': self.children.indices,
+            'children_types': self.children.types,
+            'stanzas_offsets': self.stanzas.offsets, 'stanzas_data': self.stanzas.data,
+            'typedefs_offsets': self.typedefs.offsets, 'typedefs_data': self.typedefs.data,
+            'instances_offsets': self.instances.offsets, 'instances_data': self.instances.data,
+            'alt_ids': self.alt_ids,
+            'alt_targets': self.alt_targets,
+        }
+
+    def save(self, path, stamp):
+        """ Write the compiled ontology to `path` (atomically).
+
+        :param path: Path of the compiled file.
+        :param stamp: A JSON serializable description of the source used to invalidate the file.
+
+        """
+        meta = dict(self.meta, format_version=FORMAT_VERSION, stamp=stamp)
+        write_arrays(path, self.arrays(), meta)
+
+    @classmethod
+    def load(cls, path, stamp):
+        """ Memory map the compiled ontology at `path`.
+
+        Return `None` if the file does not exist, is of a different format or was compiled from a
+        different source (its stamp differs from `stamp`).
+        """
+        try:
+            arrays, meta = read_arrays(path)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get('format_version') != FORMAT_VERSION or meta.get('stamp') != stamp:
+            return None
+        return cls(arrays, meta)
+
+
+def compiled_path(filename):
+    """ Return the path of the compiled ontology for the source `filename`. """
+    return filename + '.compiled'
+
+
+def source_stamp(filename, info=None):
+    """ Describe the source file `filename` (and its serverfiles `info`) for invalidation of the compiled file. """
+    stat = os.stat(filename)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'info': info}
+
+
+def save_matrix(path, matrix, stamp):
+    """ Write a sparse (stored in CSR format) or dense `matrix` to `path` (atomically).
+
+    :param path: Path of the file.
+    :param stamp: A JSON serializable description of the sources used to invalidate the file.
+
+    """
+    if sp.issparse(matrix):
+        matrix = matrix.tocsr()
+        arrays = {'indptr': matrix.indptr, 'indices': matrix.indices, 'data': matrix.data}
+    else:
+        matrix = np.asarray(matrix)
+        arrays = {'dense': matrix}
+    write_arrays(path, arrays, {'format_version': FORMAT_VERSION, 'stamp': stamp, 'shape': matrix.shape})
+
+
+def load_matrix(path, stamp):
+    """ Memory map a sparse (CSR) or dense matrix written with :func:`save_matrix`.
+
+    Return `None` if the file does not exist, is of a different format or its stamp differs from `stamp`.
+    """
+    try:
+        arrays, meta = read_arrays(path)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('format_version') != FORMAT_VERSION or meta.get('stamp') != stamp:
+        return None
+    try:
+        if 'dense' in arrays:
+            return arrays['dense']
+        return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']))
+    except (KeyError, ValueError):
+        return None
+
+
+def write_arrays(path, arrays, meta):
+    """ Write `arrays` (a dictionary of numpy arrays) and a JSON serializable `meta` to a single file. """
+    specs, offset = {}, 0
+    for name, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        specs[name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+        offset += array.nbytes
+
+    header = json.dumps(dict(meta, arrays=specs)).encode('utf-8')
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            for name, array in arrays.items():
+                f.seek(start + specs[name]['offset'])
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.truncate(start + offset)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_arrays(path):
+    """ Memory map arrays written with :func:`write_arrays`. Return a tuple `(arrays, meta)`. """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a compiled ontology'.format(path))
+        header_size, = struct.unpack('<Q', f.read(8))
+        meta = json.loads(f.read(header_size).decode('utf-8'))
+
+    start = -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+    size = os.path.getsize(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode='r') if size else np.zeros(0, dtype=np.uint8)
+
+    arrays = {}
+    for name, spec in meta.pop('arrays').items():
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+        begin = start + spec['offset']
+        end = begin + dtype.itemsize * int(np.prod(shape))
+        if end > size:
+            raise ValueError('{} is truncated'.format(path))
+        arrays[name] = buffer[begin:end].view(dtype).reshape(shape)
+    return arrays, meta
+
+
+def _bytes_array(strings):
+    return np.array([s.encode('utf-8') for s in strings], dtype=bytes) if strings else np.zeros(0, dtype='S1')
+
+
+def _stanza(obo_object):
+    """ Return the stanza of an OBO object, written so that it parses back to the same tags and values. """
+    lines = ['[{}]'.format(type(obo_object).__name__)]
+    for tag, value, modifiers, comment in obo_object._lines:
+        line = tag + ': ' + value
+        if modifiers:
+            line += ' {' + modifiers + '}'
+        if comment:
+            line += '! ' + comment
+        lines.append(line)
+    return '\n'.join(lines)
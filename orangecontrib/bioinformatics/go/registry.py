@@ -0,0 +1,88 @@
+""" Shared instances of objects loaded from files
+
+A :class:`Registry` keeps instances (e.g. of :class:`~orangecontrib.bioinformatics.go.Ontology`) by keys that
+describe their sources (e.g. the version of the file), so all users of the same source share one instance.
+Instances are kept by weak references: an instance is freed when it is no longer used and loaded again when
+it is requested later. An instance is loaded only once; concurrent requests for it wait for the thread that
+loads it.
+"""
+import threading
+import weakref
+
+
+class Registry:
+    """ A registry of shared, weakly referenced instances. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instances = weakref.WeakValueDictionary()
+        self._loading = {}
+
+    def get(self, key, load):
+        """ Return the instance for `key`; if there is none, `load()` it and store it.
+
+        If another thread is loading the instance, wait for it and return its instance (or raise its exception).
+
+        :param key: A hashable description of the instance's source.
+        :param load: A function that creates the instance.
+        """
+        with self._lock:
+            instance = self._instances.get(key)
+            if instance is not None:
+                return instance
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = _Loading()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return loading.result()
+
+        try:
+            instance = load()
+        except BaseException as error:
+            with self._lock:
+                del self._loading[key]
+            loading.set_error(error)
+            raise
+        with self._lock:
+            self._instances[key] = instance
+            del self._loading[key]
+        loading.set_result(instance)
+        return instance
+
+    def __contains__(self, key):
+        return key in self._instances
+
+    def __len__(self):
+        return len(self._instances)
+
+    def clear(self):
+        """ Forget all instances (they are not freed while they are used). """
+        with self._lock:
+            self._instances.clear()
+
+
+class _Loading:
+    """ An instance that is being loaded (by another thread). """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._instance = None
+        self._error = None
+
+    def set_result(self, instance):
+        self._instance = instance
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._instance
@@ -0,0 +1,251 @@
+""" Semantic similarity of GO terms and genes
+
+Similarity of terms is based either on
+
+- the information content (IC) of terms, `-log p(t)`, where `p(t)` is the fraction of genes (of the term's
+  namespace) that are annotated to the term or any of its descendants (Resnik and Lin similarity), or
+- the semantic values of the terms' ancestors, which decrease with the (weighted) distance from the term
+  (Wang similarity).
+
+Similarity of two genes is the best-match average (BMA) of similarities of their (directly annotated) terms.
+
+Example::
+
+    from orangecontrib.bioinformatics import go
+    from orangecontrib.bioinformatics.go.similarity import SemanticSimilarity
+
+    similarity = SemanticSimilarity(go.Annotations('9606'), aspect='Process')
+    matrix = similarity.gene_similarity(genes, method='lin')
+
+"""
+import hashlib
+import json
+
+import numpy as np
+import scipy.sparse as sp
+
+from orangecontrib.bioinformatics.go import evidenceDict
+from orangecontrib.bioinformatics.go.compiled import gather_rows
+
+
+RESNIK, LIN, WANG = 'resnik', 'lin', 'wang'
+METHODS = (RESNIK, LIN, WANG)
+
+# The number of matrix elements computed at once (limits the memory use).
+_BLOCK_SIZE = 1 << 22
+
+
+class SemanticSimilarity:
+    """ Semantic similarity of GO terms and genes.
+
+    The information content of terms is computed from the propagated annotations (which are cached next to the
+    annotation file, see :class:`~orangecontrib.bioinformatics.go.Annotations`); gene similarity matrices can be
+    cached in the same way (see :func:`gene_similarity`).
+
+    :param annotations: :class:`~orangecontrib.bioinformatics.go.Annotations` (with the ontology).
+    :param evidence_codes: Evidence codes of annotations to use (default: all).
+    :param aspect: Aspect(s) of annotations to use (`'Process'`, `'Function'`, `'Component'` or a set of them;
+        None for all).
+
+    """
+
+    #: Weights of links of each type in Wang similarity; links of other types are not followed.
+    WANG_WEIGHTS = {'is_a': 0.8, 'part_of': 0.6}
+
+    def __init__(self, annotations, evidence_codes=None, aspect='Process'):
+        annotations._ensure_ontology()
+        aspects = {aspect} if isinstance(aspect, str) else aspect
+        self.annotations = annotations
+        self.ontology = annotations.ontology
+        self._index = annotations._index(set(evidence_codes or evidenceDict.keys()), aspects)
+        self._ancestors = None
+        self._weighted_parents = None
+
+        compiled = self.ontology.compiled
+        counts = np.diff(annotations._propagated(self._index).indptr)
+        totals = np.zeros(len(compiled.namespace_names), dtype=counts.dtype)
+        np.maximum.at(totals, compiled.namespaces, counts)
+
+        #: Information content of each term (in the order of the compiled ontology's indices); terms without
+        #: annotations have no information (0).
+        self.information_content = np.where(
+            counts > 0, np.log(np.maximum(totals[compiled.namespaces], 1)) - np.log(np.maximum(counts, 1)), 0.0)
+
+        # (genes x terms) direct annotations; rows are levels of the `gene_id` column
+        table = annotations._table
+        rows = self._index.rows
+        terms = annotations._annotated_term_indices()[table.column('go_id')[rows]]
+        genes = table.column('gene_id')[rows]
+        known = terms >= 0
+        self._gene_terms = sp.csr_matrix(
+            (np.ones(np.count_nonzero(known), dtype=bool), (genes[known], terms[known])),
+            shape=(len(table.levels['gene_id']), len(compiled)))
+
+    def term_similarity(self, terms1, terms2=None, method=RESNIK):
+        """ Return a matrix of similarities between terms in `terms1` (rows) and `terms2` (columns).
+
+        :param terms1: A list of term ids.
+        :param terms2: A list of term ids (default: `terms1`).
+        :param str method: `'resnik'`, `'lin'` or `'wang'`.
+        :raises KeyError: if a term is not in the ontology.
+        """
+        _check_method(method)
+        indices1 = self.ontology._term_indices(list(terms1))
+        indices2 = indices1 if terms2 is None else self.ontology._term_indices(list(terms2))
+        return self._term_similarity(indices1, indices2, method)
+
+    def gene_similarity(self, genes1, genes2=None, method=RESNIK, cache=False):
+        """ Return a matrix of best-match average similarities between genes in `genes1` (rows) and `genes2`
+        (columns).
+
+        Similarity of genes without annotations (with the chosen evidence codes and aspects) is 0.
+
+        :param genes1: A list of genes (gene ids).
+        :param genes2: A list of genes (default: `genes1`).
+        :param str method: Similarity of terms, `'resnik'`, `'lin'` or `'wang'`.
+        :param bool cache: Store the (dense) matrix in the cache directory next to the annotation file and load it
+            from there when it is requested again (default False). Only the most recent matrices are kept, but each
+            takes `8 * len(genes1) * len(genes2)` bytes of disk space.
+        """
+        _check_method(method)
+        genes1 = list(genes1)
+        genes2 = genes1 if genes2 is None else list(genes2)
+        if not cache:
+            return self._gene_similarity(genes1, genes2, method)
+
+        genes = hashlib.sha1(json.dumps([genes1, genes2]).encode('utf-8')).hexdigest()
+        description = {'genes': genes, 'method': method, 'filter': self._index.describe()}
+        return np.array(self.annotations._cached(
+            'similarity', description, lambda: self._gene_similarity(genes1, genes2, method)))
+
+    def _gene_similarity(self, genes1, genes2, method):
+        gene_terms1, terms1 = self._terms_of(genes1)
+        gene_terms2, terms2 = self._terms_of(genes2)
+        similarity = self._term_similarity(terms1, terms2, method)
+
+        # sums of best matches of terms of genes2 among terms of genes1, and vice versa
+        best1 = _best_matches(gene_terms1, similarity) @ gene_terms2.T
+        best2 = _best_matches(gene_terms2, similarity.T) @ gene_terms1.T
+        sizes = np.add.outer(gene_terms1.getnnz(axis=1), gene_terms2.getnnz(axis=1))
+        return np.divide(best1 + best2.T, sizes, out=np.zeros(sizes.shape), where=sizes > 0)
+
+    def _terms_of(self, genes):
+        """ Return a sparse (genes x terms) matrix of directly annotated terms and a list of term indices of its
+        columns.
+        """
+        table = self.annotations._table
+        codes = [table.code('gene_id', gene) for gene in genes]
+        known = [i for i, code in enumerate(codes) if code is not None]
+        selected = self._gene_terms[[codes[i] for i in known]].tocsc()
+        terms = np.flatnonzero(np.diff(selected.indptr))
+        selected = selected[:, terms].tocoo()
+        gene_terms = sp.csr_matrix((selected.data.astype(float), (np.array(known, dtype=int)[selected.row],
+                                                                  selected.col)),
+                                   shape=(len(genes), len(terms)))
+        return gene_terms, terms
+
+    def _term_similarity(self, indices1, indices2, method):
+        if method == WANG:
+            values1 = self._semantic_values(indices1)
+            values2 = self._semantic_values(indices2)
+            common = (values1 @ _pattern(values2).T + _pattern(values1) @ values2.T).toarray()
+            totals = np.add.outer(values1.sum(axis=1).A1, values2.sum(axis=1).A1)
+            return common / totals
+
+        resnik = self._resnik(indices1, indices2)
+        if method == RESNIK:
+            return resnik
+        ic = self.information_content
+        totals = np.add.outer(ic[indices1], ic[indices2])
+        same = np.equal.outer(indices1, indices2).astype(float)
+        return np.divide(2 * resnik, totals, out=same, where=totals > 0)
+
+    def _resnik(self, indices1, indices2):
+        """ Return a matrix with the information content of the most informative common ancestor of terms. """
+        if self._ancestors is None:
+            n = len(self.ontology.compiled)
+            self._ancestors = (self.ontology.compiled.closure.ancestors +
+                               sp.identity(n, dtype=bool, format='csr')).astype(float).tocsr()
+        ancestors1 = self._ancestors[indices1].tocsc()
+        ancestors2 = self._ancestors[indices2].tocsc()
+
+        ic = self.information_content
+        common = np.flatnonzero((np.diff(ancestors1.indptr) > 0) & (np.diff(ancestors2.indptr) > 0) & (ic > 0))
+        common = common[np.argsort(ic[common], kind='stable')]
+
+        # Common ancestors are processed in blocks in the increasing order of their information content. In a
+        # block, the k-th ancestor is weighted by 2 ** k, so the highest bit of the sum of weights of the common
+        # ancestors in the product is the most informative one (and sums of up to 52 powers of 2 are exact).
+        similarity = np.zeros((len(indices1), len(indices2)))
+        for start in range(0, len(common), 52):
+            block = common[start:start + 52]
+            weights = sp.csc_matrix((2.0 ** np.arange(len(block)), (np.arange(len(block)), np.arange(len(block)))))
+            product = ((ancestors1[:, block] @ weights) @ ancestors2[:, block].T).tocoo()
+            _, exponents = np.frexp(product.data)
+            similarity[product.row, product.col] = ic[block[exponents - 1]]
+        return similarity
+
+    def _semantic_values(self, indices):
+        """ Return a sparse (terms x all terms) matrix of semantic values of the terms' ancestors (and the terms
+        themselves) for Wang similarity.
+
+        The value of a term is 1 and the value of its parent is the maximal value of its children multiplied by
+        the weight (:obj:`WANG_WEIGHTS`) of the link.
+        """
+        compiled = self.ontology.compiled
+        n = len(compiled)
+        if self._weighted_parents is None:
+            type_weights = np.array([self.WANG_WEIGHTS.get(type_id, 0) for type_id in compiled.relation_types] + [0])
+            weights = type_weights[compiled.parents.types]
+            sources = np.repeat(np.arange(n), np.diff(compiled.parents.indptr))
+            followed = weights > 0
+            self._weighted_parents = sp.csr_matrix(
+                (weights[followed], (sources[followed], compiled.parents.indices[followed])), shape=(n, n))
+        parents = self._weighted_parents
+
+        keys = np.arange(len(indices)) * n + np.asarray(indices)
+        values = np.ones(len(keys))
+        frontier_keys, frontier_values = keys, values
+        while len(frontier_keys):
+            links = parents[frontier_keys % n].tocoo()
+            candidate_keys = frontier_keys[links.row] // n * n + links.col
+            candidate_values = frontier_values[links.row] * links.data
+
+            # keep the largest value of each key; improved values are propagated further
+            all_keys = np.concatenate((keys, candidate_keys))
+            all_values = np.concatenate((values, candidate_values))
+            is_candidate = np.repeat([False, True], [len(keys), len(candidate_keys)])
+            order = np.lexsort((is_candidate, -all_values, all_keys))
+            first = order[np.r_[True, np.diff(all_keys[order]) != 0]]
+            keys, values = all_keys[first], all_values[first]
+            frontier_keys, frontier_values = keys[is_candidate[first]], values[is_candidate[first]]
+
+        return sp.csr_matrix((values, (keys // n, keys % n)), shape=(len(indices), n))
+
+
+def _check_method(method):
+    if method not in METHODS:
+        raise ValueError('Unknown similarity method {!r} (expected one of {})'.format(method, ', '.join(METHODS)))
+
+
+def _pattern(matrix):
+    """ Return a sparse matrix with ones at nonzero elements of `matrix`. """
+    pattern = matrix.copy()
+    pattern.data = np.ones_like(pattern.data)
+    return pattern
+
+
+def _best_matches(gene_terms, similarity):
+    """ Return a (genes x columns) matrix with the maximal similarity (a row of `similarity`) of each gene's
+    terms (nonzero columns of the csr matrix `gene_terms`); 0 for genes without terms.
+    """
+    gene_terms = gene_terms.tocsr()
+    best = np.zeros((gene_terms.shape[0], similarity.shape[1]))
+    genes = np.flatnonzero(np.diff(gene_terms.indptr))
+    step = max(1, _BLOCK_SIZE // max(1, similarity.shape[1] * max(1, gene_terms.nnz // max(1, len(genes)))))
+    for start in range(0, len(genes), step):
+        block = genes[start:start + step]
+        terms, lengths = gather_rows(gene_terms, block)
+        rows = similarity[terms]
+        best[block] = np.maximum.reduceat(rows, np.cumsum(lengths) - lengths, axis=0)
+    return best
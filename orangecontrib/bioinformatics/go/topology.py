@@ -0,0 +1,214 @@
+""" Topology-aware GO term enrichment
+
+The classic enrichment tests every term independently, so the ancestors of an enriched term are (mostly) enriched
+just because they inherit its genes. The algorithms here decorrelate the tests of related terms
+(see Alexa et al., 2006, and Grossmann et al., 2007):
+
+- `elim`: terms are tested bottom-up (the most specific first); genes of a significant term are removed from
+  the tests of its ancestors.
+- `weight`: terms are tested bottom-up with weighted genes; when a child is more significant than its parent,
+  genes of the child are down-weighted in the parent, otherwise genes of the children are down-weighted in the
+  children.
+- `parent-child`: a term is tested against the genes annotated to any of its parents instead of all genes.
+
+All algorithms work on the terms annotated by genes of a list (which include all ancestors of the terms) with
+annotations stored in a sparse (terms x genes) matrix; the genes of a term are a slice of the matrix' arrays and
+are masked or weighted with arrays aligned with them. Terms are processed by topological levels (all terms of a
+level at once), so the algorithms take about as long as the classic test.
+"""
+import numpy as np
+import scipy.sparse as sp
+
+from orangecontrib.bioinformatics.go.compiled import row_positions
+
+
+CLASSIC, ELIM, WEIGHT, PARENT_CHILD = 'classic', 'elim', 'weight', 'parent-child'
+ALGORITHMS = (CLASSIC, ELIM, WEIGHT, PARENT_CHILD)
+
+#: P-value threshold of significant terms whose genes are removed from their ancestors (`elim` algorithm)
+ELIM_CUTOFF = 0.01
+
+
+class TermGenes:
+    """ Annotations of terms with genes and the links between the terms.
+
+    :param incidence: A sparse boolean (terms x genes) matrix of (propagated) annotations.
+    :param parents: A sparse boolean (terms x terms) matrix of links to parents (all parents of a term must be
+        among the terms).
+    :param ancestors: A sparse boolean (terms x terms) matrix of ancestors.
+    :param levels: Topological levels of the terms; a term has a higher level than its ancestors.
+
+    """
+
+    def __init__(self, incidence, parents, ancestors, levels):
+        self.incidence = sp.csr_matrix(incidence, dtype=bool)
+        self.incidence.sort_indices()
+        self.parents = sp.csr_matrix(parents, dtype=bool)
+        self.ancestors = sp.csr_matrix(ancestors, dtype=bool)
+        self.levels = np.asarray(levels)
+
+        n_terms, n_genes = self.incidence.shape
+        #: The term of each annotation (element of `incidence.indices`).
+        self.rows = np.repeat(np.arange(n_terms), np.diff(self.incidence.indptr))
+        self._keys = self.rows.astype(np.int64) * n_genes + self.incidence.indices
+
+    def __len__(self):
+        return self.incidence.shape[0]
+
+    def positions(self, terms):
+        """ Return indices of annotations of `terms` (into `incidence.indices`) and the terms' numbers of genes. """
+        return row_positions(self.incidence.indptr, terms)
+
+    def find(self, terms, genes):
+        """ Return indices of annotations of `terms` with `genes` (which must be annotated to the terms). """
+        keys = np.asarray(terms, dtype=np.int64) * self.incidence.shape[1] + genes
+        # searching for sorted keys is much faster (the search is local)
+        order = np.argsort(keys, kind='stable')
+        positions = np.empty(len(keys), dtype=np.intp)
+        positions[order] = np.searchsorted(self._keys, keys[order])
+        return positions
+
+    def by_level(self):
+        """ Yield arrays of terms on the same topological level, from the most specific terms to the roots. """
+        order = np.argsort(-self.levels, kind='stable')
+        bounds = np.flatnonzero(np.diff(self.levels[order])) + 1
+        yield from np.split(order, bounds)
+
+    def counts(self, terms, query, weights):
+        """ Return sums of `weights` of annotations of `terms` with genes in `query` (a boolean mask of genes)
+        and with all genes.
+        """
+        positions, lengths = self.positions(terms)
+        segments = np.repeat(np.arange(len(terms)), lengths)
+        w = weights[positions]
+        return (np.bincount(segments, w * query[self.incidence.indices[positions]], minlength=len(terms)),
+                np.bincount(segments, w, minlength=len(terms)))
+
+
+def elim(graph, query, N, n, p_values, cutoff=ELIM_CUTOFF, progress_callback=None):
+    """ Return P-values of the `elim` algorithm and a boolean mask of annotations (of `graph.incidence`) that
+    were not removed.
+
+    :param TermGenes graph: Terms and their annotations.
+    :param query: A boolean mask of genes in the list.
+    :param N: The number of reference genes.
+    :param n: The number of genes in the list.
+    :param p_values: A function computing P-values from arrays `k`, `N`, `m` and `n` (see
+        :func:`~orangecontrib.bioinformatics.utils.statistics.Binomial.p_values`).
+    :param cutoff: P-value threshold for significant terms.
+    :param progress_callback: A function called with the fraction (0 to 1) of tested terms after each level.
+    """
+    incidence = graph.incidence
+    active = np.ones(incidence.nnz, dtype=bool)
+    p = np.ones(len(graph))
+    tested = 0
+    for terms in graph.by_level():
+        k, m = graph.counts(terms, query, active)
+        p[terms] = p_values(k.astype(int), N, m.astype(int), n)
+
+        significant = terms[p[terms] < cutoff]
+        if len(significant):
+            positions, lengths = graph.positions(significant)
+            kept = active[positions]
+            genes = sp.csr_matrix((kept, incidence.indices[positions],
+                                   np.concatenate(([0], np.cumsum(lengths)))), shape=(len(significant),
+                                                                                      incidence.shape[1]))
+            genes.eliminate_zeros()
+            removed = (graph.ancestors[significant].T @ genes).tocoo()
+            active[graph.find(removed.row, removed.col)] = False
+        if progress_callback:
+            tested += len(terms)
+            progress_callback(tested / len(graph))
+    return p, active
+
+
+def weight(graph, query, N, n, p_values, progress_callback=None):
+    """ Return P-values of the `weight` algorithm.
+
+    The weight of a gene in a term is initially the minimal weight of the gene in the term's children. If some
+    children are more significant than the term, genes of each such child are down-weighted in the term by the
+    ratio of their P-values; otherwise genes of each child are down-weighted in the child by the ratio of the
+    P-values (and the child is tested again).
+
+    :param TermGenes graph: Terms and their annotations.
+    :param query: A boolean mask of genes in the list.
+    :param N: The number of reference genes.
+    :param n: The number of genes in the list.
+    :param p_values: A function computing P-values from arrays `k`, `N`, `m` and `n`.
+    :param progress_callback: A function called with the fraction (0 to 1) of tested terms after each level.
+    """
+    incidence = graph.incidence
+    links = graph.parents.tocoo()
+    children, parents = links.row, links.col
+    weights = np.ones(incidence.nnz)
+    p = np.ones(len(graph))
+
+    def test(terms):
+        k, m = graph.counts(terms, query, weights)
+        p[terms] = p_values(np.rint(k).astype(int), N, np.rint(m).astype(int), n)
+
+    is_level = np.zeros(len(graph), dtype=bool)
+    tested = 0
+    for terms in graph.by_level():
+        is_level[:] = False
+        is_level[terms] = True
+        level_links = is_level[parents]
+        level_children, level_parents = children[level_links], parents[level_links]
+
+        # inherit the (minimal) weights of genes from the children
+        child_positions, lengths = graph.positions(level_children)
+        parent_positions = graph.find(np.repeat(level_parents, lengths), incidence.indices[child_positions])
+        np.minimum.at(weights, parent_positions, weights[child_positions])
+        test(terms)
+
+        ratios = p[level_children] / np.maximum(p[level_parents], np.finfo(float).tiny)
+        more_significant = ratios < 1
+        has_significant_child = np.zeros(len(graph), dtype=bool)
+        has_significant_child[level_parents[more_significant]] = True
+
+        # down-weight genes of more significant children in the parents
+        link_positions = np.repeat(more_significant, lengths)
+        factors = np.ones(incidence.nnz)
+        np.minimum.at(factors, parent_positions[link_positions], np.repeat(ratios, lengths)[link_positions])
+        weights *= factors
+
+        # down-weight genes of the children of parents that are more significant than all their children
+        down = ~has_significant_child[level_parents] & (ratios > 1)
+        link_positions = np.repeat(down, lengths)
+        factors = np.ones(incidence.nnz)
+        np.multiply.at(factors, child_positions[link_positions], np.repeat(1 / ratios[down], lengths[down]))
+        weights *= factors
+
+        retest = np.unique(np.concatenate((level_parents[more_significant], level_children[down])))
+        if len(retest):
+            test(retest)
+        if progress_callback:
+            tested += len(terms)
+            progress_callback(tested / len(graph))
+    return p
+
+
+def parent_child(graph, query, N, n, p_values):
+    """ Return P-values of the `parent-child` (union) algorithm.
+
+    A term is tested against the genes annotated to any of its parents: `N` is the number of these genes and
+    `n` the number of them in the list. Terms without parents are tested against all genes.
+
+    :param TermGenes graph: Terms and their annotations.
+    :param query: A boolean mask of genes in the list.
+    :param N: The number of reference genes.
+    :param n: The number of genes in the list.
+    :param p_values: A function computing P-values from arrays `k`, `N`, `m` and `n`.
+    """
+    incidence = graph.incidence
+    terms = np.arange(len(graph))
+    k, m = graph.counts(terms, query, np.ones(incidence.nnz))
+
+    union = (graph.parents.astype(np.int32) @ incidence.astype(np.int32)).tocsr()
+    union.data = np.ones_like(union.data)
+    parent_m = np.diff(union.indptr)
+    parent_k = union @ query.astype(np.int32)
+
+    is_root = parent_m == 0
+    return p_values(k.astype(int), np.where(is_root, N, parent_m), m.astype(int), np.where(is_root, n, parent_k))
+
@@ -0,0 +1,186 @@
+import os
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import scipy.stats
+
+from orangecontrib.bioinformatics import cluster_analysis
+from orangecontrib.bioinformatics.cluster_analysis import Cluster, ClusterModel, aggregate_scores, filter_results
+from orangecontrib.bioinformatics.utils import SharedArrays
+from orangecontrib.bioinformatics.utils.statistics import score_mann_whitney, score_t_test
+from orangecontrib.bioinformatics.widgets.utils.gui import gene_scoring_method
+
+
+MANN_WHITNEY = gene_scoring_method('Mann-Whitney', score_mann_whitney, None, None)
+T_TEST = gene_scoring_method('T-test', score_t_test, None, None)
+
+
+class TestAggregateScores(unittest.TestCase):
+    def setUp(self):
+        # genes x (other clusters, batches), NaN marks comparisons that were not tested
+        self.p_values = np.array([[0.01, 0.2, 0.5, 0.03],
+                                  [0.4, np.nan, 0.02, np.nan],
+                                  [np.nan, 0.3, np.nan, np.nan],
+                                  [np.nan, np.nan, np.nan, np.nan]]).reshape((4, 2, 2))
+        self.scores = np.array([[5., 2., 1., 4.],
+                                [1., np.nan, 3., np.nan],
+                                [np.nan, 2., np.nan, np.nan],
+                                [np.nan, np.nan, np.nan, np.nan]]).reshape((4, 2, 2))
+
+    def test_combine_p_values(self):
+        for method in ('fisher', 'stouffer'):
+            scores, p_values, fdr = aggregate_scores(self.scores, self.p_values, method)
+            for gene in range(3):
+                tested = self.p_values[gene][~np.isnan(self.p_values[gene])]
+                statistic, p_value = scipy.stats.combine_pvalues(tested, method=method)
+                self.assertAlmostEqual(scores[gene], statistic, msg=method)
+                self.assertAlmostEqual(p_values[gene], p_value, msg=method)
+            self.assertEqual((scores[3], p_values[3]), (0, 1))
+            self.assertFalse(np.isnan(fdr).any())
+
+    def test_mean(self):
+        scores, p_values, _ = aggregate_scores(self.scores, self.p_values, 'mean')
+        np.testing.assert_almost_equal(scores, [3, 2, 2, 0])
+        np.testing.assert_almost_equal(p_values, [0.185, 0.21, 0.3, 1])
+
+    def test_select(self):
+        expected = {'max': ([1, 1, 2, 0], [0.5, 0.4, 0.3, 1]),
+                    'min': ([5, 3, 2, 0], [0.01, 0.02, 0.3, 1]),
+                    'median': ([4, 3, 2, 0], [0.03, 0.02, 0.3, 1])}
+        for aggregation, (expected_scores, expected_p_values) in expected.items():
+            scores, p_values, _ = aggregate_scores(self.scores, self.p_values, aggregation)
+            np.testing.assert_equal(scores, expected_scores, err_msg=aggregation)
+            np.testing.assert_equal(p_values, expected_p_values, err_msg=aggregation)
+
+    def test_ties(self):
+        # the first of tied comparisons is selected
+        p_values = np.array([[0.5, 0.1, 0.5, 0.1]]).reshape((1, 2, 2))
+        scores = np.array([[1., 2., 3., 4.]]).reshape((1, 2, 2))
+        self.assertEqual(aggregate_scores(scores, p_values, 'max')[0][0], 1)
+        self.assertEqual(aggregate_scores(scores, p_values, 'min')[0][0], 2)
+
+        p_values[0, 0, 1] = np.nan
+        self.assertEqual(aggregate_scores(scores, p_values, 'min')[0][0], 4)
+
+    def test_no_comparisons(self):
+        scores, p_values, fdr = aggregate_scores(np.zeros((3, 0, 2)), np.zeros((3, 0, 2)), 'fisher')
+        np.testing.assert_equal(scores, 0)
+        np.testing.assert_equal(p_values, 1)
+        np.testing.assert_equal(fdr, 1)
+
+    def test_untested_pairs(self):
+        # the cluster (rows 0-3) has no non-zero values in the second batch
+        table_x = np.array([[1, 2], [3, 1], [0, 0], [0, 0], [2, 2], [1, 3], [4, 1], [2, 2]], dtype=float)
+        rows_by_cluster = np.array([0, 0, 0, 0, 1, 1, 1, 1])
+        rows_by_batch = np.array([0, 0, 1, 1, 0, 0, 1, 1])
+        for method in (MANN_WHITNEY, T_TEST):
+            p_values = Cluster('C0', 0).compute_scores(table_x, rows_by_cluster, method, Cluster.CLUSTER_VS_CLUSTER,
+                                                       rows_by_batch=rows_by_batch)[1]
+            self.assertEqual(p_values.shape, (2, 1, 2))
+            self.assertFalse(np.isnan(p_values[:, :, 0]).any(), msg=method.name)
+            self.assertTrue(np.isnan(p_values[:, :, 1]).all(), msg=method.name)
+
+
+class TestFilterResults(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        # rounded to get many ties
+        self.p_values = np.round(random.uniform(size=200), 2)
+        self.fdr_values = np.round(np.minimum(1, self.p_values * 2), 1)
+
+    def full_sort(self, p_val=None, fdr=None, max_count=None):
+        """ Reference implementation: a stable sort of all results """
+        keys = self.p_values if p_val is None and fdr is None else self.fdr_values
+        selected = [index for index in np.argsort(keys, kind='stable')
+                    if (p_val is None or self.p_values[index] < p_val)
+                    and (fdr is None or self.fdr_values[index] < fdr)]
+        return selected[:max_count]
+
+    def test_top(self):
+        for max_count in (None, 0, 1, 7, 50, 199, 200, 1000):
+            np.testing.assert_array_equal(
+                filter_results(self.p_values, self.fdr_values, max_count=max_count),
+                self.full_sort(max_count=max_count),
+                err_msg='max_count={}'.format(max_count))
+
+    def test_thresholds(self):
+        for p_val, fdr, max_count in ((0.3, None, None), (None, 0.5, None), (0.3, 0.5, None), (0.3, None, 10),
+                                      (None, 0.5, 25), (0.3, 0.5, 1000), (0, None, 5)):
+            np.testing.assert_array_equal(
+                filter_results(self.p_values, self.fdr_values, p_val, fdr, max_count),
+                self.full_sort(p_val, fdr, max_count),
+                err_msg='p_val={}, fdr={}, max_count={}'.format(p_val, fdr, max_count))
+
+    def test_empty(self):
+        self.assertEqual(len(filter_results(np.array([]), np.array([]), max_count=5)), 0)
+        self.assertEqual(len(filter_results(np.array([]), np.array([]), 0.1, 0.1)), 0)
+
+
+class TestClusterModelProcesses(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.table_x = random.poisson(2, size=(60, 8)).astype(float)
+        self.rows_by_cluster = np.repeat([0, 1, 2], 20)
+        self.rows_by_batch = np.tile([0, 1], 30)
+
+    def model(self):
+        model = ClusterModel()
+        clusters = [Cluster('C{}'.format(index), index) for index in range(3)]
+        for cluster in clusters:
+            cluster.set_genes(['gene{}'.format(i) for i in range(8)], list(range(8)))
+        model.add_rows(clusters)
+        return model
+
+    def kwargs(self, design):
+        return dict(table_x=self.table_x, rows_by_cluster=self.rows_by_cluster, rows_by_batch=self.rows_by_batch,
+                    method=MANN_WHITNEY, design=design, aggregation='max')
+
+    def test_processes_equal_serial(self):
+        for design in (Cluster.CLUSTER_VS_REST, Cluster.CLUSTER_VS_CLUSTER):
+            serial, parallel = self.model(), self.model()
+            calls = []
+            serial._score_genes(lambda: None, **self.kwargs(design))
+            parallel._score_genes_processes(lambda: calls.append(1), 2, **self.kwargs(design))
+
+            self.assertEqual(len(calls), 3)
+            for expected, cluster in zip(serial.get_rows(), parallel.get_rows()):
+                self.assertEqual(cluster.method_used, 'Mann-Whitney')
+                np.testing.assert_array_equal(cluster.calculated_scores, expected.calculated_scores)
+                np.testing.assert_array_equal(cluster.calculated_p_values, expected.calculated_p_values)
+                np.testing.assert_array_equal(cluster.p_values, expected.p_values)
+                np.testing.assert_array_equal(cluster.fdr_values, expected.fdr_values)
+
+    def _shared_directories(self, run):
+        directories = []
+
+        def shared_arrays(**arrays):
+            shared = SharedArrays(**arrays)
+            directories.append(shared.directory)
+            return shared
+
+        with patch.object(cluster_analysis, 'SharedArrays', shared_arrays):
+            run()
+        self.assertEqual(len(directories), 1)
+        return directories
+
+    def test_temporary_files_removed(self):
+        model = self.model()
+        directories = self._shared_directories(
+            lambda: model._score_genes_processes(lambda: None, 2, **self.kwargs(Cluster.CLUSTER_VS_REST)))
+        self.assertFalse(os.path.exists(directories[0]))
+
+    def test_temporary_files_removed_on_cancel(self):
+        def cancel():
+            raise KeyboardInterrupt()
+
+        def run():
+            with self.assertRaises(KeyboardInterrupt):
+                self.model()._score_genes_processes(cancel, 2, **self.kwargs(Cluster.CLUSTER_VS_REST))
+
+        directories = self._shared_directories(run)
+        self.assertFalse(os.path.exists(directories[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,528 @@
+import concurrent.futures
+import gc
+import io
+import os
+import tempfile
+import threading
+import unittest
+import weakref
+from unittest import mock
+
+import numpy as np
+import scipy.sparse as sp
+
+from orangecontrib.bioinformatics import go
+from orangecontrib.bioinformatics.utils import statistics
+from orangecontrib.bioinformatics.go.compiled import compiled_path
+from orangecontrib.bioinformatics.go.similarity import SemanticSimilarity
+from orangecontrib.bioinformatics.go.registry import Registry
+from orangecontrib.bioinformatics.go import topology
+
+
+OBO = """format-version: 1.2
+subsetdef: goslim_generic "Generic GO slim"
+! comment line
+
+[Term]
+id: GO:0000001
+name: root
+namespace: biological_process
+subset: goslim_generic
+
+[Term]
+id: GO:0000002
+name: child
+namespace: biological_process
+alt_id: GO:0000020
+is_a: GO:0000001 ! root
+synonym: "a child" EXACT []
+
+[Term]
+id: GO:0000003
+name: grandchild
+namespace: biological_process
+def: "Definition." [GOC:xx]
+is_a: GO:0000002 ! child
+relationship: part_of GO:0000001 ! root
+xref: Reactome:R-HSA-1 {source="x"}
+
+[Typedef]
+id: part_of
+name: part of
+"""
+
+GENE2GO = """#tax_id\tGeneID\tGO_ID\tEvidence\tQualifier\tGO_term\tPubMed\tCategory
+9606\t1\tGO:0000003\tIDA\t\tgrandchild\t123\tProcess
+9606\t1\tGO:0000002\tIEA\t\tchild\t-\tProcess
+9606\t2\tGO:0000020\tIEA\t\tchild\t-\tProcess
+9606\t3\tGO:0000003\tIDA\tNOT\tgrandchild\t-\tProcess
+9606\t\tGO:0000001\tIEA\t\troot\t-\tProcess
+"""
+
+
+class TestOntology(unittest.TestCase):
+    def setUp(self):
+        self.progress = []
+        self.ontology = go.Ontology(io.StringIO(OBO), progress_callback=self.progress.append)
+
+    def test_parse(self):
+        ontology = self.ontology
+        self.assertEqual(len(ontology), 3)
+        self.assertIn('part_of', ontology.typedefs)
+        self.assertEqual(ontology.defined_slims_subsets(), ['goslim_generic'])
+        self.assertNotIn('comment', ontology.header)
+
+        term = ontology['GO:0000003']
+        self.assertEqual(term.name, 'grandchild')
+        self.assertEqual(set(term.related), {('is_a', 'GO:0000002'), ('part_of', 'GO:0000001')})
+        self.assertEqual(set(ontology['GO:0000001'].related_to), {('is_a', 'GO:0000002'), ('part_of', 'GO:0000003')})
+        self.assertIn('xref: Reactome:R-HSA-1{ source="x" }', repr(term))
+
+        self.assertEqual(term.def_, '"Definition." [GOC:xx]')
+        self.assertEqual(ontology['GO:0000002'].alt_id, ['GO:0000020'])
+        self.assertFalse(hasattr(term, 'is_obsolete'))
+        with self.assertRaises(AttributeError):
+            term.attribute = None
+
+        # values are parsed once and can be changed
+        self.assertIs(term.values, term.values)
+        term.values['is_obsolete'] = 'true'
+        self.assertEqual(term.is_obsolete, 'true')
+
+        self.assertIs(ontology['GO:0000020'], ontology['GO:0000002'])
+        self.assertIn('GO:0000020', ontology)
+        self.assertEqual(ontology.named_slims_subset('goslim_generic'), ['GO:0000001'])
+
+    def test_progress(self):
+        self.assertTrue(self.progress)
+        self.assertEqual(self.progress, sorted(self.progress))
+        self.assertLessEqual(self.progress[-1], 100)
+
+    def test_graph(self):
+        ontology = self.ontology
+        self.assertEqual(ontology.extract_super_graph(['GO:0000003']), {'GO:0000001', 'GO:0000002', 'GO:0000003'})
+        self.assertEqual(ontology.extract_sub_graph(['GO:0000002']), {'GO:0000002', 'GO:0000003'})
+        self.assertEqual(ontology.extract_super_graph(['GO:0000020']), {'GO:0000001', 'GO:0000020'})
+        self.assertEqual([ontology.term_depth(term) for term in ['GO:0000001', 'GO:0000002', 'GO:0000003']], [1, 2, 2])
+
+    def test_slims(self):
+        ontology = self.ontology
+        ontology.set_slims_subset('goslim_generic')
+        self.assertEqual(ontology.slims_for_term('GO:0000003'), {'GO:0000001'})
+        self.assertEqual(ontology.slims_for_term('GO:0000001'), {'GO:0000001'})
+        self.assertEqual(ontology.slims_for_terms(['GO:0000002', 'GO:0000003']),
+                         {'GO:0000002': {'GO:0000001'}, 'GO:0000003': {'GO:0000001'}})
+
+
+class TestCompiledOntology(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'go.obo')
+        with open(self.filename, 'w') as f:
+            f.write(OBO + '\n')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_load_compiled(self):
+        parsed = go.Ontology(self.filename)
+        self.assertTrue(os.path.exists(compiled_path(self.filename)))
+
+        loaded = go.Ontology(self.filename)
+        self.assertIsInstance(loaded.terms, go.CompiledTerms)
+        self.assertEqual(loaded.header, parsed.header)
+        self.assertEqual(list(loaded), list(parsed))
+        self.assertEqual(set(loaded.typedefs), set(parsed.typedefs))
+        self.assertEqual(loaded.alias_mapper, parsed.alias_mapper)
+        self.assertEqual(loaded.reverse_alias_mapper, parsed.reverse_alias_mapper)
+        for term_id in parsed:
+            self.assertEqual(repr(loaded[term_id]), repr(parsed[term_id]))
+            self.assertEqual(set(loaded[term_id].related), set(parsed[term_id].related))
+            self.assertEqual(set(loaded[term_id].related_to), set(parsed[term_id].related_to))
+        self.assertEqual(loaded['GO:0000020'].name, 'child')
+        self.assertNotIn('GO:0000004', loaded)
+
+        compiled = loaded.compiled
+        child = compiled.index('GO:0000002')
+        self.assertEqual(compiled.names[child], 'child')
+        _, parents = compiled.parents.links(child)
+        self.assertEqual([compiled.term_id(i) for i in parents], ['GO:0000001'])
+
+    def test_term_order(self):
+        with open(self.filename, 'a') as f:
+            f.write('[Term]\nid: GO:0000000\nname: last\nsubset: goslim_generic\n\n')
+
+        parsed = go.Ontology(self.filename)
+        loaded = go.Ontology(self.filename)
+        self.assertIsInstance(loaded.terms, go.CompiledTerms)
+        self.assertEqual(list(parsed), ['GO:0000001', 'GO:0000002', 'GO:0000003', 'GO:0000000'])
+        self.assertEqual(list(loaded), list(parsed))
+        self.assertEqual([(term_id, term.name) for term_id, term in loaded.terms.items()],
+                         [(term_id, term.name) for term_id, term in parsed.terms.items()])
+        self.assertEqual(loaded.named_slims_subset('goslim_generic'), ['GO:0000001', 'GO:0000000'])
+
+    def test_invalidate(self):
+        go.Ontology(self.filename)
+        with open(self.filename, 'a') as f:
+            f.write('[Term]\nid: GO:0000004\nname: new\n\n')
+
+        ontology = go.Ontology(self.filename)
+        self.assertNotIsInstance(ontology.terms, go.CompiledTerms)
+        self.assertIn('GO:0000004', ontology)
+        self.assertIn('GO:0000004', go.Ontology(self.filename))
+
+
+class TestAnnotations(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(self.dir.name, 'gene2go_9606.tab')
+        with open(filename, 'w') as f:
+            f.write(GENE2GO)
+        with mock.patch.object(go.serverfiles, 'localpath_download', return_value=filename):
+            self.annotations = go.Annotations('9606', ontology=go.Ontology(io.StringIO(OBO)))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_load(self):
+        annotations = self.annotations
+        self.assertTrue(annotations.header.startswith('#tax_id'))
+        self.assertEqual(len(annotations), 3)
+        self.assertEqual(annotations[0], go.AnnotationRecord(
+            '9606', '1', 'GO:0000003', 'IDA', '', 'grandchild', '123', 'Process'))
+        self.assertEqual([a.go_id for a in annotations], ['GO:0000003', 'GO:0000002', 'GO:0000020'])
+        self.assertEqual([a.go_id for a in annotations[1:]], ['GO:0000002', 'GO:0000020'])
+        self.assertIn(annotations[2], annotations)
+
+        self.assertEqual(list(annotations.gene_annotations), ['1', '2'])
+        self.assertEqual([a.go_id for a in annotations.gene_annotations['1']], ['GO:0000003', 'GO:0000002'])
+        self.assertEqual(annotations.gene_annotations['3'], [])
+        self.assertNotIn('3', annotations.gene_annotations)
+        self.assertIsNone(annotations.term_anotations.get('GO:0000001'))
+        self.assertEqual(annotations.genes(), {'1', '2'})
+        self.assertEqual(annotations.get_genes_with_known_annotation(['1', '3']), {'1'})
+        self.assertEqual(annotations.evidence_counts(), {'IDA': (1, 1), 'IEA': (2, 2)})
+
+    def test_add_annotation(self):
+        annotations = self.annotations
+        self.assertEqual(sorted(annotations.get_genes_by_go_term('GO:0000002')), [1, 2])
+
+        annotations.add_annotation(go.AnnotationRecord(
+            '9606', '4', 'GO:0000003', 'TAS', '', 'grandchild', '-', 'Process'))
+        annotations.add_annotation(go.AnnotationRecord(
+            '9606', '5', 'GO:0000003', 'TAS', 'NOT', 'grandchild', '-', 'Process'))
+        self.assertEqual(len(annotations), 4)
+        self.assertEqual(annotations.gene_annotations['4'][0].evidence, 'TAS')
+        self.assertEqual(sorted(annotations.get_genes_by_go_term('GO:0000002')), [1, 2, 4])
+        self.assertEqual(annotations.get_genes_by_go_term('GO:0000002', ['TAS']), [4])
+
+
+    def test_enriched_terms(self):
+        annotations = self.annotations
+        binomial = statistics.Binomial()
+        enriched = annotations.get_enriched_terms(['1'], use_fdr=False)
+        self.assertEqual(enriched, {
+            'GO:0000001': (['1'], binomial.p_value(1, 2, 2, 1), 2),
+            'GO:0000002': (['1'], binomial.p_value(1, 2, 2, 1), 2),
+            'GO:0000003': (['1'], binomial.p_value(1, 2, 1, 1), 1),
+        })
+
+        enriched = annotations.get_enriched_terms(['1', '2'], reference={'2', '3'}, evidence_codes=['IEA'])
+        self.assertEqual(set(enriched), {'GO:0000001', 'GO:0000002'})
+        self.assertEqual(enriched['GO:0000002'][0], ['2'])
+        self.assertEqual(enriched['GO:0000002'][2], 1)
+
+        self.assertEqual(annotations.get_enriched_terms(['1'], aspect='Function'), {})
+
+        # the default slims subset is not stored in the (possibly shared) ontology
+        with self.assertWarns(UserWarning):
+            self.assertEqual(set(annotations.get_enriched_terms(['1'], slims_only=True)), {'GO:0000001'})
+        self.assertEqual(annotations.ontology.slims_subset, set())
+
+        annotations.ontology.set_slims_subset('goslim_generic')
+        self.assertEqual(set(annotations.get_enriched_terms(['1'], slims_only=True)), {'GO:0000001'})
+
+
+    def test_enriched_terms_batch(self):
+        annotations = self.annotations
+        gene_lists = [['1'], ['2', '3'], [], ['1', '2']]
+        for prob in (statistics.Binomial(), statistics.Hypergeometric()):
+            batch = annotations.get_enriched_terms_batch(gene_lists, reference={'1', '2', '3'}, prob=prob, n_jobs=2)
+            self.assertEqual(batch, [annotations.get_enriched_terms(genes, reference={'1', '2', '3'}, prob=prob)
+                                     for genes in gene_lists])
+        self.assertEqual(batch[2], {})
+
+    def test_enrichment_progress(self):
+        annotations = self.annotations
+        for algorithm in topology.ALGORITHMS:
+            progress = []
+            annotations.get_enriched_terms(['1'], progress_callback=progress.append, algorithm=algorithm)
+            self.assertEqual(progress, sorted(progress))
+            self.assertEqual(progress[-1], 100)
+
+            def cancel(_):
+                raise concurrent.futures.CancelledError
+            with self.assertRaises(concurrent.futures.CancelledError):
+                annotations.get_enriched_terms(['1'], progress_callback=cancel, algorithm=algorithm)
+
+        # P-values are computed in chunks when the progress is reported
+        k, N, m, n = np.arange(10), 50, np.arange(10, 20), 15
+        expected = statistics.Binomial().p_values(k, N, m, n)
+        with mock.patch.object(go.Annotations, 'P_VALUES_CHUNK', 3):
+            progress = []
+            p_values = go.Annotations._p_values(statistics.Binomial(), k, N, m, n, n_jobs=2,
+                                                progress_callback=progress.append)
+        np.testing.assert_almost_equal(p_values, expected)
+        self.assertEqual(len(progress), 4)
+        self.assertEqual(progress[-1], 1)
+
+    def test_annotated_terms(self):
+        annotations = self.annotations
+        self.assertEqual(annotations.get_annotated_terms(['1'], direct_annotation_only=True),
+                         {'GO:0000003': {'1'}, 'GO:0000002': {'1'}})
+        self.assertEqual(annotations.get_annotated_terms(['1', '2'], evidence_codes=['IEA']),
+                         {'GO:0000002': {'1', '2'}, 'GO:0000020': {'2'}, 'GO:0000001': {'1', '2'}})
+
+    def test_filtered_index(self):
+        annotations = self.annotations
+        index = annotations._index(['IEA', 'IDA'], {'Process'})
+        self.assertIs(annotations._index(['IDA', 'IEA'], ['Process']), index)
+        self.assertIsNot(annotations._index(['IEA'], {'Process'}), index)
+        self.assertEqual(index.rows.tolist(), [True, True, True])
+
+        enriched = annotations.get_enriched_terms(['1', '4'], evidence_codes=['IDA', 'TAS'])
+        self.assertEqual(enriched['GO:0000003'][0], ['1'])
+
+        # adding annotations invalidates the indices
+        annotations.add_annotation(go.AnnotationRecord(
+            '9606', '4', 'GO:0000003', 'TAS', '', 'grandchild', '-', 'Process'))
+        enriched = annotations.get_enriched_terms(['1', '4'], evidence_codes=['IDA', 'TAS'])
+        self.assertEqual(sorted(enriched['GO:0000003'][0]), ['1', '4'])
+
+    def test_propagated_cache(self):
+        obo = os.path.join(self.dir.name, 'go.obo')
+        with open(obo, 'w') as f:
+            f.write(OBO + '\n')
+        filename = os.path.join(self.dir.name, 'gene2go_9606.tab')
+
+        def load():
+            with mock.patch.object(go.serverfiles, 'localpath_download', return_value=filename):
+                return go.Annotations('9606', ontology=go.Ontology(obo))
+
+        enriched = load().get_enriched_terms(['1'])
+        self.assertEqual(len(os.listdir(filename + '.propagated')), 1)
+
+        # a new ontology and annotations use the stored propagated annotations
+        annotations = load()
+        self.assertEqual(annotations.get_enriched_terms(['1']), enriched)
+        self.assertIsNone(annotations.ontology.compiled._closure)
+
+        # which are invalidated by a change of the annotation file
+        with open(filename, 'a') as f:
+            f.write('9606\t3\tGO:0000003\tIEA\t-\tgrandchild\t-\tProcess\n')
+        annotations = load()
+        self.assertEqual(sorted(annotations.get_enriched_terms(['1', '3'])['GO:0000003'][0]), ['1', '3'])
+        self.assertIsNotNone(annotations.ontology.compiled._closure)
+
+    def test_shared(self):
+        obo = os.path.join(self.dir.name, 'go.obo')
+        with open(obo, 'w') as f:
+            f.write(OBO + '\n')
+        filename = os.path.join(self.dir.name, 'gene2go_9606.tab')
+        paths = {go.FILENAME_ONTOLOGY: obo, go.FILENAME_ANNOTATION.format('9606'): filename}
+
+        def shared():
+            with mock.patch.object(go.serverfiles, 'localpath_download',
+                                   side_effect=lambda domain, name, **kwargs: paths[name]):
+                return go.Annotations.shared('9606')
+
+        annotations = shared()
+        self.assertIs(shared(), annotations)
+        with mock.patch.object(go.serverfiles, 'localpath_download', return_value=obo):
+            self.assertIs(go.Ontology.shared(), annotations.ontology)
+        self.assertEqual(set(annotations.get_enriched_terms(['1'])), {'GO:0000001', 'GO:0000002', 'GO:0000003'})
+
+        with self.assertRaises(TypeError):
+            annotations.add_annotation(go.AnnotationRecord(
+                '9606', '4', 'GO:0000003', 'TAS', '', 'grandchild', '-', 'Process'))
+        with self.assertRaises(TypeError):
+            annotations.ontology = go.Ontology(io.StringIO(OBO))
+        with self.assertRaises(TypeError):
+            annotations.ontology.set_slims_subset('goslim_generic')
+
+        # annotations created without an ontology do not use the shared one
+        with mock.patch.object(go.serverfiles, 'localpath_download',
+                               side_effect=lambda domain, name, **kwargs: paths[name]):
+            private = go.Annotations('9606')
+            private.get_enriched_terms(['1'])
+        self.assertIsNot(private.ontology, annotations.ontology)
+        private.ontology.set_slims_subset({'GO:0000001'})
+        self.assertEqual(annotations.ontology.slims_subset, set())
+        del private
+
+        # a changed file is loaded again
+        with open(filename, 'a') as f:
+            f.write('9606\t3\tGO:0000003\tIEA\t-\tgrandchild\t-\tProcess\n')
+        self.assertEqual(len(shared()), 4)
+
+        # unused instances are freed
+        ref = weakref.ref(annotations)
+        del annotations
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class TestRegistry(unittest.TestCase):
+    class Instance:
+        pass
+
+    def test_load_once(self):
+        registry = Registry()
+        loads, started, release = [], threading.Event(), threading.Event()
+
+        def load():
+            loads.append(1)
+            started.set()
+            release.wait()
+            return self.Instance()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(registry.get, 'key', load) for _ in range(4)]
+            started.wait()
+            release.set()
+            instances = [future.result() for future in futures]
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(all(instance is instances[0] for instance in instances))
+        self.assertIn('key', registry)
+
+        del futures, instances
+        gc.collect()
+        self.assertNotIn('key', registry)
+
+    def test_error(self):
+        registry = Registry()
+
+        def fail():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            registry.get('key', fail)
+        instance = registry.get('key', self.Instance)
+        self.assertIs(registry.get('key', fail), instance)
+
+
+class TestTopology(unittest.TestCase):
+    def setUp(self):
+        # root (0) <- child (1) <- grandchild (2); the grandchild has genes 0-2, the child 0-5 and the root 0-9
+        incidence = np.zeros((3, 10), dtype=bool)
+        incidence[0], incidence[1, :6], incidence[2, :3] = True, True, True
+        parents = sp.csr_matrix(([True, True], ([1, 2], [0, 1])), shape=(3, 3))
+        ancestors = sp.csr_matrix(([True, True, True], ([1, 2, 2], [0, 0, 1])), shape=(3, 3))
+        self.graph = topology.TermGenes(sp.csr_matrix(incidence), parents, ancestors, [0, 1, 2])
+        self.query = np.arange(10) < 3
+        self.p_values = statistics.Hypergeometric().p_values
+        self.classic = self.p_values([3, 3, 3], 10, [10, 6, 3], 3)
+
+    def test_elim(self):
+        p, active = topology.elim(self.graph, self.query, 10, 3, self.p_values, cutoff=0.05)
+        np.testing.assert_almost_equal(p, [1, 1, self.classic[2]])
+        self.assertEqual(active.sum(), 3 + 3 + 7)
+        p, active = topology.elim(self.graph, self.query, 10, 3, self.p_values, cutoff=1e-3)
+        np.testing.assert_almost_equal(p, self.classic)
+        self.assertTrue(active.all())
+
+    def test_weight(self):
+        p = topology.weight(self.graph, self.query, 10, 3, self.p_values)
+        self.assertAlmostEqual(p[2], self.classic[2])
+        self.assertGreater(p[1], self.classic[1])
+
+    def test_parent_child(self):
+        p = topology.parent_child(self.graph, self.query, 10, 3, self.p_values)
+        np.testing.assert_almost_equal(p, self.p_values([3, 3, 3], [10, 10, 6], [10, 6, 3], [3, 3, 3]))
+
+    def test_annotations(self):
+        with tempfile.TemporaryDirectory() as dir:
+            filename = os.path.join(dir, 'gene2go_9606.tab')
+            with open(filename, 'w') as f:
+                f.write(GENE2GO)
+            with mock.patch.object(go.serverfiles, 'localpath_download', return_value=filename):
+                annotations = go.Annotations('9606', ontology=go.Ontology(io.StringIO(OBO)))
+
+        classic = annotations.get_enriched_terms(['1'])
+        for algorithm in topology.ALGORITHMS:
+            enriched = annotations.get_enriched_terms(['1'], algorithm=algorithm)
+            self.assertEqual(set(enriched), set(classic))
+            self.assertEqual(enriched['GO:0000003'][0], ['1'])
+        with self.assertRaises(ValueError):
+            annotations.get_enriched_terms(['1'], algorithm='elimination')
+
+
+class TestSemanticSimilarity(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(self.dir.name, 'gene2go_9606.tab')
+        with open(filename, 'w') as f:
+            f.write(GENE2GO)
+        with mock.patch.object(go.serverfiles, 'localpath_download', return_value=filename):
+            annotations = go.Annotations('9606', ontology=go.Ontology(io.StringIO(OBO)))
+        self.similarity = SemanticSimilarity(annotations)
+        self.terms = ['GO:0000001', 'GO:0000002', 'GO:0000003']
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_information_content(self):
+        # two genes are annotated to the root and the child, one to the grandchild
+        np.testing.assert_almost_equal(self.similarity.information_content, [0, 0, np.log(2)])
+
+    def test_term_similarity(self):
+        similarity = self.similarity
+        np.testing.assert_almost_equal(similarity.term_similarity(self.terms, ['GO:0000003'], method='resnik'),
+                                       [[0], [0], [np.log(2)]])
+        np.testing.assert_almost_equal(similarity.term_similarity(self.terms, method='lin'), np.identity(3))
+        # semantic values of ancestors of the grandchild are 0.8 (child) and max(0.8 * 0.8, 0.6) (root)
+        np.testing.assert_almost_equal(similarity.term_similarity(['GO:0000020'], ['GO:0000003'], method='wang'),
+                                       [[(1 + 0.8 + 0.8 + 0.64) / (1.8 + 2.44)]])
+        with self.assertRaises(ValueError):
+            similarity.term_similarity(self.terms, method='jaccard')
+
+    def test_gene_similarity(self):
+        similarity = self.similarity
+        np.testing.assert_almost_equal(similarity.gene_similarity(['1', '2', '3'], method='lin'),
+                                       [[1, 2 / 3, 0], [2 / 3, 1, 0], [0, 0, 0]])
+        np.testing.assert_almost_equal(similarity.gene_similarity(['1'], ['1', '2'], method='resnik'),
+                                       [[np.log(2) / 2, 0]])
+
+    def test_gene_similarity_cache(self):
+        obo = os.path.join(self.dir.name, 'go.obo')
+        with open(obo, 'w') as f:
+            f.write(OBO + '\n')
+        filename = os.path.join(self.dir.name, 'gene2go_9606.tab')
+        directory = filename + '.similarity'
+
+        def similarity():
+            with mock.patch.object(go.serverfiles, 'localpath_download', return_value=filename):
+                return SemanticSimilarity(go.Annotations('9606', ontology=go.Ontology(obo)))
+
+        # matrices are not stored by default
+        expected = similarity().gene_similarity(['1', '2', '3'], method='lin')
+        self.assertFalse(os.path.exists(directory))
+
+        np.testing.assert_almost_equal(similarity().gene_similarity(['1', '2', '3'], method='lin', cache=True),
+                                       expected)
+        names = os.listdir(directory)
+        self.assertEqual(len(names), 1)
+        with open(os.path.join(directory, names[0]), 'rb') as f:
+            self.assertNotIn(b'"3"', f.read())  # gene lists are stored as a hash
+
+        # a new instance loads the stored matrix
+        with mock.patch.object(SemanticSimilarity, '_gene_similarity', return_value=np.zeros((2, 2))) as compute:
+            np.testing.assert_almost_equal(
+                similarity().gene_similarity(['1', '2', '3'], method='lin', cache=True), expected)
+            compute.assert_not_called()
+            similarity().gene_similarity(['1', '2'], method='lin', cache=True)
+            compute.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
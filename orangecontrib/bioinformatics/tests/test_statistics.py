@@ -1,5 +1,7 @@
 import unittest
 import numpy as np
+import scipy.stats
+import scipy.sparse as sp
 from time import time
 
 from orangecontrib.bioinformatics.utils import statistics
@@ -31,6 +33,11 @@ class TestStatistics(unittest.TestCase):
                                                                threshold=threshold)
         self.assertIsNotNone(scores)
 
+        sparse_scores, sparse_pvalues = statistics.score_hypergeometric_test(
+            a=sp.csr_matrix(X[cluster]), b=sp.csc_matrix(X[np.logical_not(cluster)]), threshold=threshold)
+        np.testing.assert_almost_equal(sparse_scores, scores)
+        np.testing.assert_almost_equal(sparse_pvalues, pvalues)
+
 
     def test_alternatives(self):
         """ Test implemented alternative hypotheses. """
@@ -58,6 +65,113 @@ class TestStatistics(unittest.TestCase):
             assert np.linalg.norm(pval_less + pval_greater - np.array([1.0])) < 1e-8
 
 
+    def test_mann_whitney(self):
+        """ Compare vectorized Mann-Whitney U test with scipy (ties included). """
+        np.random.seed(42)
+        a = np.random.poisson(2, size=(30, 20)).astype(float)
+        b = np.random.poisson(3, size=(40, 20)).astype(float)
+
+        for alt in statistics.ALTERNATIVES:
+            scores, pvalues = statistics.score_mann_whitney(a, b, alternative=alt, chunk_size=6)
+            for i in range(a.shape[1]):
+                u, p = scipy.stats.mannwhitneyu(a[:, i], b[:, i], alternative=alt, method='asymptotic')
+                self.assertAlmostEqual(scores[i], u)
+                self.assertAlmostEqual(pvalues[i], p)
+
+        scores_t, pvalues_t = statistics.score_mann_whitney(a.T, b.T, axis=1)
+        np.testing.assert_almost_equal(scores_t, statistics.score_mann_whitney(a, b)[0])
+
+    def test_anova_kruskal_wallis(self):
+        """ Compare vectorized ANOVA and Kruskal-Wallis test with scipy (missing values omitted). """
+        np.random.seed(42)
+        groups = [np.random.poisson(lam, size=(n, 15)).astype(float) for lam, n in ((2, 10), (3, 12), (2, 8))]
+        groups[0][2, 3] = np.nan
+        groups[1][:4, 5] = np.nan
+
+        for score, scipy_score in ((statistics.score_anova, scipy.stats.f_oneway),
+                                   (statistics.score_kruskal_wallis, scipy.stats.kruskal)):
+            expected = np.array([scipy_score(*[g[:, i][np.isfinite(g[:, i])] for g in groups])
+                                 for i in range(15)]).T
+
+            np.testing.assert_almost_equal(score(*groups, chunk_size=4), expected)
+            np.testing.assert_almost_equal(score(*[g.T for g in groups], axis=1), expected)
+            np.testing.assert_almost_equal(score(*[sp.csr_matrix(g) for g in groups], chunk_size=4), expected)
+            np.testing.assert_almost_equal(score(*[g[:, 0] for g in groups]), expected[:, 0])
+
+    def test_welch_t_test(self):
+        np.random.seed(42)
+        a = np.random.normal(size=(5, 20))
+        b = np.random.normal(loc=0.5, scale=2, size=(8, 20))
+
+        for alt in statistics.ALTERNATIVES:
+            np.testing.assert_almost_equal(statistics.score_welch_t_test(a, b, alternative=alt),
+                                           scipy.stats.ttest_ind(a, b, equal_var=False, alternative=alt))
+        np.testing.assert_almost_equal(statistics.score_welch_t_test(sp.csr_matrix(a), sp.csr_matrix(b)),
+                                       statistics.score_welch_t_test(a, b))
+
+    def test_moderated_t_test(self):
+        np.random.seed(42)
+        prior_df, prior_var, df = 6, 0.5, 4
+        variances = prior_df * prior_var / np.random.chisquare(prior_df, 20000)
+        sample_variances = variances * np.random.chisquare(df, 20000) / df
+
+        # the prior is recovered from the distribution of sample variances
+        estimated_df, estimated_var = statistics._fit_prior_variance(sample_variances, df)
+        self.assertAlmostEqual(estimated_df[0], prior_df, delta=0.3)
+        self.assertAlmostEqual(estimated_var[0], prior_var, delta=0.02)
+
+        a = np.random.normal(size=(3, 200)) * np.sqrt(variances[:200])
+        b = np.random.normal(size=(3, 200)) * np.sqrt(variances[:200])
+        b[:, 0] = a[:, 0]
+        scores, p_values = statistics.score_moderated_t_test(a, b)
+        self.assertEqual(scores[0], 0)
+        self.assertTrue(np.all((p_values > 0) & (p_values <= 1)))
+
+        # moderation changes the variances, not the direction of differences
+        t_scores, _ = statistics.score_t_test(a, b)
+        np.testing.assert_array_equal(np.sign(scores), np.sign(t_scores))
+        np.testing.assert_almost_equal(statistics.score_moderated_t_test(sp.csr_matrix(a), sp.csr_matrix(b)),
+                                       (scores, p_values))
+
+    def test_sparse(self):
+        """ Sparse inputs give the same results as dense ones. """
+        np.random.seed(42)
+        X = np.random.poisson(0.5, size=(50, 20)).astype(float)
+        a, b = X[:20], X[20:]
+
+        for alt in statistics.ALTERNATIVES:
+            np.testing.assert_almost_equal(statistics.score_t_test(sp.csr_matrix(a), sp.csc_matrix(b), alternative=alt),
+                                           statistics.score_t_test(a, b, alternative=alt))
+        np.testing.assert_almost_equal(statistics.score_fold_change(sp.csr_matrix(a), sp.csr_matrix(b)),
+                                       statistics.score_fold_change(a, b))
+
+    def test_group_statistics(self):
+        np.random.seed(42)
+        X = np.random.poisson(0.5, size=(60, 20)).astype(float)
+        groups = np.random.randint(-1, 3, size=60)
+
+        for x in (X, sp.csr_matrix(X)):
+            stats = statistics.group_statistics(x, groups)
+            for i in range(3):
+                rows = X[groups == i]
+                self.assertEqual(stats.counts[i], len(rows))
+                np.testing.assert_almost_equal(stats.sums[i], rows.sum(axis=0))
+                np.testing.assert_almost_equal(stats.sums_sq[i], (rows ** 2).sum(axis=0))
+                np.testing.assert_almost_equal(stats.nonzero[i], (rows != 0).sum(axis=0))
+                np.testing.assert_almost_equal(stats.expressed[i], (rows >= 1).sum(axis=0))
+
+            a = statistics.GroupStatistics(*(field[0] for field in stats))
+            b = statistics.GroupStatistics(*(field[1] for field in stats))
+            for alt in statistics.ALTERNATIVES:
+                np.testing.assert_almost_equal(
+                    statistics.t_test_from_statistics(a, b, alternative=alt),
+                    statistics.score_t_test(X[groups == 0], X[groups == 1], alternative=alt))
+                np.testing.assert_almost_equal(
+                    statistics.hypergeometric_test_from_statistics(a, b, alternative=alt),
+                    statistics.score_hypergeometric_test(X[groups == 0], X[groups == 1], alternative=alt))
+            np.testing.assert_almost_equal(statistics.fold_change_from_statistics(a, b),
+                                           statistics.score_fold_change(X[groups == 0], X[groups == 1]))
+
     def test_alternatives_2D(self):
         """ Test implemented alternative hypotheses. """
         np.random.seed(42)
@@ -95,6 +209,66 @@ class TestStatistics(unittest.TestCase):
                 assert np.isnan(p).sum() == 0
                 assert np.isnan(r).sum() == 0
 
+    def test_enrichment_p_values(self):
+        """ Vectorized p-values of enrichment distributions. """
+        cases = np.array([(0, 10, 0, 5), (1, 10, 0, 5), (5, 10, 10, 5), (3, 100, 20, 10),
+                          (12, 20000, 150, 300), (1, 2, 1, 1)])
+        for prob in (statistics.Binomial(), statistics.Hypergeometric()):
+            expected = [prob.p_value(*map(int, case)) for case in cases]
+            np.testing.assert_allclose(prob.p_values(*cases.T), expected, rtol=1e-8)
+
+
+class TestMultipleTestingCorrection(unittest.TestCase):
+
+    def setUp(self):
+        self.p_values = np.array([0.01, 0.04, 0.03, 0.005, 0.2, 0.04])
+
+    def test_fdr(self):
+        fdr = statistics.false_discovery_rate(self.p_values)
+        np.testing.assert_almost_equal(fdr, [0.03, 0.048, 0.048, 0.03, 0.2, 0.048])
+
+        # legacy interface returns lists
+        self.assertIsInstance(statistics.FDR(self.p_values.tolist()), list)
+        np.testing.assert_almost_equal(statistics.FDR(self.p_values.tolist()), fdr)
+        np.testing.assert_almost_equal(statistics.FDR(sorted(self.p_values), ordered=True), np.sort(fdr))
+        self.assertEqual(statistics.FDR([]), [])
+
+    def test_fdr_dependent(self):
+        fdr = statistics.false_discovery_rate(self.p_values)
+        fdr_dependent = statistics.false_discovery_rate(self.p_values, dependent=True)
+        harmonic = sum(1 / i for i in range(1, len(self.p_values) + 1))
+        np.testing.assert_almost_equal(fdr_dependent, np.minimum(fdr * harmonic, 1))
+
+    def test_holm(self):
+        holm = statistics.holm_correction(self.p_values)
+        np.testing.assert_almost_equal(holm, [0.05, 0.12, 0.12, 0.03, 0.2, 0.12])
+
+    def test_bonferroni(self):
+        bonferroni = statistics.bonferroni_correction(self.p_values)
+        np.testing.assert_almost_equal(bonferroni, np.minimum(self.p_values * 6, 1))
+
+    def test_nan_and_axis(self):
+        p_values = np.vstack([self.p_values, self.p_values])
+        p_values[1, 2] = np.nan
+
+        for method in (statistics.false_discovery_rate,
+                       statistics.holm_correction,
+                       statistics.bonferroni_correction):
+            adjusted = method(p_values, axis=1)
+            np.testing.assert_almost_equal(adjusted[0], method(self.p_values))
+            self.assertTrue(np.isnan(adjusted[1, 2]))
+            np.testing.assert_almost_equal(np.delete(adjusted[1], 2), method(np.delete(self.p_values, 2)))
+            np.testing.assert_almost_equal(method(p_values.T, axis=0), adjusted.T)
+
+    def test_number_of_hypotheses(self):
+        # m is not truncated to an integer
+        fdr = statistics.false_discovery_rate(self.p_values, m=7.5)
+        np.testing.assert_almost_equal(fdr, statistics.false_discovery_rate(self.p_values) * 7.5 / 6)
+        holm = statistics.holm_correction(self.p_values, m=7.5)
+        np.testing.assert_almost_equal(holm, [0.065, 0.18, 0.165, 0.0375, 0.5, 0.18])
+        bonferroni = statistics.bonferroni_correction(self.p_values, m=7.5)
+        np.testing.assert_almost_equal(bonferroni, np.minimum(self.p_values * 7.5, 1))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 
 from AnyQt.QtCore import QStringListModel
-from orangecontrib.bioinformatics.widgets.utils.gui import TokenListCompleter
+from orangecontrib.bioinformatics.widgets.utils.gui import TokenListCompleter, GeneScoringWidget
 
 
 class TestCompleter(unittest.TestCase):
@@ -47,3 +47,11 @@ class TestCompleter(unittest.TestCase):
         completer.setCompletionPrefix("a, a")
         self.assertSequenceEqual(completions(completer),
                                  ["a, a", "a, aa", "a, ax", "a, az"])
+
+
+class TestGeneScoringWidget(unittest.TestCase):
+    def test_method_indices(self):
+        # indices of methods are stored in settings (e.g. OWClusterAnalysis.scoring_method_selection)
+        names = [method.name for method in GeneScoringWidget.scores]
+        self.assertEqual(names[:3], ['T-test', 'Mann-Whitney', 'Hypergeometric Test'])
+        self.assertEqual(names[3:], ["Welch's T-test", 'Moderated T-test'])
@@ -0,0 +1,46 @@
+import os
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+from orangecontrib.bioinformatics.utils import SharedArrays, process_count, process_pool
+
+
+class TestSharedArrays(unittest.TestCase):
+    def test_load(self):
+        dense = np.arange(12, dtype=float).reshape(3, 4)
+        sparse = sp.random(5, 4, density=0.5, format='csc', random_state=0)
+        shared = SharedArrays(dense=dense, sparse=sparse, missing=None)
+        try:
+            arrays = shared.load()
+            np.testing.assert_array_equal(arrays['dense'], dense)
+            self.assertTrue(sp.isspmatrix_csr(arrays['sparse']))
+            np.testing.assert_array_equal(arrays['sparse'].toarray(), sparse.toarray())
+            self.assertIsNone(arrays['missing'])
+        finally:
+            shared.close()
+
+    def test_close(self):
+        shared = SharedArrays(x=np.ones(3))
+        self.assertTrue(os.path.isdir(shared.directory))
+        shared.close()
+        self.assertFalse(os.path.exists(shared.directory))
+
+
+class TestProcessPool(unittest.TestCase):
+    def test_process_count(self):
+        self.assertGreaterEqual(process_count(), 1)
+        self.assertLessEqual(process_count(), os.cpu_count() or 1)
+
+    def test_process_pool(self):
+        with process_pool(1) as executor:
+            self.assertEqual(executor._mp_context.get_start_method(), 'spawn')
+            self.assertEqual(list(executor.map(abs, [-1, 2, -3])), [1, 2, 3])
+
+        with process_pool(10 ** 6) as executor:
+            self.assertLessEqual(executor._max_workers, os.cpu_count() or 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
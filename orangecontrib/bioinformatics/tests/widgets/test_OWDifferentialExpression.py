@@ -1,8 +1,18 @@
 import unittest
+from unittest import mock
+
 import scipy.stats
+import scipy.sparse as sp
 import numpy as np
 
-from orangecontrib.bioinformatics.widgets.OWDifferentialExpression import f_oneway
+from Orange.data import Table, Domain, ContinuousVariable, DiscreteVariable
+from Orange.widgets.tests.base import GuiTest
+
+from orangecontrib.bioinformatics.widgets.OWDifferentialExpression import (
+    f_oneway, permutation_scores, permutation_arrays, permutation_null_distribution, OWDifferentialExpression,
+    ScoreCache, data_fingerprint, SortedScores
+)
+from orangecontrib.bioinformatics.widgets import OWDifferentialExpression as owde
 
 
 class TestFOneWay(unittest.TestCase):
@@ -40,4 +50,172 @@ class TestFOneWay(unittest.TestCase):
 
         F, P = f_oneway(G1.T, G2.T, G3.T, axis=0)
         np.testing.assert_almost_equal(F1, F)
-        np.testing.assert_almost_equal(P1, P)
\ No newline at end of file
+        np.testing.assert_almost_equal(P1, P)
+
+
+class TestMannWhitney(unittest.TestCase):
+    def test_mann_whitney(self):
+        random_state = np.random.RandomState(0)
+        a = random_state.randint(5, size=(12, 20)).astype(float)
+        b = random_state.randint(5, size=(9, 20)).astype(float) + 0.5
+
+        U, P = owde.score_mann_whitney(a, b, axis=0)
+        for i in range(a.shape[1]):
+            # the smaller U and one sided P of the former scipy default (alternative=None)
+            u, p = scipy.stats.mannwhitneyu(a[:, i], b[:, i], alternative='two-sided', method='asymptotic')
+            self.assertAlmostEqual(U[i], min(u, len(a) * len(b) - u))
+            self.assertAlmostEqual(P[i], p / 2)
+
+        U_t, P_t = owde.score_mann_whitney(a.T, b.T, axis=1)
+        np.testing.assert_almost_equal(U_t, U)
+        np.testing.assert_almost_equal(P_t, P)
+        np.testing.assert_almost_equal(owde.score_mann_whitney_u(a, b, axis=0), U)
+
+        # identical samples
+        U, P = owde.score_mann_whitney(np.ones((3, 1)), np.ones((4, 1)))
+        np.testing.assert_equal(P, [1])
+
+
+class TestPermutations(unittest.TestCase):
+    def test_permutation_scores(self):
+        random_state = np.random.RandomState(0)
+        X = random_state.normal(loc=2, size=(30, 15))
+        X[3, 2] = np.nan
+        X[:, 5] = 1
+        binary = (X > 2).astype(float)
+        permutations = np.array([random_state.permutation(30) for _ in range(5)])
+
+        for name, _, test_type, score_func in OWDifferentialExpression.Scores:
+            sizes = [10, 20] if test_type == OWDifferentialExpression.TwoSampleTest else [10, 8, 12]
+            data = binary if name == 'Hypergeometric Test' else X
+            bounds = np.cumsum([0] + sizes)
+
+            expected = []
+            for perm in permutations:
+                scores = score_func(*[data[perm[start:end]] for start, end in zip(bounds, bounds[1:])],
+                                    axis=0, treshold=1)
+                expected.append(scores[0] if isinstance(scores, tuple) else scores)
+
+            scores = permutation_scores(data, sizes, permutations, score_func, treshold=1)
+            np.testing.assert_allclose(scores, np.array(expected, dtype=float), err_msg=name)
+
+    def test_precomputed_arrays(self):
+        random_state = np.random.RandomState(0)
+        X = random_state.normal(size=(20, 10))
+        X[3, 2] = np.nan
+        permutations = np.array([random_state.permutation(20) for _ in range(5)])
+        score_func = owde.score_kruskal_wallis_h
+
+        arrays = permutation_arrays(X, score_func)
+        with mock.patch('orangecontrib.bioinformatics.utils.statistics.rank_columns') as rank_columns:
+            scores = permutation_scores(X, [10, 10], permutations, score_func, arrays=arrays)
+        rank_columns.assert_not_called()
+        np.testing.assert_equal(scores, permutation_scores(X, [10, 10], permutations, score_func))
+
+    def test_null_distribution(self):
+        X = np.random.RandomState(0).normal(size=(20, 10))
+        indices = [np.arange(0, 20, 2), np.arange(1, 20, 2)]
+        score_func = OWDifferentialExpression.Scores[2][3]
+
+        counts = []
+        null_scores = permutation_null_distribution(X, indices, score_func, 30, callback=counts.append)
+        self.assertEqual(null_scores.shape, (30, 10))
+        self.assertEqual(sum(counts), 30)
+        np.testing.assert_equal(null_scores,
+                                permutation_null_distribution(X, indices, score_func, 30, processes=2))
+
+
+class TestScoreCache(unittest.TestCase):
+    def test_fingerprint(self):
+        X = np.arange(12, dtype=float).reshape(3, 4)
+        self.assertEqual(data_fingerprint(X), data_fingerprint(X.copy()))
+        self.assertNotEqual(data_fingerprint(X), data_fingerprint(X.reshape(4, 3)))
+        self.assertNotEqual(data_fingerprint(X), data_fingerprint(X + 1))
+
+    def test_fingerprint_sparse(self):
+        X = sp.random(10, 8, density=0.3, format='csr', random_state=0)
+        self.assertEqual(data_fingerprint(X), data_fingerprint(X.tocsc()))
+        self.assertNotEqual(data_fingerprint(X), data_fingerprint(X * 2))
+        self.assertNotEqual(data_fingerprint(X), data_fingerprint(X.T))
+
+    def test_bounded(self):
+        cache = ScoreCache(max_bytes=3 * 80)
+        for key in range(3):
+            cache.put(key, (np.zeros(10), None, None))
+        self.assertEqual(len(cache), 3)
+
+        # access makes the item recently used
+        self.assertIsNotNone(cache.get(0))
+        cache.put(3, (np.zeros(10), None, None))
+        self.assertNotIn(1, cache)
+        self.assertIn(0, cache)
+
+        cache.put(4, (np.zeros(10), np.zeros(10), None))
+        self.assertEqual(len(cache), 2)
+        self.assertIn(3, cache)
+        self.assertIn(4, cache)
+
+        # too large to be stored
+        cache.put(5, (np.zeros(100), None, None))
+        self.assertNotIn(5, cache)
+        self.assertIsNone(cache.get(5))
+
+
+class TestOWDifferentialExpression(GuiTest):
+    def setUp(self):
+        self.widget = OWDifferentialExpression()
+
+    def tearDown(self):
+        self.widget.onDeleteWidget()
+
+    @staticmethod
+    def data(X):
+        domain = Domain([ContinuousVariable('gene{}'.format(i)) for i in range(X.shape[1])],
+                        DiscreteVariable('class', values=('a', 'b')))
+        return Table.from_numpy(domain, X, np.arange(X.shape[0]) % 2)
+
+    def test_sparse_input(self):
+        data = self.data(sp.random(20, 15, density=0.3, format='csr', random_state=0))
+        self.widget.set_data(data)
+        self.assertIs(self.widget.data, data)
+
+    def test_cache_cleared_on_new_data(self):
+        widget = self.widget
+        data = self.data(np.random.RandomState(0).normal(size=(20, 15)))
+        widget.set_data(data)
+        widget.score_cache.put('key', (np.zeros(3), None, None))
+
+        # the same table keeps the cached scores, another one does not
+        widget.set_data(data)
+        self.assertIn('key', widget.score_cache)
+        widget.set_data(self.data(data.X.copy()))
+        self.assertNotIn('key', widget.score_cache)
+
+
+class TestSortedScores(unittest.TestCase):
+    def test_selection(self):
+        scores = np.round(np.random.RandomState(0).normal(size=500), 1)
+        scores[[3, 10, 42]] = [np.nan, np.inf, -np.inf]
+        index = SortedScores(scores)
+        self.assertEqual(len(index), 497)
+        self.assertEqual(index.size, 500)
+
+        finite = np.isfinite(scores)
+        tests = {OWDifferentialExpression.LowTail: owde.test_low,
+                 OWDifferentialExpression.HighTail: owde.test_high,
+                 OWDifferentialExpression.TwoTail: owde.test_two_tail}
+        for side, test in tests.items():
+            for low, high in [(-1, 1), (-0.5, 0.3), (0.5, -0.5), (-5, 5), (0.1, 0.1)]:
+                selected = finite & test(np.where(finite, scores, 0), low, high)
+                self.assertEqual(index.count(side, low, high), np.count_nonzero(selected))
+                np.testing.assert_array_equal(index.selected(side, low, high), np.flatnonzero(selected))
+
+    def test_quantile(self):
+        values = np.random.RandomState(0).normal(size=(10, 101))
+        values[0, 0] = np.nan
+        index = SortedScores(values)
+        q = [0, 0.01, 0.025, 0.5, 0.975, 1]
+        np.testing.assert_allclose(index.quantile(q), np.nanpercentile(values, np.multiply(q, 100)))
+        self.assertAlmostEqual(index.quantile(0.05), np.nanpercentile(values, 5))
+
+        np.testing.assert_array_equal(index.magnitudes(), np.sort(np.abs(values[np.isfinite(values)])))
@@ -0,0 +1,231 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from concurrent.futures import CancelledError
+
+import numpy as np
+
+from AnyQt.QtCore import QModelIndex, QCoreApplication
+
+from Orange.data import Table, Domain, StringVariable
+from Orange.widgets.tests.base import GuiTest
+from orangecontrib.bioinformatics import go
+from orangecontrib.bioinformatics.go.config import DOMAIN, FILENAME_ANNOTATION, FILENAME_ONTOLOGY
+from orangecontrib.bioinformatics.widgets import OWGOBrowser as owgobrowser
+from orangecontrib.bioinformatics.widgets.OWGOBrowser import EnrichmentTree, EnrichmentTreeModel, OWGOBrowser
+from orangecontrib.bioinformatics.widgets.utils.data import TAX_ID, GENE_AS_ATTRIBUTE_NAME, GENE_ID_COLUMN
+
+
+OBO = """format-version: 1.2
+
+[Term]
+id: GO:0000001
+name: root
+namespace: biological_process
+
+[Term]
+id: GO:0000002
+name: child
+namespace: biological_process
+is_a: GO:0000001 ! root
+
+[Term]
+id: GO:0000003
+name: other child
+namespace: biological_process
+is_a: GO:0000001 ! root
+
+[Term]
+id: GO:0000004
+name: grandchild
+namespace: biological_process
+is_a: GO:0000002 ! child
+is_a: GO:0000003 ! other child
+
+[Term]
+id: GO:0000005
+name: obsolete
+namespace: biological_process
+is_obsolete: true
+"""
+
+GENE2GO = """#tax_id\tGeneID\tGO_ID\tEvidence\tQualifier\tGO_term\tPubMed\tCategory
+9606\t1\tGO:0000004\tIDA\t\tgrandchild\t-\tProcess
+9606\t2\tGO:0000002\tIDA\t\tchild\t-\tProcess
+9606\t3\tGO:0000003\tIDA\t\tother child\t-\tProcess
+9606\t4\tGO:0000001\tIDA\t\troot\t-\tProcess
+"""
+
+RESULTS = {
+    'GO:0000001': (['a', 'b', 'c'], 1.0, 10),
+    'GO:0000002': (['a', 'b'], 0.1, 5),
+    'GO:0000003': (['b', 'c'], 0.2, 6),
+    'GO:0000004': (['b'], 0.01, 2),
+    'GO:0000005': (['c'], 0.5, 1),
+}
+
+
+class TestEnrichmentTree(unittest.TestCase):
+    def setUp(self):
+        self.ontology = go.Ontology(io.StringIO(OBO))
+        self.tree = EnrichmentTree(self.ontology, RESULTS)
+
+    def terms(self, indices):
+        return [self.tree.term_ids[i] for i in indices]
+
+    def test_tree(self):
+        tree = self.tree
+        self.assertEqual(tree.term_ids, ['GO:0000004', 'GO:0000002', 'GO:0000003', 'GO:0000005', 'GO:0000001'])
+        self.assertEqual(self.terms(tree.roots), ['GO:0000001'])
+        self.assertEqual(self.terms(tree.children(4)), ['GO:0000002', 'GO:0000003'])
+        self.assertEqual(self.terms(tree.parents(0)), ['GO:0000002', 'GO:0000003'])
+
+        results = tree.as_dict()
+        self.assertEqual(results['GO:0000002'][:3], RESULTS['GO:0000002'])
+        np.testing.assert_almost_equal([results[term][3] for term in tree.term_ids], [0.05, 0.25, 1 / 3, 0.625, 1])
+
+    def test_displayed(self):
+        tree = self.tree
+        displayed = np.ones(len(tree), dtype=bool)
+        self.assertEqual(self.terms(tree.displayed_children(None, displayed)), ['GO:0000001'])
+        self.assertEqual(tree.displayed_paths(0, displayed), [[4, 1, 0], [4, 2, 0]])
+
+        # children of hidden terms are shown below the nearest displayed ancestors
+        displayed[[1, 4]] = False
+        self.assertEqual(self.terms(tree.displayed_children(None, displayed)), ['GO:0000004', 'GO:0000003'])
+        self.assertEqual(self.terms(tree.displayed_children(2, displayed)), ['GO:0000004'])
+        self.assertEqual(tree.displayed_paths(0, displayed), [[0], [2, 0]])
+
+
+class TestEnrichmentTreeModel(GuiTest):
+    def setUp(self):
+        self.ontology = go.Ontology(io.StringIO(OBO))
+        self.tree = EnrichmentTree(self.ontology, RESULTS)
+        self.displayed = np.ones(len(self.tree), dtype=bool)
+        self.model = EnrichmentTreeModel(['GO term', 'Cluster', 'Reference', 'p-value', 'FDR', 'Genes',
+                                          'Enrichment'])
+        self.model.set_terms(self.tree, self.displayed, self.ontology, 3, 10)
+
+    def test_lazy_children(self):
+        model = self.model
+        self.assertEqual(model.rowCount(), 1)
+        root = model.index(0, 0)
+        self.assertEqual(root.data(), 'root')
+        self.assertEqual(root.data(EnrichmentTreeModel.TermRole), 'GO:0000001')
+
+        # children are created when fetched
+        self.assertTrue(model.hasChildren(root))
+        self.assertEqual(model.rowCount(root), 0)
+        self.assertTrue(model.canFetchMore(root))
+        model.fetchMore(root)
+        self.assertFalse(model.canFetchMore(root))
+        self.assertEqual([model.index(row, 0, root).data() for row in range(model.rowCount(root))],
+                         ['child', 'other child'])
+
+        child = model.index(0, 3, root)
+        self.assertEqual(child.data(), '0.10000')
+        self.assertEqual(child.data(EnrichmentTreeModel.SortRole), 0.1)
+        self.assertEqual(model.parent(child), root)
+        self.assertEqual(model.parent(root), QModelIndex())
+
+    def test_occurrences(self):
+        model = self.model
+        indices = model.occurrences('GO:0000004')
+        self.assertEqual(len(indices), 2)
+        self.assertEqual({model.parent(index).data() for index in indices}, {'child', 'other child'})
+        self.assertEqual(model.occurrences('GO:0000005'), [])
+
+    def test_flat(self):
+        model = EnrichmentTreeModel(['GO term'], flat=True)
+        model.set_terms(self.tree, self.displayed, self.ontology, 3, 10)
+        self.assertEqual([model.index(row, 0).data() for row in range(model.rowCount())],
+                         ['grandchild', 'child', 'other child', 'obsolete', 'root'])
+        self.assertFalse(model.hasChildren(model.index(0, 0)))
+        self.assertEqual(len(model.occurrences('GO:0000001')), 1)
+
+        model.clear()
+        self.assertEqual(model.rowCount(), 0)
+
+
+class TestOWGOBrowser(GuiTest):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(self.dir.name, 'gene2go_9606.tab')
+        with open(filename, 'w') as f:
+            f.write(GENE2GO)
+        with mock.patch.object(go.serverfiles, 'localpath_download', return_value=filename):
+            self.annotations = go.Annotations('9606', ontology=go.Ontology(io.StringIO(OBO)))
+
+        # all files are available locally
+        files = [(DOMAIN, FILENAME_ONTOLOGY), (DOMAIN, FILENAME_ANNOTATION.format('9606'))]
+        server_files = mock.Mock()
+        server_files.return_value.listfiles.return_value = files
+        for patcher in (mock.patch.object(owgobrowser.serverfiles, 'listfiles', return_value=files),
+                        mock.patch.object(owgobrowser.serverfiles, 'ServerFiles', server_files)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.widget = OWGOBrowser()
+        self.widget.annotations = self.annotations
+        self.widget.ontology = self.annotations.ontology
+        self.widget.loaded_annotation_code = '9606'
+
+    def tearDown(self):
+        self.widget.onDeleteWidget()
+        self.dir.cleanup()
+
+    @staticmethod
+    def data(genes):
+        table = Table.from_list(Domain([], metas=[StringVariable('Entrez ID')]), [[gene] for gene in genes])
+        table.attributes[TAX_ID] = '9606'
+        table.attributes[GENE_AS_ATTRIBUTE_NAME] = False
+        table.attributes[GENE_ID_COLUMN] = 'Entrez ID'
+        return table
+
+    def wait_until(self, condition, timeout=10):
+        end = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), end, 'timeout')
+            QCoreApplication.processEvents()
+            time.sleep(0.01)
+
+    def test_stale_enrichment_discarded(self):
+        started, release = threading.Event(), threading.Event()
+        runs = []
+        enrichment = owgobrowser.run_enrichment
+
+        def run_enrichment(annotations, ontology, genes, *args):
+            run = {'genes': set(genes)}
+            runs.append(run)
+            started.set()
+            release.wait(10)
+            try:
+                run['result'] = enrichment(annotations, ontology, genes, *args)
+            except CancelledError:
+                run['result'] = 'cancelled'
+                raise
+            return run['result']
+
+        widget = self.widget
+        with mock.patch.object(owgobrowser, 'run_enrichment', run_enrichment):
+            widget.setDataset(self.data(['1', '3']))
+            self.wait_until(started.is_set)
+
+            # the input changes while the enrichment is running
+            widget.setDataset(self.data(['2']))
+            release.set()
+            self.wait_until(lambda: len(runs) == 2 and 'result' in runs[1] and widget.enrichment_tree is not None)
+
+        self.assertEqual(runs[0]['genes'], {'1', '3'})
+        self.assertEqual(runs[0]['result'], 'cancelled')
+        self.assertEqual(runs[1]['genes'], {'2'})
+        self.assertEqual(set(widget.terms), {'GO:0000002', 'GO:0000001'})
+        self.assertEqual({gene for genes, *_ in widget.terms.values() for gene in genes}, {'2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+from unittest.mock import patch
+from concurrent.futures import Future
+
+import numpy as np
+
+from AnyQt.QtCore import QCoreApplication
+
+from Orange.data import Table, Domain, ContinuousVariable, StringVariable
+from Orange.widgets.tests.base import WidgetTest
+from orangecontrib.bioinformatics.utils.statistics import score_fold_change, score_t_test
+from orangecontrib.bioinformatics.widgets.OWVolcanoPlot import (
+    OWVolcanoPlot, VolcanoGraph, volcano_embedding, volcano_tails
+)
+from orangecontrib.bioinformatics.widgets.utils.data import GENE_AS_ATTRIBUTE_NAME, GENE_ID_COLUMN
+
+
+class TestVolcanoEmbedding(unittest.TestCase):
+    def test_embedding(self):
+        X = np.random.RandomState(0).lognormal(size=(20, 8))
+        mask = np.arange(8) < 3
+        embedding, negative = volcano_embedding(X, mask)
+
+        self.assertFalse(negative)
+        self.assertEqual(embedding.shape, (20, 2))
+        np.testing.assert_almost_equal(embedding[:, 0], score_fold_change(X[:, mask], X[:, ~mask], axis=1, log=True))
+        np.testing.assert_almost_equal(embedding[:, 1], -np.log10(score_t_test(X[:, mask], X[:, ~mask], axis=1)[1]))
+
+    def test_negative(self):
+        X = np.ones((5, 4))
+        X[2, 3] = -1
+        embedding, negative = volcano_embedding(X, np.array([True, True, False, False]))
+        self.assertTrue(negative)
+        self.assertTrue(np.isnan(embedding).all())
+
+    def test_tails(self):
+        x = np.array([0., 0.1, -0.1, 5, 0, -4, 0.2, 0])
+        y = np.array([0., 0.2, 0.1, 1, 6, 1, 0.1, 0])
+        np.testing.assert_array_equal(volcano_tails(x, y, 3), [3, 4, 5])
+        np.testing.assert_array_equal(volcano_tails(x, y, 8), np.arange(8))
+        np.testing.assert_array_equal(volcano_tails(x, y, 20), np.arange(8))
+
+
+class TestOWVolcanoPlot(WidgetTest):
+    def setUp(self):
+        self.widget = self.create_widget(OWVolcanoPlot)
+
+        # 30 genes in rows, 10 samples in columns, the samples are split by the 'group' attribute
+        samples = [ContinuousVariable('sample{}'.format(i)) for i in range(10)]
+        for i, sample in enumerate(samples):
+            sample.attributes['group'] = 'ab'[i // 5]
+        X = np.random.RandomState(0).lognormal(size=(30, 10))
+        self.data = Table.from_numpy(Domain(samples, metas=[StringVariable('Gene ID')]),
+                                     X, metas=np.arange(30).astype(str)[:, np.newaxis].astype(object))
+        self.data.attributes[GENE_AS_ATTRIBUTE_NAME] = False
+        self.data.attributes[GENE_ID_COLUMN] = 'Gene ID'
+
+    def send_data(self):
+        """ Send the data and wait for the embedding of the target split """
+        self.send_signal(self.widget.Inputs.data, self.data)
+        futures = list(self.widget._pending.values())
+        self.assertEqual(len(futures), 1)
+        futures[0].result()
+        while self.widget._pending:
+            QCoreApplication.processEvents()
+
+    def test_embedding_error(self):
+        widget = self.widget
+        self.send_data()
+        self.assertEqual(len(widget._embeddings), 1)
+
+        key = next(iter(widget._embeddings))
+        del widget._embeddings[key]
+        future = Future()
+        future.set_exception(ValueError('no memory'))
+        widget._pending[key] = future
+        widget._on_embedding_done(key, future)
+
+        self.assertTrue(widget.Error.embedding_error.is_shown())
+        self.assertEqual(widget._pending, {})
+        self.assertNotIn(key, widget._embeddings)
+
+    @patch.object(VolcanoGraph, 'MAX_GLYPHS', 10)
+    def test_summarize_bulk(self):
+        widget, graph = self.widget, self.widget.graph
+        self.send_data()
+        x, y = widget.get_coordinates_data()
+        self.assertEqual(len(x), 30)
+
+        self.assertTrue(graph.summarize_bulk)
+        np.testing.assert_array_equal(graph.sample_indices, volcano_tails(x, y, 10))
+        self.assertEqual(graph.n_shown, 10)
+        self.assertIsNotNone(graph.bulk_density_img)
+
+        graph.summarize_bulk = False
+        graph.update_level_of_detail()
+        self.assertEqual(graph.n_shown, 30)
+        self.assertIsNone(graph.bulk_density_img)
+
+
+if __name__ == '__main__':
+    unittest.main()
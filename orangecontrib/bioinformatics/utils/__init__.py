@@ -1,4 +1,10 @@
 import os
+import shutil
+import tempfile
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import scipy.sparse as sp
 
 from Orange.misc.environ import data_dir
 
@@ -16,3 +22,65 @@ def ensure_type(value, types):
     else:
         raise TypeError('Wrong variable type. {value} is {value_type}, but should be {types}'.format(
             value=value, value_type=type(value), types=types))
+
+
+#: The maximal number of worker processes used by default, see :func:`process_count`
+MAX_PROCESSES = 4
+
+
+def process_count():
+    """ Default number of worker processes: all CPUs but one (left to the GUI), at most `MAX_PROCESSES` """
+    return max(1, min((os.cpu_count() or 1) - 1, MAX_PROCESSES))
+
+
+def process_pool(processes=None):
+    """ Return a process pool executor with `processes` (default :func:`process_count`) workers,
+    but not more workers than there are CPUs.
+
+    Workers are spawned instead of forked: forking a process that runs other threads (e.g. the GUI) is unsafe.
+    Functions run in the pool must therefore be importable (defined on the module level).
+    """
+    processes = max(1, min(processes or process_count(), os.cpu_count() or 1))
+    return concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+class SharedArrays:
+    """ Arrays (dense or sparse) dumped to memory-mapped files in a temporary directory.
+
+    Instances are cheap to pickle, worker processes map the files instead of receiving copies of the data.
+    """
+
+    def __init__(self, **arrays):
+        self.directory = tempfile.mkdtemp(prefix='orange-bioinformatics-')
+        self.arrays = {}
+
+        for name, array in arrays.items():
+            if array is None:
+                self.arrays[name] = None
+            elif sp.issparse(array):
+                array = sp.csr_matrix(array)
+                self.arrays[name] = (array.shape, [self.__dump('{}_{}'.format(name, part), getattr(array, part))
+                                                   for part in ('data', 'indices', 'indptr')])
+            else:
+                self.arrays[name] = (None, [self.__dump(name, array)])
+
+    def __dump(self, name, array):
+        path = os.path.join(self.directory, name + '.npy')
+        np.save(path, np.asarray(array))
+        return path
+
+    def load(self):
+        """ Return a dictionary of (read-only) memory-mapped arrays """
+        arrays = {}
+        for name, stored in self.arrays.items():
+            if stored is None:
+                arrays[name] = None
+                continue
+
+            shape, paths = stored
+            parts = [np.load(path, mmap_mode='r') for path in paths]
+            arrays[name] = parts[0] if shape is None else sp.csr_matrix(tuple(parts), shape=shape, copy=False)
+        return arrays
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
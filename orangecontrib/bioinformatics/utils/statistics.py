@@ -1,9 +1,13 @@
 import math
 import scipy
+import scipy.special
+import scipy.stats
 import threading
 import numpy as np
+import scipy.sparse as sp
 
 from typing import Tuple, Union
+from collections import namedtuple
 
 from scipy.stats import hypergeom
 
@@ -13,11 +17,132 @@ ALT_GREATER = "greater"
 ALTERNATIVES = [ALT_GREATER, ALT_TWO, ALT_LESS]
 
 
+def _mean(x, axis=0):
+    # type: (Union[np.ndarray, sp.spmatrix], int) -> np.ndarray
+    """ Mean along `axis` of a dense (ignoring NaNs) or sparse matrix. """
+    if sp.issparse(x):
+        return np.asarray(x.mean(axis=axis)).ravel()
+    return np.nanmean(x, axis=axis)
+
+
+def _moments(x, axis=0):
+    # type: (Union[np.ndarray, sp.spmatrix], int) -> Tuple[int, np.ndarray, np.ndarray]
+    """ Return the number of samples, mean and (unbiased) variance along `axis`.
+    Sparse matrices are never densified.
+    """
+    n = x.shape[axis]
+    if sp.issparse(x):
+        mean = np.asarray(x.mean(axis=axis)).ravel()
+        mean_sq = np.asarray(x.multiply(x).mean(axis=axis)).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.maximum(mean_sq - mean ** 2, 0) * n / (n - 1)
+        return n, mean, var
+
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return n, np.mean(x, axis=axis), np.var(x, axis=axis, ddof=1)
+
+
+def _t_p_values(scores, df, alternative=ALT_TWO):
+    """ P-values of t statistics with `df` degrees of freedom. """
+    if alternative == ALT_TWO:
+        return 2 * scipy.stats.t.sf(np.abs(scores), df)
+    elif alternative == ALT_LESS:
+        return scipy.stats.t.cdf(scores, df)
+    return scipy.stats.t.sf(scores, df)
+
+
+def _t_test(n_a, mean_a, var_a, n_b, mean_b, var_b, alternative=ALT_TWO):
+    """ Two sample t-test (equal variances) from the samples' moments. """
+    df = n_a + n_b - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pooled_var = ((n_a - 1) * var_a + (n_b - 1) * var_b) / df
+        scores = (mean_a - mean_b) / np.sqrt(pooled_var * (1.0 / n_a + 1.0 / n_b))
+    return scores, _t_p_values(scores, df, alternative)
+
+
+def _welch_t_test(n_a, mean_a, var_a, n_b, mean_b, var_b, alternative=ALT_TWO):
+    """ Two sample t-test (unequal variances) from the samples' moments. """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se_a, se_b = var_a / n_a, var_b / n_b
+        scores = (mean_a - mean_b) / np.sqrt(se_a + se_b)
+        # Welch-Satterthwaite degrees of freedom
+        df = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+    return scores, _t_p_values(scores, df, alternative)
+
+
+def _trigamma_inverse(x):
+    # type: (np.ndarray) -> np.ndarray
+    """ Solve trigamma(y) = x for y with Newton's method (as in limma). """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = 0.5 + 1 / x
+        for _ in range(50):
+            tri = scipy.special.polygamma(1, y)
+            step = tri * (1 - tri / x) / scipy.special.polygamma(2, y)
+            y = y + step
+            if not np.any(np.abs(step / y) > 1e-8):
+                break
+        # asymptotic solutions, where the iteration is inaccurate
+        y = np.where(x > 1e7, 1 / np.sqrt(x), y)
+        return np.where(x < 1e-6, 1 / x, y)
+
+
+def _fit_prior_variance(variances, df):
+    # type: (np.ndarray, np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+    """ Estimate the prior degrees of freedom and the prior variance from the (scaled F)
+    distribution of variances along the last axis, by the method of moments on log variances.
+
+    :return: (prior degrees of freedom, prior variance), with the last axis kept
+    """
+    df = np.broadcast_to(df, variances.shape)
+    valid = np.isfinite(variances) & (variances > 0) & (df > 0)
+    n_valid = np.sum(valid, axis=-1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half_df = np.where(valid, df, 2) / 2
+        e = np.log(np.where(valid, variances, 1)) - scipy.special.digamma(half_df) + np.log(half_df)
+        e_mean = np.sum(np.where(valid, e, 0), axis=-1, keepdims=True) / n_valid
+        e_var = np.sum(np.where(valid, (e - e_mean) ** 2, 0), axis=-1, keepdims=True) / (n_valid - 1)
+        e_var -= np.sum(np.where(valid, scipy.special.polygamma(1, half_df), 0), axis=-1, keepdims=True) / n_valid
+
+        moderated = e_var > 0
+        prior_df = np.where(moderated, 2 * _trigamma_inverse(np.where(moderated, e_var, 1)), np.inf)
+        half_prior_df = np.where(moderated, prior_df / 2, 1)
+        prior_var = np.exp(e_mean + np.where(
+            moderated, scipy.special.digamma(half_prior_df) - np.log(half_prior_df), 0))
+
+    # too few genes to estimate the prior, do not moderate variances
+    prior_df = np.where(n_valid > 1, prior_df, 0)
+    prior_var = np.where(n_valid > 1, prior_var, 0)
+    return prior_df, prior_var
+
+
+def _moderated_t_test(n_a, mean_a, var_a, n_b, mean_b, var_b, alternative=ALT_TWO):
+    """ Moderated two sample t-test from the samples' moments, genes along the last axis. """
+    df = np.asarray(n_a + n_b - 2, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pooled_var = ((n_a - 1) * var_a + (n_b - 1) * var_b) / df
+    df = np.broadcast_to(df, np.shape(pooled_var))
+    prior_df, prior_var = _fit_prior_variance(pooled_var, df)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        posterior_var = np.where(np.isinf(prior_df), prior_var,
+                                 (prior_df * prior_var + df * pooled_var) / (prior_df + df))
+        scores = (mean_a - mean_b) / np.sqrt(posterior_var * (1.0 / n_a + 1.0 / n_b))
+
+    # the total degrees of freedom are limited by the residual degrees of freedom of all genes
+    total_df = np.minimum(df + prior_df, np.sum(np.where(np.isfinite(pooled_var), df, 0), axis=-1, keepdims=True))
+    return scores, _t_p_values(scores, total_df, alternative)
+
+
 def score_t_test(a, b, axis=0, alternative=ALT_TWO):
     # type: (np.array, np.array, int, str) -> Tuple[Union[float, np.array], Union[float, np.array]]
     """ Run t-test. Enable setting different alternative hypothesis.
     Probabilities are exact due to symmetry of the test.
 
+    `a` and `b` can be dense or sparse (scipy.sparse) matrices.
+
     :return: (statistics, p_values)
 
     See also
@@ -25,26 +150,106 @@ def score_t_test(a, b, axis=0, alternative=ALT_TWO):
     scipy.stats.ttest_ind
 
     """
-    # alt = kwargs.get("alternative", ALT_TWO)
     assert alternative in ALTERNATIVES
-    scores, pvalues = scipy.stats.ttest_ind(a, b, axis=axis)
+    return _t_test(*_moments(a, axis=axis), *_moments(b, axis=axis), alternative=alternative)
 
-    if alternative == ALT_TWO:
-        return scores, pvalues
 
-    less = scores < 0
-    pvalues = pvalues / 2.0
-    pvalues[np.logical_not(less)] = 1.0 - pvalues[np.logical_not(less)]
+def score_welch_t_test(a, b, axis=0, alternative=ALT_TWO):
+    # type: (np.array, np.array, int, str) -> Tuple[Union[float, np.array], Union[float, np.array]]
+    """ Run Welch's t-test (unequal variances) on all genes at once.
+
+    `a` and `b` can be dense or sparse (scipy.sparse) matrices.
+
+    :return: (statistics, p_values)
+
+    See also
+    --------
+    scipy.stats.ttest_ind
+
+    """
+    assert alternative in ALTERNATIVES
+    return _welch_t_test(*_moments(a, axis=axis), *_moments(b, axis=axis), alternative=alternative)
 
-    if alternative == ALT_LESS:
-        return scores, pvalues
-    else:
-        return scores, 1.0 - pvalues
+
+def score_moderated_t_test(a, b, axis=0, alternative=ALT_TWO):
+    # type: (np.array, np.array, int, str) -> Tuple[Union[float, np.array], Union[float, np.array]]
+    """ Run moderated t-test (empirical Bayes, as in limma) on all genes at once.
+
+    Variances of genes are shrunk towards a common prior variance, which is estimated
+    (with its degrees of freedom) from the distribution of variances of all genes.
+    The statistics follow the t distribution with the residual and prior degrees of
+    freedom, which gives stable rankings for experiments with few samples.
+
+    `a` and `b` can be dense or sparse (scipy.sparse) matrices.
+
+    :return: (statistics, p_values)
+
+    References
+    ----------
+    Smyth, G. K. (2004). Linear models and empirical Bayes methods for assessing
+    differential expression in microarray experiments.
+
+    """
+    assert alternative in ALTERNATIVES
+    a_moments, b_moments = _moments(a, axis=axis), _moments(b, axis=axis)
+    if np.ndim(a_moments[1]) == 0:
+        raise ValueError("Moderated t-test requires a matrix of genes")
+    return _moderated_t_test(*a_moments, *b_moments, alternative=alternative)
+
+
+def rank_columns(x):
+    # type: (np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+    """ Rank the values in each column of `x`, tied values get the average rank.
+
+    :return: (ranks, tie correction term sum(t**3 - t) over groups of ties in each column)
+    """
+    n = x.shape[0]
+    order = np.argsort(x, axis=0)
+    sorted_x = np.take_along_axis(x, order, axis=0)
+    positions = np.arange(n)[:, np.newaxis]
+
+    # mark the first and the last position of each group of tied values
+    first = np.ones(x.shape, dtype=bool)
+    first[1:] = sorted_x[1:] != sorted_x[:-1]
+    last = np.ones(x.shape, dtype=bool)
+    last[:-1] = first[1:]
+
+    first = np.maximum.accumulate(np.where(first, positions, 0), axis=0)
+    last = np.minimum.accumulate(np.where(last, positions, n)[::-1], axis=0)[::-1]
+
+    ranks = np.empty(x.shape, dtype=float)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=0)
+
+    # each of t tied values contributes (t**2 - 1), which sums to t**3 - t per group
+    ties = (last - first + 1).astype(float)
+    return ranks, np.sum(ties ** 2 - 1, axis=0)
 
 
 def score_mann_whitney(a, b, **kwargs):
+    """ Run Mann-Whitney U test on all genes at once. Each gene is ranked once
+    (with tie correction) and p-values are computed with the normal approximation
+    (with continuity correction).
+
+    :param axis: Axis which holds the samples (default 0)
+    :param alternative: Alternative hypothesis
+    :param chunk_size: Number of genes ranked at once. Defaults to a value which
+        keeps the ranked block at roughly 4M elements. Sparse inputs are densified
+        one block at a time.
+
+    :return: (U statistics of `a`, p_values)
+
+    See also
+    --------
+    scipy.stats.mannwhitneyu
+
+    """
     axis = kwargs.get('axis', 0)
-    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    sparse = sp.issparse(a) or sp.issparse(b)
+    if sparse:
+        # genes are ranked in dense column blocks
+        a, b = sp.csc_matrix(a, dtype=float), sp.csc_matrix(b, dtype=float)
+    else:
+        a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
 
     if not 0 <= axis < 2:
         raise ValueError("Axis")
@@ -55,56 +260,108 @@ def score_mann_whitney(a, b, **kwargs):
     if axis >= a.ndim:
         raise ValueError
 
-    if axis == 0:
+    if a.ndim == 1:
+        a, b = a[:, np.newaxis], b[:, np.newaxis]
+    elif axis == 1:
         a, b = a.T, b.T
+        if sparse:
+            a, b = a.tocsc(), b.tocsc()
 
     alt = kwargs.get("alternative", ALT_TWO)
     assert alt in ALTERNATIVES
-    statistics = np.zeros((a.shape[0]),)
-    p_values = np.zeros((a.shape[0]),)
-    for i, (a_, b_) in enumerate(zip(a, b)):
-        try:
-            s, p = scipy.stats.mannwhitneyu(a_, b_, alternative=alt)
-        except ValueError:
-            s, p = (0, 1)
-        statistics[i] = s
-        p_values[i] = p
-    return np.array(statistics), np.array(p_values)
+
+    n1, n2 = a.shape[0], b.shape[0]
+    n = n1 + n2
+    n_genes = a.shape[1]
+    statistics = np.zeros((n_genes,))
+    p_values = np.ones((n_genes,))
+    if not n1 or not n2:
+        return statistics, p_values
+
+    chunk_size = kwargs.get('chunk_size', None) or max(1, 2 ** 22 // n)
+    for start in range(0, n_genes, chunk_size):
+        genes = slice(start, start + chunk_size)
+        if sparse:
+            block = sp.vstack((a[:, genes], b[:, genes])).toarray()
+        else:
+            block = np.vstack((a[:, genes], b[:, genes]))
+        ranks, ties = rank_columns(block)
+        statistics[genes] = np.sum(ranks[:n1], axis=0) - n1 * (n1 + 1) / 2.0
+
+        # normal approximation
+        mean = n1 * n2 / 2.0
+        sd = np.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+        u1 = statistics[genes]
+        if alt == ALT_TWO:
+            u = np.maximum(u1, n1 * n2 - u1)
+        elif alt == ALT_LESS:
+            u = n1 * n2 - u1
+        else:
+            u = u1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = scipy.stats.norm.sf((u - mean - 0.5) / sd)
+        if alt == ALT_TWO:
+            p = np.minimum(2.0 * p, 1.0)
+        p[sd == 0] = 1.0
+        p_values[genes] = p
+
+    return statistics, p_values
+
+
+def _expressed_count(x, threshold):
+    # type: (Union[np.ndarray, sp.spmatrix], float) -> np.ndarray
+    """ Count the values greater or equal to `threshold` in each column of `x`. """
+    if sp.issparse(x):
+        if sp.isspmatrix_csr(x):
+            columns, data = x.indices, x.data
+        else:
+            x = x.tocoo()
+            columns, data = x.col, x.data
+
+        if threshold > 0:
+            return np.bincount(columns[data >= threshold], minlength=x.shape[1])
+        # implicit zeros are above the threshold
+        return x.shape[0] - np.bincount(columns[data < threshold], minlength=x.shape[1])
+
+    return np.count_nonzero(np.asarray(x) >= threshold, axis=0)
 
 
 def score_hypergeometric_test(a, b, threshold=1, **kwargs):
     """
     Run a hypergeometric test. The probability in a two-sided test is approximated
     with the symmetric distribution with more extreme of the tails.
+
+    `a` and `b` can be dense or sparse (scipy.sparse) expression matrices.
     """
     # type: (np.ndarray, np.ndarray, float) -> np.ndarray
-
-    # Binary expression matrices
-    A = (a >= threshold).astype(int)
-    B = (b >= threshold).astype(int)
     alt = kwargs.get("alternative", ALT_TWO)
     assert alt in ALTERNATIVES
+    return _hypergeometric_test(a.shape[0], _expressed_count(a, threshold),
+                                b.shape[0], _expressed_count(b, threshold), alternative=alt)
+
 
+def _hypergeometric_test(n_a, expressed_a, n_b, expressed_b, alternative=ALT_TWO):
+    """ Hypergeometric test from the numbers of samples and the numbers of samples expressing genes. """
     # Test Parameters
-    M = len(A) + len(B)
-    N = len(A)
-    n_expr = A.sum(axis=0) + B.sum(axis=0)  # Number of cells expressing genes (overall)
-    n_expr_clust = A.sum(axis=0)            # Number of cells expressing genes (in cluster)
+    M = n_a + n_b
+    N = n_a
+    n_expr_clust = expressed_a               # Number of cells expressing genes (in cluster)
+    n_expr = expressed_a + expressed_b       # Number of cells expressing genes (overall)
 
     # Test results --- both tails
     # Note: cumulatives do sum to >1 due to overlap at 1 point
-    under = np.fromiter(map(lambda t: hypergeom.cdf(k=t[1], n=t[0], M=M, N=N),
-                            zip(n_expr, n_expr_clust)), dtype=float)
-    over = np.fromiter(map(lambda t: hypergeom.sf(k=t[1]-1, n=t[0], M=M, N=N),
-                           zip(n_expr, n_expr_clust)), dtype=float)
+    under = hypergeom.cdf(k=n_expr_clust, M=M, n=n_expr, N=N)
+    over = hypergeom.sf(k=n_expr_clust - 1, M=M, n=n_expr, N=N)
     signs = np.sign(under - over)
-    if alt == ALT_TWO:
+    if alternative == ALT_TWO:
         pvalues = np.minimum(1.0, 2.0 * np.minimum(under, over))
-    elif alt == ALT_LESS:
+    elif alternative == ALT_LESS:
         pvalues = under
     else:
         pvalues = over
-    scores = -np.log(pvalues) * signs
+    with np.errstate(divide='ignore'):
+        scores = -np.log(pvalues) * signs
     return scores, pvalues
 
 
@@ -120,14 +377,295 @@ def score_fold_change(a, b, axis=0, log=False):
     :return: The fold change scores
     """
 
-    scores = np.nanmean(a, axis=axis) / np.nanmean(b, axis=axis)
+    return _fold_change(_mean(a, axis=axis), _mean(b, axis=axis), log=log)
+
+
+def _fold_change(mean_a, mean_b, log=False):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = mean_a / mean_b
 
     # TODO: Properly handle this warrning in widgets
     # "Negative fold change scores were ignored. You should use another scoring method."
-    if np.any(scores < 0):
-        scores[scores < 0] = np.nan
+    scores = np.where(scores < 0, np.nan, scores)
+
+    with np.errstate(divide='ignore'):
+        return np.log2(scores) if log else scores
+
+
+def _prepare_groups(arrays, axis):
+    """ Return groups with samples in rows (csc sparse or dense float arrays) and whether the input was 1-D. """
+    if not 0 <= axis < 2:
+        raise ValueError("Axis")
+
+    if len(arrays) < 2:
+        raise TypeError("Need at least 2 groups")
+
+    sparse = any(sp.issparse(x) for x in arrays)
+    arrays = [sp.csc_matrix(x, dtype=float) if sparse else np.asarray(x, dtype=float) for x in arrays]
+    if any(x.ndim != arrays[0].ndim for x in arrays) or axis >= arrays[0].ndim:
+        raise ValueError("All arrays must have the same number of dimensions")
 
-    return np.log2(scores) if log else scores
+    one_dimensional = arrays[0].ndim == 1
+    if one_dimensional:
+        arrays = [x[:, np.newaxis] for x in arrays]
+    elif axis == 1:
+        arrays = [x.T.tocsc() if sparse else x.T for x in arrays]
+    return arrays, one_dimensional
+
+
+def _column_blocks(n_rows, n_columns, chunk_size=None):
+    """ Split columns into blocks of roughly 4M elements (or `chunk_size` columns). """
+    chunk_size = chunk_size or max(1, 2 ** 22 // max(n_rows, 1))
+    return [slice(start, start + chunk_size) for start in range(0, n_columns, chunk_size)]
+
+
+def _dense_block(x, columns):
+    return x[:, columns].toarray() if sp.issparse(x) else x[:, columns]
+
+
+def anova_from_statistics(counts, sums, sums_sq):
+    # type: (np.ndarray, np.ndarray, np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+    """ One-way ANOVA from the numbers of (non-missing) values, sums and sums of squares of groups.
+    Groups are stored along axis -2 (e.g. groups x genes), groups without values are ignored.
+
+    :return: (F statistics, p_values)
+    """
+    counts = np.asarray(counts, dtype=float)
+    present = counts > 0
+    n_groups = np.sum(present, axis=-2)
+    bign = np.sum(counts, axis=-2)
+    total = np.sum(sums, axis=-2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correction = total ** 2 / bign
+        sstot = np.sum(sums_sq, axis=-2) - correction
+        ssbn = np.sum(np.where(present, sums ** 2 / counts, 0), axis=-2) - correction
+        dfbn = n_groups - 1
+        dfwn = bign - n_groups
+        f = (ssbn / dfbn) / ((sstot - ssbn) / dfwn)
+        p_values = scipy.special.fdtrc(dfbn, dfwn, f)
+    return f, p_values
+
+
+def score_anova(*arrays, **kwargs):
+    """ Run one-way ANOVA on all genes at once.
+
+    Groups are processed in column blocks, without concatenating them. Missing values (NaN)
+    are ignored, i.e. each gene is tested on the number of its non-missing values in each group.
+
+    :param arrays: Dense or sparse (scipy.sparse) samples of each group
+    :param axis: Axis which holds the samples (default 0)
+    :param chunk_size: Number of genes processed at once
+
+    :return: (F statistics, p_values)
+
+    See also
+    --------
+    scipy.stats.f_oneway
+
+    """
+    arrays, one_dimensional = _prepare_groups(arrays, kwargs.get('axis', 0))
+    n_genes = arrays[0].shape[1]
+    counts, sums, sums_sq = (np.zeros((len(arrays), n_genes)) for _ in range(3))
+
+    for i, x in enumerate(arrays):
+        for columns in _column_blocks(x.shape[0], n_genes, kwargs.get('chunk_size', None)):
+            if sp.issparse(x):
+                block = x[:, columns]
+                data = block.data
+                missing = np.isnan(data)
+                block = sp.csc_matrix((np.where(missing, 0, data), block.indices, block.indptr), shape=block.shape)
+                data_columns = np.repeat(np.arange(block.shape[1]), np.diff(block.indptr))
+                counts[i, columns] = x.shape[0] - np.bincount(data_columns[missing], minlength=block.shape[1])
+                sums[i, columns] = np.asarray(block.sum(axis=0)).ravel()
+                sums_sq[i, columns] = np.asarray(block.multiply(block).sum(axis=0)).ravel()
+            else:
+                block = x[:, columns]
+                valid = np.isfinite(block)
+                block = np.where(valid, block, 0)
+                counts[i, columns] = np.sum(valid, axis=0)
+                sums[i, columns] = np.sum(block, axis=0)
+                sums_sq[i, columns] = np.sum(block * block, axis=0)
+
+    f, p_values = anova_from_statistics(counts, sums, sums_sq)
+    return (f[0], p_values[0]) if one_dimensional else (f, p_values)
+
+
+def kruskal_wallis_from_rank_sums(counts, rank_sums, ties):
+    # type: (np.ndarray, np.ndarray, np.ndarray) -> Tuple[np.ndarray, np.ndarray]
+    """ Kruskal-Wallis H-test from the numbers of (non-missing) values and sums of ranks of groups.
+    Groups are stored along axis -2 (e.g. groups x genes), groups without values are ignored.
+
+    :param ties: Tie correction term, sum(t**3 - t) over groups of tied values (see :func:`rank_columns`)
+
+    :return: (H statistics, p_values)
+    """
+    counts = np.asarray(counts, dtype=float)
+    present = counts > 0
+    bign = np.sum(counts, axis=-2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = np.sum(np.where(present, rank_sums ** 2 / counts, 0), axis=-2)
+        h = 12 / (bign * (bign + 1)) * h - 3 * (bign + 1)
+        h /= 1 - ties / (bign ** 3 - bign)
+    return h, scipy.stats.chi2.sf(h, np.sum(present, axis=-2) - 1)
+
+
+def score_kruskal_wallis(*arrays, **kwargs):
+    """ Run Kruskal-Wallis H-test on all genes at once.
+
+    Each block of genes is ranked once (with tie correction) over all groups. Missing
+    values (NaN) are ignored.
+
+    :param arrays: Dense or sparse (scipy.sparse) samples of each group
+    :param axis: Axis which holds the samples (default 0)
+    :param chunk_size: Number of genes ranked at once. Defaults to a value which
+        keeps the ranked block at roughly 4M elements.
+
+    :return: (H statistics, p_values)
+
+    See also
+    --------
+    scipy.stats.kruskal
+
+    """
+    arrays, one_dimensional = _prepare_groups(arrays, kwargs.get('axis', 0))
+    n_genes = arrays[0].shape[1]
+    sizes = [x.shape[0] for x in arrays]
+    bounds = np.cumsum([0] + sizes)
+    h, p_values = np.zeros(n_genes), np.ones(n_genes)
+
+    for columns in _column_blocks(bounds[-1], n_genes, kwargs.get('chunk_size', None)):
+        block = np.vstack([_dense_block(x, columns) for x in arrays])
+        valid = np.isfinite(block)
+        # missing values are ranked last and each forms its own group of ties
+        ranks, ties = rank_columns(block)
+        ranks[~valid] = 0
+
+        counts = np.array([np.sum(valid[start:end], axis=0) for start, end in zip(bounds, bounds[1:])])
+        rank_sums = np.array([np.sum(ranks[start:end], axis=0) for start, end in zip(bounds, bounds[1:])])
+        h[columns], p_values[columns] = kruskal_wallis_from_rank_sums(counts, rank_sums, ties)
+
+    return (h[0], p_values[0]) if one_dimensional else (h, p_values)
+
+
+#: Sufficient statistics of groups of samples (rows), see :func:`group_statistics`.
+GroupStatistics = namedtuple('GroupStatistics', ['counts', 'sums', 'sums_sq', 'nonzero', 'expressed'])
+
+
+def group_statistics(x, groups, n_groups=None, threshold=1):
+    # type: (Union[np.ndarray, sp.spmatrix], np.ndarray, Union[int, None], float) -> GroupStatistics
+    """ Compute sufficient statistics of each group of rows of `x` in one pass over the matrix.
+
+    Pairwise t-tests, fold changes and hypergeometric tests between any groups (or unions of groups)
+    can then be computed from the aggregates, without slicing the expression matrix again.
+
+    :param x: Dense or sparse (scipy.sparse) matrix (samples x genes)
+    :param groups: Group index of each row. Rows with a negative index are skipped.
+    :param n_groups: Number of groups (default ``max(groups) + 1``)
+    :param threshold: Expression threshold used to count expressing samples (as in hypergeometric test)
+
+    :return: counts (n_groups, ), sums, sums of squares, non-zero counts and counts of values above
+             the threshold (n_groups x genes)
+    """
+    groups = np.asarray(groups, dtype=int)
+    n_groups = groups.max() + 1 if n_groups is None else n_groups
+    rows = np.flatnonzero(groups >= 0)
+    indicator = sp.csr_matrix((np.ones(len(rows)), (groups[rows], rows)), shape=(n_groups, x.shape[0]))
+    counts = np.bincount(groups[rows], minlength=n_groups)
+
+    if sp.issparse(x):
+        x = sp.csr_matrix(x, dtype=float)
+
+        def aggregate(data):
+            values = sp.csr_matrix((data, x.indices, x.indptr), shape=x.shape)
+            return np.asarray((indicator @ values).todense())
+
+        sums, sums_sq = aggregate(x.data), aggregate(x.data ** 2)
+        nonzero = aggregate((x.data != 0).astype(float))
+        if threshold > 0:
+            expressed = aggregate((x.data >= threshold).astype(float))
+        else:
+            # implicit zeros are above the threshold
+            expressed = counts[:, np.newaxis] - aggregate((x.data < threshold).astype(float))
+        return GroupStatistics(counts, sums, sums_sq, nonzero, expressed)
+
+    x = np.asarray(x, dtype=float)
+    sums, sums_sq, nonzero, expressed = (np.zeros((n_groups, x.shape[1])) for _ in range(4))
+    # process the matrix in row blocks to bound the size of temporary arrays
+    chunk_size = max(1, 2 ** 22 // max(x.shape[1], 1))
+    for start in range(0, x.shape[0], chunk_size):
+        block, block_indicator = x[start:start + chunk_size], indicator[:, start:start + chunk_size]
+        sums += block_indicator @ block
+        sums_sq += block_indicator @ (block * block)
+        nonzero += block_indicator @ (block != 0).astype(float)
+        expressed += block_indicator @ (block >= threshold).astype(float)
+    return GroupStatistics(counts, sums, sums_sq, nonzero, expressed)
+
+
+def _statistics_moments(stats):
+    # type: (GroupStatistics) -> Tuple[np.ndarray, np.ndarray, np.ndarray]
+    n = np.asarray(stats.counts, dtype=float)[..., np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = stats.sums / n
+        var = np.maximum(stats.sums_sq - stats.sums * mean, 0) / (n - 1)
+    return n, mean, var
+
+
+def t_test_from_statistics(a, b, alternative=ALT_TWO):
+    # type: (GroupStatistics, GroupStatistics, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Run t-test (see :func:`score_t_test`) on groups described by sufficient statistics.
+    Statistics of `a` and `b` can have any (broadcastable) leading dimensions.
+
+    :return: (statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    return _t_test(*_statistics_moments(a), *_statistics_moments(b), alternative=alternative)
+
+
+def welch_t_test_from_statistics(a, b, alternative=ALT_TWO):
+    # type: (GroupStatistics, GroupStatistics, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Run Welch's t-test (see :func:`score_welch_t_test`) on groups described by sufficient statistics.
+    Statistics of `a` and `b` can have any (broadcastable) leading dimensions.
+
+    :return: (statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    return _welch_t_test(*_statistics_moments(a), *_statistics_moments(b), alternative=alternative)
+
+
+def moderated_t_test_from_statistics(a, b, alternative=ALT_TWO):
+    # type: (GroupStatistics, GroupStatistics, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Run moderated t-test (see :func:`score_moderated_t_test`) on groups described by sufficient
+    statistics. Statistics of `a` and `b` can have any (broadcastable) leading dimensions, the prior
+    is estimated separately for each comparison (over genes on the last axis).
+
+    :return: (statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    return _moderated_t_test(*_statistics_moments(a), *_statistics_moments(b), alternative=alternative)
+
+
+def fold_change_from_statistics(a, b, log=False):
+    # type: (GroupStatistics, GroupStatistics, bool) -> np.ndarray
+    """ Calculate the fold change (see :func:`score_fold_change`) between groups described by
+    sufficient statistics.
+    """
+    _, mean_a, _ = _statistics_moments(a)
+    _, mean_b, _ = _statistics_moments(b)
+    return _fold_change(mean_a, mean_b, log=log)
+
+
+def hypergeometric_test_from_statistics(a, b, alternative=ALT_TWO):
+    # type: (GroupStatistics, GroupStatistics, str) -> Tuple[np.ndarray, np.ndarray]
+    """ Run hypergeometric test (see :func:`score_hypergeometric_test`) on groups described by
+    sufficient statistics. The expression threshold is the one used in :func:`group_statistics`.
+
+    :return: (statistics, p_values)
+    """
+    assert alternative in ALTERNATIVES
+    return _hypergeometric_test(np.asarray(a.counts)[..., np.newaxis], a.expressed,
+                                np.asarray(b.counts)[..., np.newaxis], b.expressed, alternative=alternative)
 
 
 def _lngamma(z):
@@ -145,6 +683,55 @@ def _lngamma(z):
     return math.log(x) - 5.58106146679532777 - z + (z - 0.5) * math.log(z + 6.5)
         
 
+def _log_binomial(n, k):
+    return scipy.special.gammaln(n + 1) - scipy.special.gammaln(k + 1) - scipy.special.gammaln(n - k + 1)
+
+
+def _hypergeometric_pmf_sum(start, stop, N, m, n, step):
+    """ Sum hypergeometric probabilities of `start`, `start + step`, ... up to `stop` (inclusive).
+
+    Consecutive probabilities are computed with the recurrence between them; the summation stops early when
+    the terms become negligible (they decrease monotonically away from the mode).
+    """
+    term = np.exp(_log_binomial(m, start) + _log_binomial(N - m, n - start) - _log_binomial(N, n))
+    total = term.copy()
+    i = start.copy()
+    active = np.flatnonzero(i != stop)
+    while active.size:
+        ia, Na, ma, na = i[active], N[active], m[active], n[active]
+        if step > 0:
+            ratio = (ma - ia) * (na - ia) / ((ia + 1) * (Na - ma - na + ia + 1))
+        else:
+            ratio = ia * (Na - ma - na + ia) / ((ma - ia + 1) * (na - ia + 1))
+        t = term[active] * ratio
+        i[active] = ia + step
+        term[active] = t
+        total[active] += t
+        active = active[(i[active] != stop[active]) & (t > total[active] * 1e-17)]
+    return total
+
+
+def hypergeometric_sf(k, N, m, n):
+    """ Return the probabilities that `k` or more of `n` draws (without replacement) from a population of `N`
+    with `m` successes are successes; a vectorized (and for large arrays much faster) equivalent of
+    `scipy.stats.hypergeom.sf(k - 1, N, m, n)`.
+
+    The shorter tail (from `k` up or from `k - 1` down, depending on the mode) is summed.
+    """
+    k, N, m, n = (a.astype(float) for a in np.broadcast_arrays(k, N, m, n))
+    low, high = np.maximum(0, n + m - N), np.minimum(n, m)
+    p = (k <= low).astype(float)
+
+    inside = (k > low) & (k <= high)
+    upper = inside & (k > np.floor((n + 1) * (m + 1) / (N + 2)))
+    lower = inside & ~upper
+    if upper.any():
+        p[upper] = _hypergeometric_pmf_sum(k[upper], high[upper], N[upper], m[upper], n[upper], 1)
+    if lower.any():
+        p[lower] = 1 - _hypergeometric_pmf_sum(k[lower] - 1, low[lower], N[lower], m[lower], n[lower], -1)
+    return np.clip(p, 0, 1)
+
+
 class LogBin(object):
     _max = 2
     _lookup = [0.0, 0.0]
@@ -229,6 +816,12 @@ class Binomial(LogBin):
             else:
                 return value
 
+    def p_values(self, k, N, m, n):
+        """ Vectorized :func:`p_value`: the probabilities that `k` or more tests are positive for arrays
+        of `k`, `N`, `m` and `n`. """
+        k, N, m, n = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (k, N, m, n)))
+        return scipy.stats.binom.sf(k - 1, n, m / N)
+
 
 class Hypergeometric(LogBin):
     """ `Hypergeometric distribution <http://en.wikipedia.org/wiki/Hypergeometric_distribution>`_ is
@@ -269,17 +862,123 @@ class Hypergeometric(LogBin):
             else:
                 return value
 
+    def p_values(self, k, N, m, n):
+        """ Vectorized :func:`p_value`: the probabilities that `k` or more tests are positive for arrays
+        of `k`, `N`, `m` and `n`. """
+        return hypergeometric_sf(k, N, m, n)
+
+
+# Euler-Mascheroni constant, used to approximate harmonic numbers for large m
+# (sum([1/i for i in range(1, m+1)]) ~ log(m) + 0.5772... + 1/(2m))
+_EULER_GAMMA = 0.57721566490153286060651209008240243104215933593992
+_HARMONIC_EXACT_LIMIT = 100000
+
+
+def _harmonic_numbers(m):
+    # type: (np.ndarray) -> np.ndarray
+    """ Return the m-th harmonic number for each element of `m`. """
+    m = np.asarray(m, dtype=float)
+    h = np.zeros_like(m)
+    exact = (m >= 1) & (m < _HARMONIC_EXACT_LIMIT)
+    if np.any(exact):
+        table = np.cumsum(1.0 / np.arange(1, int(m[exact].max()) + 1))
+        h[exact] = table[m[exact].astype(int) - 1]
+    large = m >= _HARMONIC_EXACT_LIMIT
+    h[large] = np.log(m[large]) + _EULER_GAMMA + 0.5 / m[large]
+    return h
+
+
+def _sort_p_values(p_values, axis, ordered=False):
+    """ Move `axis` to the end and sort p-values along it (NaNs are sorted last).
+
+    :return: (moved p-values, sort order or None, sorted p-values, number of non-NaN p-values)
+    """
+    p_values = np.moveaxis(np.asarray(p_values, dtype=float), axis, -1)
+    if ordered:
+        order, sorted_p = None, p_values
+    else:
+        order = np.argsort(p_values, axis=-1)
+        sorted_p = np.take_along_axis(p_values, order, axis=-1)
+    n_valid = np.count_nonzero(~np.isnan(p_values), axis=-1)[..., np.newaxis]
+    return p_values, order, sorted_p, n_valid
+
 
-# to speed-up FDR, calculate ahead sum([1/i for i in range(1, m+1)]), for m in [1,100000].
-# For higher values of m use an approximation, with error less or equal to
-# 4.99999157277e-006. (sum([1/i for i in range(1, m+1)])  ~ log(m) + 0.5772..., 0.5572 is an Euler-Mascheroni constant)
-c = [1.0]
-for m in range(2, 100000):
-    c.append(c[-1] + 1.0/m)
+def _unsort_p_values(adjusted, order, axis):
+    if order is not None:
+        unsorted = np.empty_like(adjusted)
+        np.put_along_axis(unsorted, order, adjusted, axis=-1)
+        adjusted = unsorted
+    return np.moveaxis(adjusted, -1, axis)
 
 
-def is_sorted(l):
-    return all(l[i] <= l[i+1] for i in range(len(l)-1))
+def false_discovery_rate(p_values, dependent=False, m=None, axis=-1, ordered=False):
+    # type: (np.ndarray, bool, Union[int, None], int, bool) -> np.ndarray
+    """ Benjamini-Hochberg (or Benjamini-Yekutieli if `dependent`) `False Discovery Rate
+    <http://en.wikipedia.org/wiki/False_discovery_rate>`_ correction of p-values.
+
+    NaN p-values are ignored: they are not counted as tested hypotheses and remain NaN in the result.
+
+    :param p_values: an array of p-values.
+    :param dependent: use correction for dependent hypotheses (default False).
+    :param m: number of hypotheses tested (default the number of non-NaN p-values along `axis`).
+    :param axis: axis along which the hypotheses are stored.
+    :param ordered: p-values are already sorted along `axis` (default False).
+
+    :return: FDR adjusted p-values with the same shape as `p_values`
+    """
+    p_values, order, sorted_p, n_valid = _sort_p_values(p_values, axis, ordered)
+    m = n_valid if m is None else np.full(n_valid.shape, m, dtype=float)
+
+    if dependent:  # correct q for dependent tests
+        m = m * _harmonic_numbers(m)
+
+    ranks = np.arange(1, sorted_p.shape[-1] + 1)
+    with np.errstate(invalid='ignore'):
+        fdrs = sorted_p * m / ranks
+    # enforce monotonicity (fmin skips the NaNs sorted to the end)
+    fdrs = np.fmin.accumulate(fdrs[..., ::-1], axis=-1)[..., ::-1]
+    fdrs = np.minimum(fdrs, 1.0)
+    fdrs[np.isnan(sorted_p)] = np.nan
+    return _unsort_p_values(fdrs, order, axis)
+
+
+def holm_correction(p_values, m=None, axis=-1):
+    # type: (np.ndarray, Union[int, None], int) -> np.ndarray
+    """ `Holm-Bonferroni <https://en.wikipedia.org/wiki/Holm%E2%80%93Bonferroni_method>`_ correction of p-values.
+
+    :param p_values: an array of p-values.
+    :param m: number of hypotheses tested (default the number of non-NaN p-values along `axis`).
+    :param axis: axis along which the hypotheses are stored.
+
+    :return: adjusted p-values with the same shape as `p_values`
+    """
+    p_values, order, sorted_p, n_valid = _sort_p_values(p_values, axis)
+    m = n_valid if m is None else np.full(n_valid.shape, m, dtype=float)
+
+    ranks = np.arange(sorted_p.shape[-1])
+    with np.errstate(invalid='ignore'):
+        adjusted = sorted_p * (m - ranks)
+    adjusted = np.fmax.accumulate(adjusted, axis=-1)
+    adjusted = np.minimum(adjusted, 1.0)
+    adjusted[np.isnan(sorted_p)] = np.nan
+    return _unsort_p_values(adjusted, order, axis)
+
+
+def bonferroni_correction(p_values, m=None, axis=-1):
+    # type: (np.ndarray, Union[int, None], int) -> np.ndarray
+    """ `Bonferroni <http://en.wikipedia.org/wiki/Bonferroni_correction>`_ correction of p-values.
+
+    :param p_values: an array of p-values.
+    :param m: number of hypotheses tested (default the number of non-NaN p-values along `axis`).
+    :param axis: axis along which the hypotheses are stored.
+
+    :return: adjusted p-values with the same shape as `p_values`
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    if m is None:
+        m = np.count_nonzero(~np.isnan(p_values), axis=axis)
+        m = np.expand_dims(m, axis) if p_values.ndim else m
+    return np.minimum(p_values * m, 1.0)
 
 
 def FDR(p_values, dependent=False, m=None, ordered=False):
@@ -289,41 +988,18 @@ def FDR(p_values, dependent=False, m=None, ordered=False):
     :param dependent: use correction for dependent hypotheses (default False).
     :param m: number of hypotheses tested (default ``len(p_values)``).
     :param ordered: prevent sorting of p-values if they are already sorted (default False).
-    """
-
-    if not ordered:
-        ordered = is_sorted(p_values)
 
-    if not ordered:
-        joined = [(v, i) for i, v in enumerate(p_values)]
-        joined.sort()
-        p_values = [p[0] for p in joined]
-        indices = [p[1] for p in joined]
+    .. seealso:: :func:`false_discovery_rate`
+    """
+    if isinstance(p_values, np.ndarray):
+        return false_discovery_rate(p_values, dependent=dependent, m=m, ordered=ordered)
 
     if not m:
         m = len(p_values)
     if m <= 0 or not p_values:
         return []
 
-    if dependent: # correct q for dependent tests
-        k = c[m-1] if m <= len(c) else math.log(m) + 0.57721566490153286060651209008240243104215933593992
-        m = m * k
-
-    tmp_fdrs = [p*m/(i+1.0) for (i, p) in enumerate(p_values)]
-    fdrs = []
-    cmin = tmp_fdrs[-1]
-    for f in reversed(tmp_fdrs):
-        cmin = min(f, cmin)
-        fdrs.append( cmin)
-    fdrs.reverse()
-
-    if not ordered:
-        new = [None] * len(fdrs)
-        for v, i in zip(fdrs, indices):
-            new[i] = v
-        fdrs = new
-
-    return fdrs
+    return false_discovery_rate(p_values, dependent=dependent, m=m, ordered=ordered).tolist()
 
 
 def Bonferroni(p_values, m=None):
@@ -337,4 +1013,4 @@ def Bonferroni(p_values, m=None):
     if m == 0:
         return []
     m = float(m)
-    return [p/m for p in p_values]
+    return (np.asarray(p_values, dtype=float) / m).tolist()
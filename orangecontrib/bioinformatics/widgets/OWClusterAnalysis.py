@@ -2,6 +2,7 @@
 import sys
 import itertools
 import numpy as np
+import scipy.sparse as sp
 
 from AnyQt.QtWidgets import (
     QTableView, QHeaderView, QHBoxLayout,
@@ -14,7 +15,7 @@ from AnyQt.QtCore import (
 from scipy.stats import rankdata
 
 from Orange.widgets.gui import (
-    vBox, widgetBox, widgetLabel, spin, doubleSpin, comboBox, listView, auto_commit
+    vBox, widgetBox, widgetLabel, spin, doubleSpin, comboBox, listView, auto_commit, checkBox
 )
 from Orange.widgets.widget import OWWidget, Msg
 from Orange.widgets.settings import Setting, ContextSetting, DomainContextHandler, PerfectDomainContextHandler, vartype
@@ -26,9 +27,12 @@ from Orange.data import StringVariable, DiscreteVariable, ContinuousVariable, Ta
 from orangecontrib.bioinformatics.widgets.utils.data import (
     TAX_ID, GENE_AS_ATTRIBUTE_NAME, GENE_ID_COLUMN, GENE_ID_ATTRIBUTE
 )
+from orangecontrib.bioinformatics.utils import process_count
 from orangecontrib.bioinformatics.utils.statistics import score_hypergeometric_test
 from orangecontrib.bioinformatics.widgets.utils.gui import HTMLDelegate, GeneSetsSelection, GeneScoringWidget
-from orangecontrib.bioinformatics.cluster_analysis import Cluster, ClusterModel, DISPLAY_GENE_SETS_COUNT
+from orangecontrib.bioinformatics.cluster_analysis import (
+    Cluster, ClusterModel, DISPLAY_GENE_SETS_COUNT, AGGREGATIONS
+)
 from orangecontrib.bioinformatics.geneset.utils import GeneSetException
 from orangecontrib.bioinformatics.ncbi.gene.config import NCBI_ID
 
@@ -82,7 +86,9 @@ class OWClusterAnalysis(OWWidget):
 
     scoring_method_selection = ContextSetting(0)
     scoring_method_design = ContextSetting(0)
+    scoring_aggregation = ContextSetting(0)
     scoring_test_type = ContextSetting(0)
+    use_processes = Setting(False)
 
     # genes filter
     max_gene_count = Setting(20)
@@ -167,7 +173,11 @@ class OWClusterAnalysis(OWWidget):
         self.gene_scoring = GeneScoringWidget(box, self)
         self.gene_scoring.set_method_selection_area('scoring_method_selection')
         self.gene_scoring.set_method_design_area('scoring_method_design')
+        self.gene_scoring.set_aggregation_area('scoring_aggregation', AGGREGATIONS,
+                                               callback=self.aggregation_changed)
         self.gene_scoring.set_test_type('scoring_test_type')
+        checkBox(box, self, 'use_processes', 'Use multiple processes',
+                 tooltip='Score clusters in parallel worker processes (Mann-Whitney test only)')
 
         # Gene Sets widget
         gene_sets_box = widgetBox(self.controlArea, "Gene Sets")
@@ -388,7 +398,12 @@ class OWClusterAnalysis(OWWidget):
         method = self.gene_scoring.get_selected_method()
         try:
             if method.score_function == score_hypergeometric_test:
-                values = set(np.unique(self.input_data.X))
+                table_x = self.input_data.X
+                if sp.issparse(table_x):
+                    # implicit zeros are not stored in sparse matrices
+                    values = set(np.unique(table_x.data)) | {0}
+                else:
+                    values = set(np.unique(table_x))
                 if (0 not in values) or (len(values) != 2):
                     raise ValueError('Binary data expected (use Preprocess)')
 
@@ -397,7 +412,9 @@ class OWClusterAnalysis(OWWidget):
                                                 rows_by_cluster=self.rows_by_cluster,
                                                 rows_by_batch=self.rows_by_batch,
                                                 method=method,
-                                                alternative=test_type)
+                                                alternative=test_type,
+                                                aggregation=AGGREGATIONS[self.scoring_aggregation],
+                                                processes=process_count() if self.use_processes else None)
         except ValueError as e:
             self.Warning.gene_enrichment(str(e), 'p-values are set to 1')
 
@@ -443,6 +460,17 @@ class OWClusterAnalysis(OWWidget):
             self.__gene_enrichment()
             self.__update_info_box()
 
+    def aggregation_changed(self):
+        if self.cluster_info_model is None:
+            return
+
+        if self.cluster_info_model.scoring_in_progress:
+            self.invalidate(cluster_init=False)
+        else:
+            # genes are already scored, aggregate them differently
+            self.cluster_info_model.apply_aggregation(AGGREGATIONS[self.scoring_aggregation])
+            self.filter_genes()
+
     def batch_indicator_changed(self):
         self.invalidate(cluster_init=False)
 
@@ -614,13 +642,14 @@ class OWClusterAnalysis(OWWidget):
 
         data = []
         for cluster in selected_clusters:
-            num_of_genes = len(cluster.filtered_genes)
-
-            scores = [gene.score for gene in cluster.filtered_genes]
-            p_vals = [gene.p_val for gene in cluster.filtered_genes]
-            fdr_vals = [gene.fdr for gene in cluster.filtered_genes]
-            gene_names = [gene.input_name for gene in cluster.filtered_genes]
-            gene_ids = [gene.ncbi_id for gene in cluster.filtered_genes]
+            filtered = cluster.filtered_gene_indices
+            num_of_genes = len(filtered)
+
+            scores = cluster.scores[filtered]
+            p_vals = cluster.p_values[filtered]
+            fdr_vals = cluster.fdr_values[filtered]
+            gene_names = cluster.gene_names[filtered]
+            gene_ids = cluster.gene_ids[filtered]
             rank = rankdata(p_vals, method='min')
 
             if len(self.new_cluster_profile):
@@ -651,12 +680,13 @@ class OWClusterAnalysis(OWWidget):
 
         data = []
         for cluster in selected_clusters:
-            num_of_sets = len(cluster.filtered_gene_sets)
+            filtered = cluster.filtered_gene_set_indices
+            num_of_sets = len(filtered)
 
-            p_vals = [gs.p_val for gs in cluster.filtered_gene_sets]
-            fdr_vals = [gs.fdr for gs in cluster.filtered_gene_sets]
-            gs_names = [gs.name for gs in cluster.filtered_gene_sets]
-            gs_ids = [gs.gs_id for gs in cluster.filtered_gene_sets]
+            p_vals = cluster.gene_set_p_values[filtered]
+            fdr_vals = cluster.gene_set_fdr_values[filtered]
+            gs_names = cluster.gene_set_names[filtered]
+            gs_ids = cluster.gene_set_ids[filtered]
             rank = rankdata(p_vals, method='min')
 
             if len(self.new_cluster_profile):
@@ -685,7 +715,7 @@ class OWClusterAnalysis(OWWidget):
             cluster = sel_row.data()
             selected_clusters.append(cluster)
             selected_cluster_indexes.add(cluster.index)
-            [selected_cluster_genes.add(gene.ncbi_id) for gene in cluster.filtered_genes]
+            selected_cluster_genes.update(cluster.gene_ids[cluster.filtered_gene_indices])
 
         # get columns of selected clusters
         selected_columns = [column for column in self.input_data.domain.attributes
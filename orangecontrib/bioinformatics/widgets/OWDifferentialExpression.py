@@ -1,11 +1,14 @@
 """ Differential Gene Expression """
 import sys
+import hashlib
 import numpy as np
 import pyqtgraph as pg
-import scipy.special
 import scipy.stats
+import scipy.sparse
 import Orange.data
 
+from collections import OrderedDict
+
 from types import SimpleNamespace as namespace
 from AnyQt.QtGui import (
     QStandardItemModel, QPen
@@ -23,6 +26,7 @@ from Orange.widgets.utils.datacaching import data_hints
 from orangecontrib.bioinformatics.widgets.utils.settings import SetContextHandler
 from orangecontrib.bioinformatics.widgets.utils import gui as guiutils
 from orangecontrib.bioinformatics.widgets.utils.data import GENE_AS_ATTRIBUTE_NAME
+from orangecontrib.bioinformatics.utils import statistics, SharedArrays, process_count, process_pool
 from orangecontrib.bioinformatics.utils.statistics import score_hypergeometric_test
 
 
@@ -86,35 +90,39 @@ def score_ttest_p(a, b, **kwargs):
     return P
 
 
-def score_anova(*arrays, **kwargs):
+def score_welch_ttest_t(a, b, **kwargs):
     axis = kwargs.get('axis', 0)
-    F, P = f_oneway(*arrays, axis=axis)
-    return F, P
+    T, _ = statistics.score_welch_t_test(a, b, axis=axis)
+    return T
 
 
-def score_anova_(*arrays, **kwargs):
+def score_welch_ttest_p(a, b, **kwargs):
     axis = kwargs.get('axis', 0)
-    arrays = [np.asarray(arr, dtype=float) for arr in arrays]
+    _, P = statistics.score_welch_t_test(a, b, axis=axis)
+    return P
 
-    if not len(arrays) > 1:
-        raise TypeError("Need at least 2 positional arguments")
 
-    if not 0 <= axis < 2:
-        raise ValueError("0 <= axis < 2")
+def score_moderated_ttest_t(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    T, _ = statistics.score_moderated_t_test(a, b, axis=axis)
+    return T
 
-    if not all(arrays[i].ndim == arrays[i + 1].ndim
-               for i in range(len(arrays) - 2)):
-        raise ValueError("All arrays must have the same number of dimensions")
 
-    if axis >= arrays[0].ndim:
-        raise ValueError()
+def score_moderated_ttest_p(a, b, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = statistics.score_moderated_t_test(a, b, axis=axis)
+    return P
+
+
+def score_anova(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    F, P = f_oneway(*arrays, axis=axis)
+    return F, P
 
-    if axis == 0:
-        arrays = [arr.T for arr in arrays]
 
-    scores = [scipy.stats.f_oneway(*ars) for ars in zip(*arrays)]
-    F, P = zip(*scores)
-    return np.array(F, dtype=float), np.array(P, dtype=float)
+def score_anova_(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    return statistics.score_anova(*arrays, axis=axis)
 
 
 def f_oneway(*arrays, **kwargs):
@@ -123,7 +131,7 @@ def f_oneway(*arrays, **kwargs):
 
     Like `scipy.stats.f_oneway` but accept 2D arrays, with `axis`
     specifying over which axis to operate (in which axis the samples
-    are stored).
+    are stored). Missing values are ignored.
 
     Parameters
     ----------
@@ -142,27 +150,10 @@ def f_oneway(*arrays, **kwargs):
     See also
     --------
     scipy.stats.f_oneway
+    orangecontrib.bioinformatics.utils.statistics.score_anova
     """
     axis = kwargs.get('axis', 0)
-    arrays = [np.asarray(a, dtype=float) for a in arrays]
-    alldata = np.concatenate(arrays, axis)
-    bign = alldata.shape[axis]
-    sstot = np.sum(alldata ** 2, axis) - (np.sum(alldata, axis) ** 2) / bign
-
-    ssarrays = [(np.sum(a, axis, keepdims=True) ** 2) / a.shape[axis]
-                for a in arrays]
-    ssbn = np.sum(np.concatenate(ssarrays, axis), axis)
-    ssbn -= (np.sum(alldata, axis) ** 2) / bign
-    assert sstot.shape == ssbn.shape
-
-    sswn = sstot - ssbn
-    dfbn = len(arrays) - 1
-    dfwn = bign - len(arrays)
-    msb = ssbn / dfbn
-    msw = sswn / dfwn
-    f = msb / msw
-    prob = scipy.special.fdtrc(dfbn, dfwn, f)
-    return f, prob
+    return statistics.score_anova(*arrays, axis=axis)
 
 
 def score_anova_f(*arrays, **kwargs):
@@ -177,6 +168,23 @@ def score_anova_p(*arrays, **kwargs):
     return P
 
 
+def score_kruskal_wallis(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    return statistics.score_kruskal_wallis(*arrays, axis=axis)
+
+
+def score_kruskal_wallis_h(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    H, _ = score_kruskal_wallis(*arrays, axis=axis)
+    return H
+
+
+def score_kruskal_wallis_p(*arrays, **kwargs):
+    axis = kwargs.get('axis', 0)
+    _, P = score_kruskal_wallis(*arrays, axis=axis)
+    return P
+
+
 def score_signal_to_noise(a, b, **kwargs):
     axis = kwargs.get('axis', 0)
     mean_a = np.nanmean(a, axis=axis)
@@ -189,6 +197,18 @@ def score_signal_to_noise(a, b, **kwargs):
 
 
 def score_mann_whitney(a, b, **kwargs):
+    """
+    Mann-Whitney U test (vectorized over all genes) with the semantics of
+    the former default of `scipy.stats.mannwhitneyu` (``alternative=None``).
+
+    Returns
+    -------
+    U : array
+        The smaller of the two U statistics (low values are significant)
+    P : array
+        One sided P values (normal approximation with tie and continuity
+        correction)
+    """
     axis = kwargs.get('axis', 0)
     a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
 
@@ -201,12 +221,22 @@ def score_mann_whitney(a, b, **kwargs):
     if axis >= a.ndim:
         raise ValueError
 
-    if axis == 0:
+    if a.ndim == 1:
+        a, b = a[:, np.newaxis], b[:, np.newaxis]
+    elif axis == 1:
         a, b = a.T, b.T
 
-    res = [scipy.stats.mannwhitneyu(a_, b_) for a_, b_ in zip(a, b)]
-    U, P = zip(*res)
-    return np.array(U), np.array(P)
+    n1, n2 = a.shape[0], b.shape[0]
+    n = n1 + n2
+    ranks, ties = statistics.rank_columns(np.vstack((a, b)))
+    u1 = np.sum(ranks[:n1], axis=0) - n1 * (n1 + 1) / 2.0
+    u2 = n1 * n2 - u1
+    sd = np.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.abs((np.maximum(u1, u2) - (n1 * n2 / 2.0 + 0.5)) / sd)
+    P = scipy.stats.norm.sf(z)
+    P[sd == 0] = 1.0
+    return np.minimum(u1, u2), P
 
 
 def score_mann_whitney_u(a, b, **kwargs):
@@ -236,6 +266,364 @@ def hypergeometric_test_score(*args, **kwargs):
     return scores
 
 
+def _moment_arrays(X, **kwargs):
+    """
+    Sample values and their squares, with missing values replaced by 0,
+    and a mask of present values (None if no values are missing).
+    """
+    valid = np.isfinite(X)
+    if valid.all():
+        return {'valid': None, 'values': X, 'squares': X * X}
+    X = np.where(valid, X, 0)
+    return {'valid': valid.astype(float), 'values': X, 'squares': X * X}
+
+
+def _raw_moment_arrays(X, **kwargs):
+    """ Sample values and their squares (missing values propagate into the sums of their groups). """
+    return {'values': X, 'squares': X * X}
+
+
+def _rank_arrays(X, **kwargs):
+    """ Per gene ranks (0 for missing values), tie terms and a mask of present values. """
+    valid = np.isfinite(X)
+    ranks, ties = statistics.rank_columns(X)
+    ranks[~valid] = 0
+    return {'valid': valid.astype(float), 'ranks': ranks, 'ties': ties}
+
+
+def _mann_whitney_arrays(X, **kwargs):
+    ranks, _ = statistics.rank_columns(X)
+    return {'ranks': ranks}
+
+
+def _expressed_arrays(X, **kwargs):
+    return {'expressed': (X >= kwargs.get('treshold', 1)).astype(float)}
+
+
+def _group_moments(arrays, group_sums, group_sizes, omit_nan=False):
+    """
+    Per group counts, means and variances (ddof=1) of (P, K, M) shape.
+
+    NaN values are omitted if `omit_nan`, otherwise they are propagated
+    into the moments of the group.
+    """
+    sizes = group_sizes[:, np.newaxis]
+    valid = arrays['valid']
+    n = sizes if valid is None else group_sums(valid)
+
+    sums = group_sums(arrays['values'])
+    sums_sq = group_sums(arrays['squares'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / n
+        var = np.maximum(sums_sq - sums * mean, 0) / (n - 1)
+
+    if not omit_nan and valid is not None:
+        incomplete = n < sizes
+        mean[incomplete] = np.nan
+        var[incomplete] = np.nan
+        n = sizes
+    return np.broadcast_to(n, mean.shape), mean, var
+
+
+def _permuted_fold_change(arrays, group_sums, group_sizes, **kwargs):
+    _, mean, _ = _group_moments(arrays, group_sums, group_sizes, omit_nan=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = mean[:, 0] / mean[:, 1]
+    res[res < 0] = float("nan")
+    return res
+
+
+def _permuted_log_fold_change(arrays, group_sums, group_sizes, **kwargs):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log2(_permuted_fold_change(arrays, group_sums, group_sizes))
+
+
+def _permuted_ttest(arrays, group_sums, group_sizes, **kwargs):
+    n, mean, var = _group_moments(arrays, group_sums, group_sizes)
+    n_a, n_b = n[:, 0], n[:, 1]
+    df = n_a + n_b - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pooled_var = ((n_a - 1) * var[:, 0] + (n_b - 1) * var[:, 1]) / df
+        T = (mean[:, 0] - mean[:, 1]) / np.sqrt(pooled_var * (1 / n_a + 1 / n_b))
+    return T, 2 * scipy.stats.t.sf(np.abs(T), df)
+
+
+def _permuted_ttest_t(arrays, group_sums, group_sizes, **kwargs):
+    return _permuted_ttest(arrays, group_sums, group_sizes)[0]
+
+
+def _permuted_ttest_p(arrays, group_sums, group_sizes, **kwargs):
+    return _permuted_ttest(arrays, group_sums, group_sizes)[1]
+
+
+def _permuted_group_statistics(arrays, group_sums, group_sizes):
+    sums, sums_sq = group_sums(arrays['values']), group_sums(arrays['squares'])
+    return [statistics.GroupStatistics(size, sums[:, i], sums_sq[:, i], None, None)
+            for i, size in enumerate(group_sizes)]
+
+
+def _permuted_welch_ttest_t(arrays, group_sums, group_sizes, **kwargs):
+    return statistics.welch_t_test_from_statistics(*_permuted_group_statistics(arrays, group_sums, group_sizes))[0]
+
+
+def _permuted_welch_ttest_p(arrays, group_sums, group_sizes, **kwargs):
+    return statistics.welch_t_test_from_statistics(*_permuted_group_statistics(arrays, group_sums, group_sizes))[1]
+
+
+def _permuted_moderated_ttest_t(arrays, group_sums, group_sizes, **kwargs):
+    return statistics.moderated_t_test_from_statistics(
+        *_permuted_group_statistics(arrays, group_sums, group_sizes))[0]
+
+
+def _permuted_moderated_ttest_p(arrays, group_sums, group_sizes, **kwargs):
+    return statistics.moderated_t_test_from_statistics(
+        *_permuted_group_statistics(arrays, group_sums, group_sizes))[1]
+
+
+def _permuted_anova(arrays, group_sums, group_sizes, **kwargs):
+    sums = group_sums(arrays['values'])
+    valid = arrays['valid']
+    counts = np.broadcast_to(group_sizes[:, np.newaxis], sums.shape) if valid is None else group_sums(valid)
+    return statistics.anova_from_statistics(counts, sums, group_sums(arrays['squares']))
+
+
+def _permuted_anova_f(arrays, group_sums, group_sizes, **kwargs):
+    return _permuted_anova(arrays, group_sums, group_sizes)[0]
+
+
+def _permuted_anova_p(arrays, group_sums, group_sizes, **kwargs):
+    return _permuted_anova(arrays, group_sums, group_sizes)[1]
+
+
+def _permuted_kruskal_wallis(arrays, group_sums, group_sizes, **kwargs):
+    return statistics.kruskal_wallis_from_rank_sums(
+        group_sums(arrays['valid']), group_sums(arrays['ranks']), arrays['ties'])
+
+
+def _permuted_kruskal_wallis_h(arrays, group_sums, group_sizes, **kwargs):
+    return _permuted_kruskal_wallis(arrays, group_sums, group_sizes)[0]
+
+
+def _permuted_kruskal_wallis_p(arrays, group_sums, group_sizes, **kwargs):
+    return _permuted_kruskal_wallis(arrays, group_sums, group_sizes)[1]
+
+
+def _permuted_signal_to_noise(arrays, group_sums, group_sizes, **kwargs):
+    _, mean, var = _group_moments(arrays, group_sums, group_sizes, omit_nan=True)
+    std = np.sqrt(var)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (mean[:, 0] - mean[:, 1]) / (std[:, 0] + std[:, 1])
+
+
+def _permuted_mann_whitney_u(arrays, group_sums, group_sizes, **kwargs):
+    n_a, n_b = group_sizes
+    U = group_sums(arrays['ranks'])[:, 0] - n_a * (n_a + 1) / 2
+    return np.minimum(U, n_a * n_b - U)
+
+
+def _permuted_hypergeometric_test(arrays, group_sums, group_sizes, **kwargs):
+    expressed = group_sums(arrays['expressed'])
+    scores, _ = statistics.hypergeometric_test_from_statistics(
+        *(statistics.GroupStatistics(group_sizes[i], None, None, None, expressed[:, i]) for i in range(2)))
+    return scores
+
+
+#: Scoring functions computed from group sums in `permutation_scores`, mapped to
+#: (a function computing the label independent per gene arrays, the permuted score)
+PERMUTATION_SCORES = {
+    score_fold_change: (_moment_arrays, _permuted_fold_change),
+    score_log_fold_change: (_moment_arrays, _permuted_log_fold_change),
+    score_ttest_t: (_moment_arrays, _permuted_ttest_t),
+    score_ttest_p: (_moment_arrays, _permuted_ttest_p),
+    score_welch_ttest_t: (_raw_moment_arrays, _permuted_welch_ttest_t),
+    score_welch_ttest_p: (_raw_moment_arrays, _permuted_welch_ttest_p),
+    score_moderated_ttest_t: (_raw_moment_arrays, _permuted_moderated_ttest_t),
+    score_moderated_ttest_p: (_raw_moment_arrays, _permuted_moderated_ttest_p),
+    score_anova_f: (_moment_arrays, _permuted_anova_f),
+    score_anova_p: (_moment_arrays, _permuted_anova_p),
+    score_kruskal_wallis_h: (_rank_arrays, _permuted_kruskal_wallis_h),
+    score_kruskal_wallis_p: (_rank_arrays, _permuted_kruskal_wallis_p),
+    score_signal_to_noise: (_moment_arrays, _permuted_signal_to_noise),
+    score_mann_whitney_u: (_mann_whitney_arrays, _permuted_mann_whitney_u),
+    hypergeometric_test_score: (_expressed_arrays, _permuted_hypergeometric_test),
+}
+
+
+def permutation_arrays(X, score_func, **kwargs):
+    """
+    Compute the arrays (ranks, squares, ...), which do not depend on the
+    labels, used by `permutation_scores` to score the permutations.
+
+    Returns
+    -------
+    arrays : dict or None
+        None if `score_func` is not in `PERMUTATION_SCORES`
+    """
+    if score_func not in PERMUTATION_SCORES:
+        return None
+    prepare, _ = PERMUTATION_SCORES[score_func]
+    return prepare(np.asarray(X, dtype=float), **kwargs)
+
+
+def permutation_scores(X, group_sizes, permutations, score_func, arrays=None, **kwargs):
+    """
+    Compute the scores of many label permutations at once.
+
+    Samples (rows of `X`) are ordered by groups, i.e. the first
+    ``group_sizes[0]`` rows belong to the first group, ... Each permutation
+    reorders the samples before they are split into groups.
+
+    Scores of the functions in `PERMUTATION_SCORES` are derived from per
+    group sums of sample values (or ranks, ...), which are computed for all
+    permutations with one product with a (permutation, group) x sample
+    indicator matrix. Other scoring functions are called for each permutation.
+
+    Parameters
+    ----------
+    X : (N, M) array
+        Samples in rows, ordered by groups
+    group_sizes : list of int
+        Number of samples in each group
+    permutations : (P, N) int array
+        Permutations of sample (row) indices
+    score_func : callable
+        Scoring function (see `OWDifferentialExpression.Scores`)
+    arrays : dict, optional
+        Arrays computed by `permutation_arrays` (computed from `X` if not
+        given); pass them when scoring many batches of the same data
+    treshold : float
+        Expression threshold for the hypergeometric test
+
+    Returns
+    -------
+    scores : (P, M) array
+        The scores of each permutation
+    """
+    X = np.asarray(X, dtype=float)
+    permutations = np.asarray(permutations, dtype=int)
+    n_perm = permutations.shape[0]
+
+    if score_func not in PERMUTATION_SCORES:
+        bounds = np.cumsum([0] + list(group_sizes))
+        scores = []
+        for perm in permutations:
+            ss = score_func(*[X[perm[start:end]] for start, end in zip(bounds, bounds[1:])], axis=0, **kwargs)
+            scores.append(ss[0] if isinstance(ss, tuple) else ss)
+        return np.array(scores, dtype=float).reshape((n_perm, X.shape[1]))
+
+    if arrays is None:
+        arrays = permutation_arrays(X, score_func, **kwargs)
+
+    n_groups = len(group_sizes)
+    labels = np.repeat(np.arange(n_groups), group_sizes)
+    rows = (np.arange(n_perm)[:, np.newaxis] * n_groups + labels).ravel()
+    indicator = np.zeros((n_perm * n_groups, X.shape[0]))
+    indicator[rows, permutations.ravel()] = 1
+
+    def group_sums(values):
+        return (indicator @ values).reshape((n_perm, n_groups, X.shape[1]))
+
+    _, score = PERMUTATION_SCORES[score_func]
+    return score(arrays, group_sums, np.asarray(group_sizes, dtype=float), **kwargs)
+
+
+def _permutation_batch(X, arrays, group_sizes, score_func, seed, batch, count, kwargs):
+    """
+    Score `count` random permutations of the `batch`-th batch.
+    Batches are seeded independently, the results do not depend on the
+    order (or the process) in which they are computed.
+    """
+    random_state = np.random.RandomState([seed, batch])
+    permutations = np.argsort(random_state.random_sample((count, X.shape[0])), axis=1)
+    return permutation_scores(X, group_sizes, permutations, score_func, arrays=arrays, **kwargs)
+
+
+def _shared_permutation_batch(shared_arrays, has_arrays, *args):
+    """ Score a batch of permutations in a worker process. """
+    arrays = shared_arrays.load()
+    X = arrays.pop('X')
+    return _permutation_batch(X, arrays if has_arrays else None, *args)
+
+
+def permutation_null_distribution(X, group_indices, score_func, n_permutations, **kwargs):
+    """
+    Compute the null score distribution from random label permutations.
+
+    Permutations are scored in batches (see `permutation_scores`) of
+    bounded memory, in a pool of worker processes if `processes` > 1
+    (see `orangecontrib.bioinformatics.utils.process_pool`).
+
+    Parameters
+    ----------
+    X : (N, M) array
+        Samples in rows
+    group_indices : list of int arrays
+        Row indices of samples in each group
+    score_func : callable
+        Scoring function (see `OWDifferentialExpression.Scores`)
+    n_permutations : int
+        Number of permutations
+    seed : int
+        Random seed (default 0)
+    processes : int, optional
+        Number of worker processes (at most the number of CPUs)
+    callback : callable, optional
+        Called with the number of scored permutations after each batch
+
+    Returns
+    -------
+    scores : (P, M) array
+        The scores of each permutation
+    """
+    seed = kwargs.pop('seed', 0)
+    processes = kwargs.pop('processes', None)
+    callback = kwargs.pop('callback', None)
+
+    X = np.asarray(X, dtype=float)[np.hstack(group_indices)]
+    group_sizes = [len(ind) for ind in group_indices]
+    # ranks, squares, ... do not depend on the labels, compute them only once
+    arrays = permutation_arrays(X, score_func, **kwargs)
+    batch_size = max(1, 2 ** 20 // max(len(group_sizes) * X.shape[1], X.shape[0], 1))
+    batches = [(batch, min(batch_size, n_permutations - start))
+               for batch, start in enumerate(range(0, n_permutations, batch_size))]
+
+    def collect(results):
+        null_scores = np.empty((n_permutations, X.shape[1]))
+        start = 0
+        for (_, count), scores in zip(batches, results):
+            null_scores[start:start + count] = scores
+            start += count
+        return null_scores
+
+    if not processes or processes < 2 or len(batches) < 2:
+        results = []
+        for batch, count in batches:
+            results.append(_permutation_batch(X, arrays, group_sizes, score_func, seed, batch, count, kwargs))
+            if callback is not None:
+                callback(count)
+        return collect(results)
+
+    shared_arrays = SharedArrays(X=X, **(arrays or {}))
+    try:
+        with process_pool(processes) as executor:
+            futures = [executor.submit(_shared_permutation_batch, shared_arrays, arrays is not None, group_sizes,
+                                       score_func, seed, batch, count, kwargs)
+                       for batch, count in batches]
+            try:
+                for future, (_, count) in zip(futures, batches):
+                    future.result()
+                    if callback is not None:
+                        callback(count)
+            except BaseException:
+                # do not start pending batches after cancellation or an error
+                for future in futures:
+                    future.cancel()
+                raise
+            return collect(future.result() for future in futures)
+    finally:
+        shared_arrays.close()
+
+
 class Histogram(pg.PlotWidget):
     """
     A histogram plot with interactive 'tail' selection
@@ -532,6 +920,166 @@ def test_middle(array, low, high):
     return (array <= high) | (array >= low)
 
 
+class SortedScores:
+    """
+    An index of the finite values of `scores` in ascending order.
+
+    It is computed once per score computation, after which threshold
+    counts, selections and quantiles are binary searches (or direct
+    lookups) on the sorted values instead of passes over all scores.
+
+    Parameters
+    ----------
+    scores : (N, ) array
+        The scores. Non finite values are excluded from the index.
+    """
+    def __init__(self, scores):
+        scores = np.asarray(scores, dtype=float).ravel()
+        finite = np.flatnonzero(np.isfinite(scores))
+        #: Positions of the finite scores in ascending order of their values
+        self.index = finite[np.argsort(scores[finite], kind="stable")]
+        #: The finite scores in ascending order
+        self.values = scores[self.index]
+        #: Number of all (including non finite) scores
+        self.size = scores.size
+        self.__magnitudes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def count_low(self, low):
+        """Return the number of scores `<= low`."""
+        return int(np.searchsorted(self.values, low, side="right"))
+
+    def count_high(self, high):
+        """Return the number of scores `>= high`."""
+        return len(self.values) - int(np.searchsorted(self.values, high, side="left"))
+
+    def __tail_counts(self, side, low, high):
+        n_low = self.count_low(low) if side & Histogram.Low else 0
+        n_high = self.count_high(high) if side & Histogram.High else 0
+        if n_low + n_high > len(self.values):
+            # overlapping tails (`high <= low`) select all scores
+            n_low, n_high = len(self.values), 0
+        return n_low, n_high
+
+    def count(self, side, low, high):
+        """
+        Return the number of scores in the `side` tail(s) (the selection
+        of `test_low`, `test_high` or `test_two_tail`).
+
+        Parameters
+        ----------
+        side : int
+            A bitwise combination of `Histogram.Low` and `Histogram.High`
+            (i.e. the `OWDifferentialExpression.LowTail`, `HighTail` or
+            `TwoTail` flag).
+        low, high : float
+            The tail thresholds.
+        """
+        return sum(self.__tail_counts(side, low, high))
+
+    def selected(self, side, low, high):
+        """
+        Return (ascending) positions of the scores in the `side` tail(s).
+        """
+        n_low, n_high = self.__tail_counts(side, low, high)
+        n = len(self.values)
+        return np.sort(np.r_[self.index[:n_low], self.index[n - n_high:]])
+
+    def quantile(self, q):
+        """
+        Return the `q`-th quantile(s) of the scores (linearly interpolated
+        like `np.percentile(scores, 100 * q)`).
+        """
+        q = np.asarray(q, dtype=float)
+        pos = q * (len(self.values) - 1)
+        lower = np.floor(pos).astype(int)
+        upper = np.minimum(lower + 1, len(self.values) - 1)
+        lo, hi = self.values[lower], self.values[upper]
+        return lo + (hi - lo) * (pos - lower)
+
+    def magnitudes(self, log2=False):
+        """
+        Return sorted absolute values of the scores (of their base 2
+        logarithm if `log2` is True). The result is cached.
+        """
+        if log2 not in self.__magnitudes:
+            values = self.values
+            if log2:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    values = np.log2(np.abs(values))
+            self.__magnitudes[log2] = np.sort(np.abs(values))
+        return self.__magnitudes[log2]
+
+
+def data_fingerprint(X):
+    """
+    Return a digest of the values (and the shape) of a dense or sparse array.
+    """
+    digest = hashlib.sha1(np.array(X.shape, dtype=np.int64).tobytes())
+    if scipy.sparse.issparse(X):
+        X = X.tocsr()
+        parts = (X.data, X.indices, X.indptr)
+    else:
+        parts = (X,)
+    for part in parts:
+        part = np.ascontiguousarray(part)
+        digest.update(part.dtype.str.encode())
+        digest.update(part.view(np.uint8).ravel().data if part.size else b'')
+    return digest.hexdigest()
+
+
+class ScoreCache:
+    """
+    A least recently used cache of computed scores.
+
+    The cache is bounded by the total size (in bytes) of the stored arrays.
+    """
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        self.__items = OrderedDict()
+        self.__bytes = 0
+
+    @staticmethod
+    def _size(value):
+        return sum(item.nbytes for item in value if isinstance(item, np.ndarray))
+
+    def __contains__(self, key):
+        return key in self.__items
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, key, default=None):
+        if key not in self.__items:
+            return default
+        self.__items.move_to_end(key)
+        return self.__items[key]
+
+    def put(self, key, value):
+        """
+        Store a tuple of results. Least recently used results are removed
+        when the cache is full; results larger than the cache are not stored.
+        """
+        size = self._size(value)
+        if key in self.__items:
+            self.__bytes -= self._size(self.__items.pop(key))
+        if size > self.max_bytes:
+            return
+
+        while self.__items and self.__bytes + size > self.max_bytes:
+            _, removed = self.__items.popitem(last=False)
+            self.__bytes -= self._size(removed)
+
+        self.__items[key] = value
+        self.__bytes += size
+
+    def clear(self):
+        self.__items.clear()
+        self.__bytes = 0
+
+
 class OWDifferentialExpression(widget.OWWidget):
     name = "Differential Expression"
     description = "Gene selection by differential expression analysis."
@@ -558,7 +1106,13 @@ class OWDifferentialExpression(widget.OWWidget):
         ("ANOVA P-value", LowTail, VarSampleTest, score_anova_p),
         ("Signal to Noise Ratio", TwoTail, TwoSampleTest, score_signal_to_noise),
         ("Mann-Whitney", LowTail, TwoSampleTest, score_mann_whitney_u),
-        ('Hypergeometric Test', TwoTail, TwoSampleTest, hypergeometric_test_score)
+        ('Hypergeometric Test', TwoTail, TwoSampleTest, hypergeometric_test_score),
+        ("Kruskal-Wallis", HighTail, VarSampleTest, score_kruskal_wallis_h),
+        ("Kruskal-Wallis P-value", LowTail, VarSampleTest, score_kruskal_wallis_p),
+        ("Welch's T-test", TwoTail, TwoSampleTest, score_welch_ttest_t),
+        ("Welch's T-test P-value", LowTail, TwoSampleTest, score_welch_ttest_p),
+        ("Moderated T-test", TwoTail, TwoSampleTest, score_moderated_ttest_t),
+        ("Moderated T-test P-value", LowTail, TwoSampleTest, score_moderated_ttest_p),
     ]
 
     settingsHandler = SetContextHandler()
@@ -569,6 +1123,8 @@ class OWDifferentialExpression(widget.OWWidget):
     compute_null = settings.Setting(False)
     #: Number of permutations to for null score distribution.
     permutations_count = settings.Setting(20)
+    #: Score permutations in multiple worker processes.
+    use_processes = settings.Setting(False)
     #: Alpha value (significance) for the selection on background
     #: null score distribution.
     alpha_value = settings.Setting(0.01)
@@ -583,6 +1139,11 @@ class OWDifferentialExpression(widget.OWWidget):
         "T-test P-value": (0.01, 0.01),
         "ANOVA": (0, 3),
         "ANOVA P-value": (0, 0.01),
+        "Kruskal-Wallis P-value": (0, 0.01),
+        "Welch's T-test": (-2, 2),
+        "Welch's T-test P-value": (0.01, 0.01),
+        "Moderated T-test": (-2, 2),
+        "Moderated T-test P-value": (0.01, 0.01),
     })
 
     auto_commit = settings.Setting(False)
@@ -611,17 +1172,18 @@ class OWDifferentialExpression(widget.OWWidget):
         self.scores = None
         #: The computed scores from label permutations
         self.nulldist = None
+        #: Sorted index of the finite scores (see `SortedScores`)
+        self.sorted_scores = None
+        #: Sorted index of the finite null distribution scores
+        self.sorted_nulldist = None
+        #: Computed (scores, null scores, warning) of seen configurations
+        #: of the current input data
+        self.score_cache = ScoreCache()
 
         self.__scores_future = self.__scores_state = None
 
         self.__in_progress = False
 
-        self.test_f = {
-            OWDifferentialExpression.LowTail: test_low,
-            OWDifferentialExpression.HighTail: test_high,
-            OWDifferentialExpression.TwoTail: test_two_tail,
-        }
-
         self.histogram = Histogram(
             enableMouse=False, enableMenu=False, background="w"
         )
@@ -685,11 +1247,16 @@ class OWDifferentialExpression(widget.OWWidget):
             callback=self.update_scores)
 
         perm_spin = gui.spin(
-            box, self, "permutations_count", minv=1, maxv=50,
+            box, self, "permutations_count", minv=1, maxv=10000,
             label="Permutations:", callback=self.update_scores,
             callbackOnReturn=True)
 
+        processes_check = gui.checkBox(
+            box, self, "use_processes", "Use multiple processes",
+            tooltip="Score permutations in parallel worker processes")
+
         check.disables.append(perm_spin)
+        check.disables.append(processes_check)
 
         box1 = gui.widgetBox(box, orientation='horizontal')
 
@@ -733,6 +1300,7 @@ class OWDifferentialExpression(widget.OWWidget):
         self.stored_selections = []
         self.nulldist = None
         self.scores = None
+        self.sorted_scores = self.sorted_nulldist = None
         self.label_selection_widget.clear()
         self.clear_plot()
         self.dataInfoLabel.setText("No data on input.\n")
@@ -773,6 +1341,9 @@ class OWDifferentialExpression(widget.OWWidget):
         return grp, selected_indices
 
     def set_data(self, data):
+        if data is not self.data:
+            # scores are cached only for the current input (the data is not hashed)
+            self.score_cache.clear()
         self.closeContext()
 
         self.clear()
@@ -831,6 +1402,7 @@ class OWDifferentialExpression(widget.OWWidget):
         self.clear_plot()
         self.scores = None
         self.nulldist = None
+        self.sorted_scores = self.sorted_nulldist = None
         self.error(0)
 
         grp, split_selection = self.selected_split()
@@ -848,16 +1420,6 @@ class OWDifferentialExpression(widget.OWWidget):
 
             return ss[0] if isinstance(ss, tuple) and not warn else ss
 
-        def permute_indices(group_indices, random_state=None):
-            assert all(ind.dtype.kind == "i" for ind in group_indices)
-            assert all(ind.ndim == 1 for ind in group_indices)
-            if random_state is None:
-                random_state = np.random
-            joined = np.hstack(group_indices)
-            random_state.shuffle(joined)
-            split_ind = np.cumsum([len(ind) for ind in group_indices])
-            return np.split(joined, split_ind[:-1])
-
         if isinstance(grp, guiutils.RowGroup):
             axis = 0
         else:
@@ -891,8 +1453,7 @@ class OWDifferentialExpression(widget.OWWidget):
         # TODO: Check that each label has more than one measurement,
         # raise warning otherwise.
 
-        def compute_scores_with_perm(X, indices, nperm=0, rstate=None,
-                                     progress_advance=None):
+        def compute_scores_with_perm(X, indices, nperm=0, progress_advance=None):
             warning = None
             scores = compute_scores(X, indices, warn=True)
             if isinstance(scores, tuple):
@@ -900,38 +1461,40 @@ class OWDifferentialExpression(widget.OWWidget):
 
             if progress_advance is not None:
                 progress_advance()
-            null_scores = []
+            null_scores = None
             if nperm > 0:
-                if rstate is None:
-                    rstate = np.random.RandomState(0)
-
-                for i in range(nperm):
-                    p_indices = permute_indices(indices, rstate)
-                    assert all(pind.shape == ind.shape
-                               for pind, ind in zip(indices, p_indices))
-                    pscore = compute_scores(X, p_indices)
-                    assert pscore.shape == scores.shape
-                    null_scores.append(pscore)
-                    if progress_advance is not None:
-                        progress_advance()
+                null_scores = permutation_null_distribution(
+                    X, indices, score_func, nperm,
+                    processes=process_count() if self.use_processes else None,
+                    callback=progress_advance,
+                    treshold=self.expression_threshold_value)
 
             return scores, null_scores, warning
 
+        nperm = self.permutations_count if self.compute_null else 0
+        key = (axis, score_func.__name__,
+               tuple(data_fingerprint(ind) for ind in indices),
+               self.expression_threshold_value, nperm)
+        cached = self.score_cache.get(key)
+        if cached is not None:
+            self.error(1)
+            self.set_scores(*cached)
+            return
+
         p_advance = concurrent.methodinvoke(
             self, "progressBarAdvance", (float,))
-        state = namespace(cancelled=False, advance=p_advance)
+        state = namespace(cancelled=False, advance=p_advance, key=key)
 
-        def progress():
+        def progress(count=1):
             if state.cancelled:
                 raise concurrent.CancelledError
             else:
-                state.advance(100 / (nperm + 1))
+                state.advance(100 * count / (nperm + 1))
 
         self.progressBarInit()
         set_scores = concurrent.methodinvoke(
             self, "__set_score_results", (concurrent.Future,))
 
-        nperm = self.permutations_count if self.compute_null else 0
         self.__scores_state = state
         self.__scores_future = self._executor.submit(
                 compute_scores_with_perm, X, indices, nperm,
@@ -966,6 +1529,7 @@ class OWDifferentialExpression(widget.OWWidget):
                 except Exception as ex:
                     self.error(1, "Error: {!s}".format(ex))
                 else:
+                    self.score_cache.put(self.__scores_state.key, results)
                     self.set_scores(*results)
 
         elif self.__scores_future is None:
@@ -981,11 +1545,14 @@ class OWDifferentialExpression(widget.OWWidget):
     def set_scores(self, scores, null_scores=None, warning=None):
         self.scores = scores
         self.nulldist = null_scores
+        self.sorted_scores = SortedScores(scores)
 
-        if null_scores:
-            nulldist = np.array(null_scores, dtype=float)
+        if null_scores is not None and len(null_scores):
+            nulldist = np.asarray(null_scores, dtype=float)
+            self.sorted_nulldist = SortedScores(nulldist)
         else:
             nulldist = None
+            self.sorted_nulldist = None
 
         self.warning(10, warning)
 
@@ -1109,15 +1676,12 @@ class OWDifferentialExpression(widget.OWWidget):
     def update_selected_info_label(self):
         pl = lambda c: "" if c == 1 else "s"
         if self.data is not None and self.scores is not None:
-            scores = self.scores
             low, high = self.min_value, self.max_value
             _, side, _, _ = self.Scores[self.score_index]
-            test = self.test_f[side]
-            count_undef = np.count_nonzero(np.isnan(scores))
-            count_scores = len(scores)
-            scores = scores[np.isfinite(scores)]
+            count_undef = np.count_nonzero(np.isnan(self.scores))
+            count_scores = len(self.scores)
 
-            nselected = np.count_nonzero(test(scores, low, high))
+            nselected = self.sorted_scores.count(side, low, high)
             defined_txt = ("{} of {} score{} undefined."
                            .format(count_undef, count_scores, pl(count_scores)))
 
@@ -1166,8 +1730,7 @@ class OWDifferentialExpression(widget.OWWidget):
             return
 
         score_name, side, _, _ = self.Scores[self.score_index]
-        scores = self.scores
-        scores = np.sort(scores[np.isfinite(scores)])
+        scores = self.sorted_scores.values
 
         if side == OWDifferentialExpression.HighTail:
             cut = scores[-np.clip(self.n_best, 1, len(scores))]
@@ -1177,12 +1740,9 @@ class OWDifferentialExpression(widget.OWWidget):
             self.histogram.setLower(cut)
         elif side == OWDifferentialExpression.TwoTail:
             n = min(self.n_best, len(scores))
-            scoresabs = np.abs(scores)
-            if score_name == "Fold Change":
-                # comparing fold change on a logarithmic scale
-                scores = np.log2(scoresabs)
-                scores = scores[np.isfinite(scoresabs)]
-            scoresabs = np.sort(np.abs(scores))
+            # comparing fold change on a logarithmic scale
+            scoresabs = self.sorted_scores.magnitudes(
+                log2=score_name == "Fold Change")
             limit = (scoresabs[-n] + scoresabs[-min(n+1, len(scores))]) / 2
             cuthigh, cutlow = limit, -limit
             if score_name == "Fold Change":
@@ -1191,26 +1751,24 @@ class OWDifferentialExpression(widget.OWWidget):
         self._invalidate_selection()
 
     def select_p_best(self):
-        if not self.nulldist:
+        if self.sorted_nulldist is None or not len(self.sorted_nulldist):
             return
 
         _, side, _, _ = self.Scores[self.score_index]
-        nulldist = np.asarray(self.nulldist).ravel()
-        nulldist = nulldist[np.isfinite(nulldist)]
-        nulldist = np.sort(nulldist)
+        nulldist = self.sorted_nulldist
 
         assert 0 <= self.alpha_value <= 1
         p = self.alpha_value
         if side == OWDifferentialExpression.HighTail:
-            cut = np.percentile(nulldist, 100 * (1 - p))
+            cut = nulldist.quantile(1 - p)
             self.max_value = cut
             self.histogram.setUpper(cut)
         elif side == OWDifferentialExpression.LowTail:
-            cut = np.percentile(nulldist, 100 * p)
+            cut = nulldist.quantile(p)
             self.min_value = cut
             self.histogram.setLower(cut)
         elif side == OWDifferentialExpression.TwoTail:
-            p1, p2 = np.percentile(nulldist, [100 * p / 2, 100 * (1 - p / 2)])
+            p1, p2 = nulldist.quantile([p / 2, 1 - p / 2])
             self.histogram.setBoundary(p1, p2)
         self._invalidate_selection()
 
@@ -1262,15 +1820,9 @@ class OWDifferentialExpression(widget.OWWidget):
         low, high = self.histogram.boundary()
 
         scores = self.scores
-        mask = np.isfinite(scores)
-        test = self.test_f[side]
-        selected_masked = test(scores[mask], low, high)
-
-        selected = np.zeros_like(scores, dtype=bool)
-        selected[mask] = selected_masked
-
-        indices = np.flatnonzero(selected)
-        remaining = np.flatnonzero(~selected)
+        indices = self.sorted_scores.selected(side, low, high)
+        remaining = np.setdiff1d(np.arange(len(scores)), indices,
+                                 assume_unique=True)
 
         domain = self.data.domain
 
@@ -1338,6 +1890,7 @@ class OWDifferentialExpression(widget.OWWidget):
         super().onDeleteWidget()
         self.clear()
         self.__cancel_pending()
+        self.score_cache.clear()
         self._executor.shutdown(wait=True)
 
 
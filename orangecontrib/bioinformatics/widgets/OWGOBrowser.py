@@ -12,17 +12,19 @@ import logging
 
 from collections import defaultdict
 from functools import reduce
-from concurrent.futures import Future
+from concurrent.futures import Future, CancelledError
 from types import SimpleNamespace
 from typing import Dict, List, Tuple
 from requests.exceptions import ConnectTimeout, RequestException, ConnectionError
 
 from AnyQt.QtWidgets import (
-    QTreeWidget, QTreeWidgetItem, QTreeView, QMenu, QCheckBox, QSplitter,
-    QDialog, QVBoxLayout, QLabel, QItemDelegate
+    QTreeView, QMenu, QCheckBox, QSplitter, QDialog, QVBoxLayout, QLabel, QItemDelegate
 )
 from AnyQt.QtGui import QBrush
-from AnyQt.QtCore import Qt, QSize, QThread, QTimer
+from AnyQt.QtCore import (
+    Qt, QSize, QThread, QTimer, QAbstractItemModel, QModelIndex, QSortFilterProxyModel, QItemSelection,
+    QItemSelectionModel
+)
 from AnyQt.QtCore import pyqtSlot as Slot, Signal
 
 
@@ -78,16 +80,320 @@ def listAvailable():
     return dict(essential)
 
 
-class TreeNode(object):
-    def __init__(self, value, children):
-        self.value = value
-        self.children = children
+class EnrichmentTree:
+    """ Enriched terms and the links between them, in flat lists (arrays) sorted by p-value.
+
+    A term is identified by its index in `term_ids`; terms in the tree are enriched terms whose parents are
+    not among the enriched terms (except obsolete terms).
+
+    :param ontology: The ontology of the terms.
+    :param results: Enriched terms, as returned from :func:`go.Annotations.get_enriched_terms`
+                    (with p-values that are not FDR adjusted).
+
+    """
+
+    def __init__(self, ontology, results):
+        #: Ids of the terms, sorted by p-value.
+        self.term_ids = sorted(results, key=lambda term: (results[term][1], term))
+        fdr = statistics.FDR([results[term][1] for term in self.term_ids], ordered=True)
+        #: Tuples (genes, p-value, reference count, FDR) for the terms.
+        self.results = [results[term] + (fdr,) for term, fdr in zip(self.term_ids, fdr)]
+
+        #: Indices of term ids.
+        self.term_index = index = {term: i for i, term in enumerate(self.term_ids)}
+        links = sorted({(index[parent], i) for i, term in enumerate(self.term_ids)
+                        for _, parent in ontology[term].related if parent in index})
+        links = numpy.array(links, dtype=int).reshape(-1, 2)
+        # children (in the order of p-values) and parents of each term, in csr arrays
+        self._children = links[:, 1]
+        self._children_indptr = numpy.searchsorted(links[:, 0], numpy.arange(len(self.term_ids) + 1))
+        order = numpy.lexsort((links[:, 0], links[:, 1]))
+        self._parents = links[order, 0]
+        self._parents_indptr = numpy.searchsorted(links[order, 1], numpy.arange(len(self.term_ids) + 1))
+
+        #: Terms without parents (in the order of p-values).
+        self.roots = [i for i in numpy.flatnonzero(numpy.diff(self._parents_indptr) == 0).tolist()
+                      if not getattr(ontology[self.term_ids[i]], "is_obsolete", False)]
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def as_dict(self):
+        """ Return a dictionary of (genes, p-value, reference count, FDR) for term ids. """
+        return dict(zip(self.term_ids, self.results))
 
+    def children(self, term):
+        return self._children[self._children_indptr[term]:self._children_indptr[term + 1]].tolist()
+
+    def parents(self, term):
+        return self._parents[self._parents_indptr[term]:self._parents_indptr[term + 1]].tolist()
+
+    def displayed_children(self, term, displayed):
+        """ Return the terms shown below `term` (or at the top level, if `term` is None) in the order of
+        p-values. These are its displayed descendants that are not below another displayed descendant.
+
+        :param displayed: A boolean array; terms that are not displayed are skipped (and their displayed
+                          descendants shown below their nearest displayed ancestors).
+        """
+        stack = list(self.roots if term is None else self.children(term))
+        seen, shown = set(), []
+        while stack:
+            term = stack.pop()
+            if term in seen:
+                continue
+            seen.add(term)
+            if displayed[term]:
+                shown.append(term)
+            else:
+                stack.extend(self.children(term))
+        return sorted(shown)
+
+    def displayed_paths(self, term, displayed):
+        """ Return paths (lists of displayed terms, starting with a top-level one) to all places of the
+        displayed `term` in the tree (see :func:`displayed_children`).
+        """
+        roots = set(self.roots)
+        paths = {}
+
+        def displayed_parents(term):
+            # nearest displayed ancestors (None for the top level)
+            stack, seen, found = self.parents(term), set(), set()
+            if term in roots:
+                found.add(None)
+            while stack:
+                parent = stack.pop()
+                if parent in seen:
+                    continue
+                seen.add(parent)
+                if displayed[parent]:
+                    found.add(parent)
+                else:
+                    stack.extend(self.parents(parent))
+                    if parent in roots:
+                        found.add(None)
+            return found
+
+        def paths_to(term):
+            if term not in paths:
+                # the top level (None) first, then parents in the order of p-values
+                parents = sorted(displayed_parents(term), key=lambda parent: -1 if parent is None else parent)
+                paths[term] = [path + [term] for parent in parents
+                               for path in ([[]] if parent is None else paths_to(parent))]
+            return paths[term]
+
+        return paths_to(term)
+
+
+def run_enrichment(annotations, ontology, genes, reference, evidence_codes, aspect, prob, progress_callback):
+    """ Compute enriched terms and return them in an :class:`EnrichmentTree`.
+
+    Runs in a worker thread; `progress_callback` is called with the progress (in percents) and can raise an
+    exception (:class:`concurrent.futures.CancelledError`) to cancel the computation.
+    """
+    results = annotations.get_enriched_terms(genes, reference, evidence_codes, aspect=aspect, prob=prob,
+                                             use_fdr=False,
+                                             progress_callback=lambda value: progress_callback(0.95 * value))
+    tree = EnrichmentTree(ontology, results)
+    progress_callback(100.0)
+    return tree
+
+
+class EnrichmentTreeModel(QAbstractItemModel):
+    """ A model of enriched terms (of an :class:`EnrichmentTree`) for a tree view, or for a flat table if
+    `flat` is set.
+
+    The tree is created lazily: the rows below a term are created when the term is expanded (see
+    :func:`canFetchMore`) and the contents of a row when it is shown.
+    """
+
+    #: The role of the id of a row's term.
+    TermRole = Qt.UserRole + 1
+    #: The role of the values by which the rows are sorted.
+    SortRole = Qt.UserRole + 2
+
+    class Node:
+        __slots__ = ('term', 'parent', 'row', 'children')
+
+        def __init__(self, term, parent, row):
+            self.term = term
+            self.parent = parent
+            self.row = row
+            #: Child nodes (None until they are fetched).
+            self.children = None
+
+    def __init__(self, columns, flat=False, parent=None):
+        super().__init__(parent)
+        self._columns = list(columns)
+        self._flat = flat
+        self._tree = None
+        self._root = self.Node(None, None, 0)
+        self._root.children = []
 
-class GOTreeWidget(QTreeWidget):
+    def clear(self):
+        self.beginResetModel()
+        self._tree = None
+        self._root = self.Node(None, None, 0)
+        self._root.children = []
+        self.endResetModel()
+
+    def set_terms(self, tree, displayed, ontology, n_cluster_genes, n_reference_genes):
+        """ Show the `displayed` (a boolean array) terms of the :class:`EnrichmentTree` `tree`.
+
+        :param ontology: The ontology of the terms.
+        :param n_cluster_genes: The number of genes in the cluster.
+        :param n_reference_genes: The number of genes in the reference.
+        """
+        self.beginResetModel()
+        self._tree = tree
+        self._displayed = numpy.asarray(displayed, dtype=bool)
+        self._ontology = ontology
+        self._n_cluster_genes = n_cluster_genes
+        self._n_reference_genes = n_reference_genes
+        self._displayed_children = {}
+        self._row_data = {}
+        self._max_fold_enrichment = max([self._enrichment(tree.results[term])
+                                         for term in numpy.flatnonzero(self._displayed).tolist()] or [1])
+
+        self._root = self.Node(None, None, 0)
+        if self._flat:
+            top = numpy.flatnonzero(self._displayed).tolist()
+        else:
+            top = self._children_of(None)
+        self._root.children = [self.Node(term, self._root, row) for row, term in enumerate(top)]
+        self.endResetModel()
+
+    def _children_of(self, term):
+        if term not in self._displayed_children:
+            self._displayed_children[term] = self._tree.displayed_children(term, self._displayed)
+        return self._displayed_children[term]
+
+    def _node(self, index):
+        return index.internalPointer() if index.isValid() else self._root
+
+    def index(self, row, column, parent=QModelIndex()):
+        children = self._node(parent).children
+        if children is None or not 0 <= row < len(children) or not 0 <= column < len(self._columns):
+            return QModelIndex()
+        return self.createIndex(row, column, children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is self._root or parent is None:
+            return QModelIndex()
+        return self.createIndex(parent.row, 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        children = self._node(parent).children
+        return len(children) if children is not None else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self._columns)
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self._node(parent)
+        if node.children is not None:
+            return bool(node.children)
+        return not self._flat and bool(self._children_of(node.term))
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        return node.children is None and not self._flat and bool(self._children_of(node.term))
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        if node.children is not None:
+            return
+        terms = self._children_of(node.term)
+        self.beginInsertRows(parent, 0, len(terms) - 1)
+        node.children = [self.Node(term, node, row) for row, term in enumerate(terms)]
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and 0 <= section < len(self._columns):
+            return self._columns[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        term = index.internalPointer().term
+        if role == self.TermRole:
+            return self._tree.term_ids[term]
+        texts, tooltips, sort_values, enrichment = self._row(term)
+        column = index.column()
+        if role == Qt.DisplayRole:
+            return texts[column]
+        elif role == Qt.ToolTipRole:
+            return tooltips[column]
+        elif role == self.SortRole:
+            return sort_values[column]
+        elif role == Qt.UserRole:
+            if self._max_fold_enrichment > 0:
+                return enrichment / self._max_fold_enrichment
+            else:
+                return numpy.nan
+        return None
+
+    def occurrences(self, term_id):
+        """ Return indices of all rows of the term `term_id`; the rows (and their ancestors) are created if
+        needed.
+        """
+        term = self._tree.term_index.get(term_id)
+        if term is None or not self._displayed[term]:
+            return []
+        paths = [[term]] if self._flat else self._tree.displayed_paths(term, self._displayed)
+        indices = []
+        for path in paths:
+            node, index = self._root, QModelIndex()
+            for term in path:
+                self.fetchMore(index)
+                node = next(child for child in node.children if child.term == term)
+                index = self.createIndex(node.row, 0, node)
+            indices.append(index)
+        return indices
+
+    def _enrichment(self, result):
+        genes, _, reference_count, _ = result
+        if reference_count > 0 and self._n_reference_genes > 0 and self._n_cluster_genes > 0:
+            return (len(genes) / reference_count) * (self._n_reference_genes / self._n_cluster_genes)
+        else:
+            return numpy.nan
+
+    def _row(self, term):
+        """ Return texts, tooltips and sort values of the columns of the term's row and the term's enrichment.
+        """
+        if term not in self._row_data:
+            querymapped, pvalue, refmappedcount, fdr = self._tree.results[term]
+            go_term = self._ontology[self._tree.term_ids[term]]
+            nClusterGenes, nRefGenes = self._n_cluster_genes, self._n_reference_genes
+            querymappedcount = len(querymapped)
+            enrichment = self._enrichment(self._tree.results[term])
+            genes = ", ".join(querymapped)
+
+            fmt_cluster = "%" + str(-int(math.log(max(nClusterGenes, 1)))) + "i (%.2f%%)"
+            fmt_reference = "%" + str(-int(math.log(max(nRefGenes, 1)))) + "i (%.2f%%)"
+            texts = [go_term.name,
+                     fmt_cluster % (querymappedcount, 100.0 * querymappedcount / (nClusterGenes or 1)),
+                     fmt_reference % (refmappedcount, 100.0 * refmappedcount / (nRefGenes or 1)),
+                     fmtp(pvalue), fmtp(fdr), genes, "%.2f" % enrichment]
+            tooltips = ["<p>" + go_term.__repr__()[6:].strip().replace("\n", "<br>"), None, None,
+                        fmtpdet(pvalue), fmtpdet(fdr), None, "%.2f" % enrichment]
+            sort_values = [go_term.name, querymappedcount, refmappedcount, pvalue, fdr, genes, enrichment]
+            self._row_data[term] = (texts, tooltips, sort_values, enrichment)
+        return self._row_data[term]
+
+
+class GOTreeView(QTreeView):
     def contextMenuEvent(self, event):
         super().contextMenuEvent(event)
-        term = self.itemAt(event.pos()).term
+        index = self.indexAt(event.pos())
+        if not index.isValid():
+            return
+        term = index.data(EnrichmentTreeModel.TermRole)
         self._currMenu = QMenu()
         self._currAction = self._currMenu.addAction("View term on AmiGO website")
         self._currAction.triggered.connect(lambda: self.BrowserAction(term))
@@ -162,12 +468,13 @@ class OWGOBrowser(widget.OWWidget):
         self.ontology = None
         self.annotations = None
         self.loaded_annotation_code = None
-        self.treeStructRootKey = None
+        self.enrichment_tree = None
         self.probFunctions = [statistics.Binomial(), statistics.Hypergeometric()]
         self.selectedTerms = []
 
         self.selectionChanging = 0
         self.__state = State.Ready
+        self.__enrichment_state = None
         self.__scheduletimer = QTimer(self, singleShot=True)
         self.__scheduletimer.timeout.connect(self.__update)
 
@@ -273,12 +580,12 @@ class OWGOBrowser(widget.OWWidget):
         self.splitter = QSplitter(Qt.Vertical, self.mainArea)
         self.mainArea.layout().addWidget(self.splitter)
 
-        # list view
-        self.listView = GOTreeWidget(self.splitter)
+        # list view (a tree of terms, created as it is expanded)
+        self.listModel = EnrichmentTreeModel(self.DAGcolumns, parent=self)
+        self.listView = GOTreeView(self.splitter)
+        self.listView.setModel(self._sortProxy(self.listModel))
         self.listView.setSelectionMode(QTreeView.ExtendedSelection)
         self.listView.setAllColumnsShowFocus(1)
-        self.listView.setColumnCount(len(self.DAGcolumns))
-        self.listView.setHeaderLabels(self.DAGcolumns)
 
         self.listView.header().setSectionsClickable(True)
         self.listView.header().setSortIndicatorShown(True)
@@ -288,19 +595,20 @@ class OWGOBrowser(widget.OWWidget):
             6, EnrichmentColumnItemDelegate(self))
         self.listView.setRootIsDecorated(True)
 
-        self.listView.itemSelectionChanged.connect(self.ViewSelectionChanged)
+        self.listView.selectionModel().selectionChanged.connect(self.ViewSelectionChanged)
 
         # table of significant GO terms
-        self.sigTerms = QTreeWidget(self.splitter)
-        self.sigTerms.setColumnCount(len(self.DAGcolumns))
-        self.sigTerms.setHeaderLabels(self.DAGcolumns)
+        self.sigTermsModel = EnrichmentTreeModel(self.DAGcolumns, flat=True, parent=self)
+        self.sigTerms = QTreeView(self.splitter)
+        self.sigTerms.setModel(self._sortProxy(self.sigTermsModel))
+        self.sigTerms.setRootIsDecorated(False)
         self.sigTerms.setSortingEnabled(True)
         self.sigTerms.setSelectionMode(QTreeView.ExtendedSelection)
         self.sigTerms.header().setSortIndicator(self.DAGcolumns.index('p-value'), Qt.AscendingOrder)
         self.sigTerms.setItemDelegateForColumn(
             6, EnrichmentColumnItemDelegate(self))
 
-        self.sigTerms.itemSelectionChanged.connect(self.TableSelectionChanged)
+        self.sigTerms.selectionModel().selectionChanged.connect(self.TableSelectionChanged)
 
         self.sigTableTermsSorted = []
         self.graph = {}
@@ -340,6 +648,12 @@ class OWGOBrowser(widget.OWWidget):
     def sizeHint(self):
         return QSize(1000, 700)
 
+    def _sortProxy(self, model):
+        proxy = QSortFilterProxyModel(self)
+        proxy.setSourceModel(model)
+        proxy.setSortRole(EnrichmentTreeModel.SortRole)
+        return proxy
+
     def __on_evidenceChanged(self):
         for etype, cb in self.evidenceCheckBoxDict.items():
             self.useEvidenceType[etype] = cb.isChecked()
@@ -426,6 +740,8 @@ class OWGOBrowser(widget.OWWidget):
         self.__scheduletimer.start()
         if self.__state != State.Ready:
             self.__state |= State.Stale
+            # stop the running enrichment (it is restarted when it finishes)
+            self.__cancel_enrichment()
 
         self.SetGraph({})
         self.ref_genes = None
@@ -547,32 +863,25 @@ class OWGOBrowser(widget.OWWidget):
     def Load(self):
         a = self.available_annotations[self.annotation_index]
 
-        if self.ontology is None:
-            self.ontology = go.Ontology()
-
         if a.taxid != self.loaded_annotation_code:
             self.annotations = None
             gc.collect()  # Force run garbage collection
-            self.annotations = go.Annotations(a.taxid)
+            # annotations and their ontology are shared with other widgets (and loaded only once)
+            self.annotations = go.Annotations.shared(a.taxid)
+            self.ontology = self.annotations.ontology
             self.loaded_annotation_code = a.taxid
-            count = defaultdict(int)
-            geneSets = defaultdict(set)
+            counts = self.annotations.evidence_counts()
 
-            for anno in self.annotations.annotations:
-                count[anno.evidence] += 1
-                geneSets[anno.evidence].add(anno.gene_id)
             for etype in go.evidenceTypesOrdered:
                 ecb = self.evidenceCheckBoxDict[etype]
-                ecb.setEnabled(bool(count[etype]))
-                ecb.setText(etype + ": %i annots(%i genes)" % (count[etype], len(geneSets[etype])))
+                count, gene_count = counts.get(etype, (0, 0))
+                ecb.setEnabled(bool(count))
+                ecb.setText(etype + ": %i annots(%i genes)" % (count, gene_count))
 
     def Enrichment(self):
         assert self.input_data is not None
         assert self.__state == State.Ready
 
-        if not self.annotations.ontology:
-            self.annotations.ontology = self.ontology
-
         self.error(1)
         self.warning([0, 1])
 
@@ -628,13 +937,19 @@ class OWGOBrowser(widget.OWWidget):
         self.__state = State.Running
 
         if self.input_genes:
-            f = self._executor.submit(
-                self.annotations.get_enriched_terms,
-                self.input_genes, self.ref_genes, evidences, aspect=aspect,
-                prob=self.probFunctions[self.probFunc], use_fdr=False,
+            progress = methodinvoke(self, "_progressBarSet", (float,))
+            state = SimpleNamespace(cancelled=False)
 
-                progress_callback=methodinvoke(
-                    self, "_progressBarSet", (float,))
+            def progress_callback(value):
+                if state.cancelled:
+                    raise CancelledError
+                progress(value)
+
+            self.__enrichment_state = state
+            f = self._executor.submit(
+                run_enrichment, self.annotations, self.ontology,
+                self.input_genes, self.ref_genes, evidences, aspect,
+                self.probFunctions[self.probFunc], progress_callback
             )
             fw = FutureWatcher(f, parent=self)
             fw.done.connect(self.__on_enrichment_done)
@@ -642,11 +957,17 @@ class OWGOBrowser(widget.OWWidget):
             return
         else:
             f = Future()
-            f.set_result({})
+            f.set_result(EnrichmentTree(self.ontology, {}))
             self.__on_enrichment_done(f)
 
+    def __cancel_enrichment(self):
+        if self.__enrichment_state is not None:
+            self.__enrichment_state.cancelled = True
+            self.__enrichment_state = None
+
     def __on_enrichment_done(self, results):
-        # type: (Future[Dict[str, tuple]]) -> None
+        # type: (Future[EnrichmentTree]) -> None
+        self.__enrichment_state = None
         self.progressBarFinished(processEvents=False)
         self.setBlocking(False)
         self.setStatusMessage("")
@@ -657,47 +978,22 @@ class OWGOBrowser(widget.OWWidget):
 
         self.__state = State.Ready
         try:
-            results = results.result()  # type: Dict[str, tuple]
+            tree = results.result()  # type: EnrichmentTree
+        except CancelledError:
+            return
         except Exception as ex:
-            results = {}
+            tree = EnrichmentTree(self.ontology, {})
             error = str(ex)
             self.error(1, error)
 
-        if results:
-            terms = list(results.items())
-            fdr_vals = statistics.FDR([d[1] for _, d in terms])
-            terms = [(key, d + (fdr,))
-                     for (key, d), fdr in zip(terms, fdr_vals)]
-            terms = dict(terms)
-
-        else:
-            terms = {}
-
-        self.terms = terms
+        self.enrichment_tree = tree
+        self.terms = terms = tree.as_dict()
 
         if not self.terms:
             self.warning(0, "No enriched terms found.")
         else:
             self.warning(0)
 
-        self.treeStructDict = {}
-        ids = self.terms.keys()
-
-        self.treeStructRootKey = None
-
-        parents = {}
-        for id in ids:
-            parents[id] = set([term for _, term in self.ontology[id].related])
-
-        children = {}
-        for term in self.terms:
-            children[term] = set([id for id in ids if term in parents[id]])
-
-        for term in self.terms:
-            self.treeStructDict[term] = TreeNode(self.terms[term], children[term])
-            if not self.ontology[term].related and not getattr(self.ontology[term], "is_obsolete", False):
-                self.treeStructRootKey = term
-
         self.SetGraph(terms)
         self._updateEnrichmentReportOutput()
         self.commit()
@@ -783,62 +1079,23 @@ class OWGOBrowser(widget.OWWidget):
             self.ClearGraph()
 
     def ClearGraph(self):
-        self.listView.clear()
-        self.listViewItems=[]
-        self.sigTerms.clear()
+        self.listModel.clear()
+        self.sigTermsModel.clear()
 
     def DisplayGraph(self):
-        fromParentDict = {}
-        self.termListViewItemDict = {}
-        self.listViewItems = []
-
-        def enrichment(t):
-            try:
-                return len(t[0]) / t[2] * (len(self.ref_genes) / len(self.input_genes))
-            except ZeroDivisionError:
-                # TODO: find out why this happens
-                return 0
-
-        maxFoldEnrichment = max([enrichment(term) for term in self.graph.values()] or [1])
-
-        def addNode(term, parent, parentDisplayNode):
-            if (parent, term) in fromParentDict:
-                return
-            if term in self.graph:
-                displayNode = GOTreeWidgetItem(self.ontology[term], self.graph[term], len(self.input_genes),
-                                               len(self.ref_genes), maxFoldEnrichment, parentDisplayNode)
-                displayNode.goId = term
-                self.listViewItems.append(displayNode)
-                if term in self.termListViewItemDict:
-                    self.termListViewItemDict[term].append(displayNode)
-                else:
-                    self.termListViewItemDict[term] = [displayNode]
-                fromParentDict[(parent, term)] = True
-                parent = term
-            else:
-                displayNode = parentDisplayNode
-
-            for c in self.treeStructDict[term].children:
-                addNode(c, parent, displayNode)
-
-        if self.treeStructDict:
-            addNode(self.treeStructRootKey, None, self.listView)
-
-        terms = self.graph.items()
-        terms = sorted(terms, key=lambda item: item[1][1])
-        self.sigTableTermsSorted = [t[0] for t in terms]
+        tree = self.enrichment_tree
+        if tree is None:
+            return
+        displayed = numpy.array([term in self.graph for term in tree.term_ids], dtype=bool)
+        self.sigTableTermsSorted = [tree.term_ids[i] for i in numpy.flatnonzero(displayed)]
 
-        self.sigTerms.clear()
-        for i, (t_id, (genes, p_value, refCount, fdr)) in enumerate(terms):
-            item = GOTreeWidgetItem(self.ontology[t_id],
-                                    (genes, p_value, refCount, fdr),
-                                    len(self.input_genes),
-                                    len(self.ref_genes),
-                                    maxFoldEnrichment,
-                                    self.sigTerms)
-            item.goId = t_id
+        for model in (self.listModel, self.sigTermsModel):
+            model.set_terms(tree, displayed, self.ontology, len(self.input_genes), len(self.ref_genes))
 
-        self.listView.expandAll()
+        # only the top level is expanded; the rest of the tree is created when expanded by the user
+        proxy = self.listView.model()
+        for row in range(proxy.rowCount()):
+            self.listView.expand(proxy.index(row, 0))
         for i in range(5):
             self.listView.resizeColumnToContents(i)
             self.sigTerms.resizeColumnToContents(i)
@@ -852,9 +1109,8 @@ class OWGOBrowser(widget.OWWidget):
             return
 
         self.selectionChanging = 1
-        self.selectedTerms = []
-        selected = self.listView.selectedItems()
-        self.selectedTerms = list(set([lvi.term.id for lvi in selected]))
+        selected = self.listView.selectionModel().selectedRows()
+        self.selectedTerms = list(set([index.data(EnrichmentTreeModel.TermRole) for index in selected]))
         self.ExampleSelection()
         self.selectionChanging = 0
 
@@ -863,24 +1119,22 @@ class OWGOBrowser(widget.OWWidget):
             return
 
         self.selectionChanging = 1
-        self.selectedTerms = []
-        selectedIds = set([self.sigTerms.itemFromIndex(index).goId for index in self.sigTerms.selectedIndexes()])
-
-        for i in range(self.sigTerms.topLevelItemCount()):
-            item = self.sigTerms.topLevelItem(i)
-            selected = item.goId in selectedIds
-            term = item.goId
-
-            if selected:
-                self.selectedTerms.append(term)
-
-            for lvi in self.termListViewItemDict[term]:
-                try:
-                    lvi.setSelected(selected)
-                    if selected:
-                        lvi.setExpanded(True)
-                except RuntimeError:  # Underlying C/C++ object deleted
-                    pass
+        selectedIds = set([index.data(EnrichmentTreeModel.TermRole)
+                           for index in self.sigTerms.selectionModel().selectedRows()])
+        self.selectedTerms = [term for term in self.sigTableTermsSorted if term in selectedIds]
+
+        # select all places of the terms in the tree (creating them if needed) and show them
+        proxy = self.listView.model()
+        selection = QItemSelection()
+        for term in self.selectedTerms:
+            for index in self.listModel.occurrences(term):
+                index = proxy.mapFromSource(index)
+                selection.select(index, index.sibling(index.row(), proxy.columnCount() - 1))
+                parent = index.parent()
+                while parent.isValid():
+                    self.listView.expand(parent)
+                    parent = parent.parent()
+        self.listView.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect)
         self.selectionChanging = 0
         self.ExampleSelection()
 
@@ -960,6 +1214,7 @@ class OWGOBrowser(widget.OWWidget):
     def onDeleteWidget(self):
         """Called before the widget is removed from the canvas.
         """
+        self.__cancel_enrichment()
         self.annotations = None
         self.ontology = None
         gc.collect()  # Force collection
@@ -969,61 +1224,6 @@ fmtp = lambda score: "%0.5f" % score if score > 10e-4 else "%0.1e" % score
 fmtpdet = lambda score: "%0.9f" % score if score > 10e-4 else "%0.5e" % score
 
 
-class GOTreeWidgetItem(QTreeWidgetItem):
-    def __init__(self, term, enrichmentResult, nClusterGenes, nRefGenes,
-                 maxFoldEnrichment, parent):
-        super().__init__(parent)
-        self.term = term
-        self.enrichmentResult = enrichmentResult
-        self.nClusterGenes = nClusterGenes
-        self.nRefGenes = nRefGenes
-        self.maxFoldEnrichment = maxFoldEnrichment
-
-        querymapped, pvalue, refmappedcount, fdr = enrichmentResult
-
-        querymappedcount = len(querymapped)
-        if refmappedcount > 0 and nRefGenes > 0 and nClusterGenes > 0:
-            enrichment = (querymappedcount / refmappedcount) * (nRefGenes / nClusterGenes)
-        else:
-            enrichment = numpy.nan
-
-        self.enrichment = enrichment
-
-        self.setText(0, term.name)
-
-        fmt = "%" + str(-int(math.log(max(nClusterGenes, 1)))) + "i (%.2f%%)"
-        self.setText(1, fmt % (querymappedcount,
-                               100.0 * querymappedcount / (nClusterGenes or 1)))
-
-        fmt = "%" + str(-int(math.log(max(nRefGenes, 1)))) + "i (%.2f%%)"
-        self.setText(2, fmt % (refmappedcount,
-                               100.0 * refmappedcount / (nRefGenes or 1)))
-
-        self.setText(3, fmtp(pvalue))
-        self.setToolTip(3, fmtpdet(pvalue))
-        self.setText(4, fmtp(fdr))  # FDR
-        self.setToolTip(4, fmtpdet(fdr))
-        self.setText(5, ", ".join(querymapped))
-        self.setText(6, "%.2f" % (enrichment))
-        self.setToolTip(6, "%.2f" % (enrichment))
-        self.setToolTip(0, "<p>" + term.__repr__()[6:].strip().replace("\n", "<br>"))
-        self.sortByData = [term.name, querymappedcount, refmappedcount,
-                           pvalue, fdr, ", ".join(querymapped), enrichment]
-
-    def data(self, col, role):
-        if role == Qt.UserRole:
-            if self.maxFoldEnrichment > 0:
-                return self.enrichment / self.maxFoldEnrichment
-            else:
-                return numpy.nan
-        else:
-            return super().data(col, role)
-
-    def __lt__(self, other):
-        col = self.treeWidget().sortColumn()
-        return self.sortByData[col] < other.sortByData[col]
-
-
 class EnrichmentColumnItemDelegate(QItemDelegate):
     def paint(self, painter, option, index):
         self.drawBackground(painter, option, index)
@@ -1,9 +1,15 @@
+from functools import partial
+from concurrent.futures import Future
+
 import numpy as np
+import pyqtgraph as pg
 
+from AnyQt.QtCore import QRectF, pyqtSlot as Slot
 
 from Orange.widgets.widget import OWWidget, Msg
 from Orange.widgets import gui, settings
 from Orange.widgets.settings import SettingProvider
+from Orange.widgets.utils.concurrent import ThreadExecutor, FutureWatcher
 from Orange.widgets.visualize.owscatterplot import OWScatterPlotBase,  OWDataProjectionWidget
 
 from orangecontrib.bioinformatics.widgets.utils.gui import label_selection
@@ -13,12 +19,116 @@ from orangecontrib.bioinformatics.widgets.utils.data import (
 )
 
 
+def volcano_embedding(X, mask):
+    """ Compute the volcano plot embedding of genes in rows of `X`.
+
+    :param X: Expression matrix with genes in rows and samples in columns.
+    :param mask: Boolean mask of the target samples (columns of `X`).
+
+    :return: A (genes, 2) array of log2 fold changes and -log10 P values of
+             the t-test between the target and the remaining samples, and
+             a flag telling whether `X` had negative values (in which case
+             the embedding is undefined).
+    """
+    X1, X2 = X[:, mask], X[:, ~mask]
+
+    negative = bool(np.any(X1 < 0.0) or np.any(X2 < 0.0))
+    if negative:
+        return np.full((X.shape[0], 2), np.nan), negative
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fold = score_fold_change(X1, X2, axis=1, log=True)
+        _, p_values = score_t_test(X1, X2, axis=1)
+        log_p_values = np.log10(p_values)
+
+    return np.array([fold, -log_p_values]).T, negative
+
+
+def volcano_tails(x, y, n):
+    """ Return (sorted) indices of the (at most) `n` points furthest from
+    the bulk of the volcano plot, i.e. the points with the largest fold change
+    and significance in units of their spread.
+    """
+    if len(x) <= n:
+        return np.arange(len(x))
+
+    x = (x - np.median(x)) / (np.std(x) or 1)
+    y = y / (np.std(y) or 1)
+    distance = x * x + y * y
+    return np.sort(np.argpartition(-distance, n - 1)[:n])
+
+
 class VolcanoGraph(OWScatterPlotBase):
     label_only_selected = settings.Setting(True)
+    summarize_bulk = settings.Setting(True)
+
+    #: The number of points drawn as glyphs when the bulk is summarized
+    MAX_GLYPHS = 5000
+    BULK_BINS = 200
+
+    def __init__(self, scatter_widget, parent=None):
+        super().__init__(scatter_widget, parent)
+        self.bulk_density_img = None
 
     def set_axis_title(self, axis, title):
         self.plot_widget.setLabel(axis=axis, text=title)
 
+    def clear(self):
+        super().clear()
+        self.bulk_density_img = None
+
+    def update_level_of_detail(self):
+        """ Redraw the points after the `summarize_bulk` setting change, keeping the selection. """
+        self.clear()
+        self.sample_indices = None
+        self.update_coordinates()
+        self.update_point_props()
+
+    def _create_sample(self):
+        """ Show only the tails as glyphs if the bulk of the points is summarized by density bins. """
+        if not self.summarize_bulk or self.n_valid <= self.MAX_GLYPHS:
+            super()._create_sample()
+            return
+
+        if self.sample_indices is None:
+            x, y = self.master.get_coordinates_data()
+            self.sample_indices = volcano_tails(x, y, self.MAX_GLYPHS)
+        self.n_shown = len(self.sample_indices)
+
+    def update_coordinates(self):
+        super().update_coordinates()
+        self.update_bulk_density()
+
+    def update_bulk_density(self):
+        """ Draw the points that are not shown as glyphs as an image of density bins. """
+        if self.bulk_density_img is not None:
+            self.plot_widget.removeItem(self.bulk_density_img)
+            self.bulk_density_img = None
+
+        if self.scatterplot_item is None or self.sample_indices is None:
+            return
+
+        x, y = self.master.get_coordinates_data()
+        bulk = np.ones(len(x), dtype=bool)
+        bulk[self.sample_indices] = False
+        x, y = x[bulk], y[bulk]
+        if not len(x):
+            return
+
+        counts, x_edges, y_edges = np.histogram2d(x, y, bins=self.BULK_BINS)
+        alpha = np.log1p(counts)
+        alpha = (255 * alpha / alpha.max()).astype(np.uint8)
+
+        image = np.zeros(counts.shape + (4,), dtype=np.uint8)
+        image[..., :3] = self.COLOR_DEFAULT
+        image[..., 3] = alpha
+
+        self.bulk_density_img = pg.ImageItem(image)
+        self.bulk_density_img.setRect(QRectF(x_edges[0], y_edges[0],
+                                             x_edges[-1] - x_edges[0], y_edges[-1] - y_edges[0]))
+        self.bulk_density_img.setZValue(-10)
+        self.plot_widget.addItem(self.bulk_density_img, ignoreBounds=True)
+
 
 class OWVolcanoPlot(OWDataProjectionWidget):
     name = "Volcano Plot"
@@ -38,6 +148,7 @@ class OWVolcanoPlot(OWDataProjectionWidget):
         negative_values = Msg('Negative values in the input. The inputs cannot be in ratio scale.')
         data_not_annotated = Msg('The input date is not annotated as expexted. Please refer to documentation.')
         gene_column_id_missing = Msg('Can not identify genes column. Please refer to documentation.')
+        embedding_error = Msg('Failed to compute the embedding: {}')
 
     GRAPH_CLASS = VolcanoGraph
     graph = SettingProvider(VolcanoGraph)
@@ -47,6 +158,11 @@ class OWVolcanoPlot(OWDataProjectionWidget):
     current_group_index = settings.ContextSetting(0)
 
     def __init__(self):
+        #: Computed embeddings of the current data for group splits (see `_split_key`)
+        self._embeddings = {}
+        #: Futures of embeddings that are being computed
+        self._pending = {}
+        self._executor = ThreadExecutor()
         super().__init__()
 
     def _add_controls(self):
@@ -58,22 +174,24 @@ class OWVolcanoPlot(OWDataProjectionWidget):
 
         super()._add_controls()
         self.gui.add_widgets([self.gui.ShowGridLines], self._plot_box)
+        gui.checkBox(self._plot_box, self.graph, 'summarize_bulk', 'Summarize non-significant genes',
+                     callback=self.graph.update_level_of_detail,
+                     tooltip='Draw only the {} most significant genes as points and the remaining '
+                             'genes as density bins.'.format(VolcanoGraph.MAX_GLYPHS))
 
     def get_embedding(self):
+        """ Return the embedding of the current group split.
+
+        Embeddings are cached per split and computed in a separate thread, hence the method returns `None`
+        while the embedding is computing; the plot is set up once it is finished.
+        """
         self.Error.exclude_error.clear()
 
         group, target_indices = self.group_selection_widget.selected_split()
 
         if self.data and group is not None and target_indices:
-            X = self.data.X
             I1 = label_selection.group_selection_mask(self.data, group, target_indices)
-            I2 = ~I1
-
-            # print(group)
-            if isinstance(group, label_selection.RowGroup):
-                X = X.T
-
-            N1, N2 = np.count_nonzero(I1), np.count_nonzero(I2)
+            N1, N2 = np.count_nonzero(I1), np.count_nonzero(~I1)
 
             if not N1 or not N2:
                 self.Error.exclude_error()
@@ -82,20 +200,61 @@ class OWVolcanoPlot(OWDataProjectionWidget):
             if N1 < 2 and N2 < 2:
                 self.Warning.insufficient_data()
 
-            X1, X2 = X[:, I1], X[:, I2]
-
-            if np.any(X1 < 0.0) or np.any(X2 < 0):
-                self.Error.negative_values()
-                X1 = np.full_like(X1, np.nan)
-                X2 = np.full_like(X2, np.nan)
+            key = self._split_key(group, I1)
+            if key not in self._embeddings:
+                self._start_embedding(key, group, I1)
+                return
 
-            with np.errstate(divide="ignore", invalid="ignore"):
-                fold = score_fold_change(X1, X2, axis=1, log=True)
-                _, p_values = score_t_test(X1, X2, axis=1)
-                log_p_values = np.log10(p_values)
+            embedding, negative = self._embeddings[key]
+            self.Error.negative_values(shown=negative)
+            self.valid_data = np.all(np.isfinite(embedding), axis=1)
+            return embedding
+
+    @staticmethod
+    def _split_key(group, mask):
+        return isinstance(group, label_selection.RowGroup), np.packbits(mask).tobytes(), len(mask)
+
+    def _start_embedding(self, key, group, mask):
+        if key in self._pending:
+            return
+
+        X = self.data.X
+        if isinstance(group, label_selection.RowGroup):
+            X = X.T
+
+        future = self._executor.submit(volcano_embedding, X, mask)
+        self._pending[key] = future
+        watcher = FutureWatcher(future, parent=self)
+        watcher.done.connect(partial(self._on_embedding_done, key))
+        watcher.done.connect(watcher.deleteLater)
+        self.setStatusMessage('Computing...')
+
+    @Slot(Future)
+    def _on_embedding_done(self, key, future):
+        if self._pending.get(key) is not future:
+            # the input data has changed in the meantime
+            return
+
+        del self._pending[key]
+        if not self._pending:
+            self.setStatusMessage('')
+
+        try:
+            self._embeddings[key] = future.result()
+        except Exception as ex:  # pylint: disable=broad-except
+            self.Error.embedding_error(str(ex))
+            return
+
+        self.Error.embedding_error.clear()
+        self.setup_plot()
+        self.commit()
 
-            self.valid_data = np.isfinite(fold) & np.isfinite(p_values)
-            return np.array([fold, -log_p_values]).T
+    def _clear_embeddings(self):
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._embeddings = {}
+        self.setStatusMessage('')
 
     def setup_plot(self):
         super().setup_plot()
@@ -115,6 +274,7 @@ class OWVolcanoPlot(OWDataProjectionWidget):
     def set_data(self, data):
         self.Warning.clear()
         self.Error.clear()
+        self._clear_embeddings()
         super().set_data(data)
         self.group_selection_widget.set_data(self, self.data)
 
@@ -142,6 +302,11 @@ class OWVolcanoPlot(OWDataProjectionWidget):
             self.Error.gene_column_id_missing()
             self.data = None
 
+    def onDeleteWidget(self):
+        self._clear_embeddings()
+        self._executor.shutdown(wait=False)
+        super().onDeleteWidget()
+
 
 if __name__ == "__main__":
     pass
@@ -12,7 +12,7 @@ from Orange.widgets.gui import (
 
 
 from orangecontrib.bioinformatics.utils.statistics import score_t_test, score_mann_whitney, score_hypergeometric_test, \
-    ALTERNATIVES, ALT_LESS, ALT_TWO, ALT_GREATER
+    score_welch_t_test, score_moderated_t_test, ALTERNATIVES, ALT_LESS, ALT_TWO, ALT_GREATER
 
 
 #: Selection types
@@ -28,9 +28,12 @@ gene_scoring_method = namedtuple('scoring_method', 'name, score_function, select
 class GeneScoringWidget(QWidget):
 
     # default methods, override to add custom scoring methods
+    # (the index of the selected method is a setting, so new methods are appended)
     scores = [gene_scoring_method('T-test', score_t_test, TwoTail, TwoSampleTest),
               gene_scoring_method('Mann-Whitney', score_mann_whitney, LowTail, TwoSampleTest),
-              gene_scoring_method('Hypergeometric Test', score_hypergeometric_test, TwoTail, TwoSampleTest)]
+              gene_scoring_method('Hypergeometric Test', score_hypergeometric_test, TwoTail, TwoSampleTest),
+              gene_scoring_method("Welch's T-test", score_welch_t_test, TwoTail, TwoSampleTest),
+              gene_scoring_method('Moderated T-test', score_moderated_t_test, TwoTail, TwoSampleTest)]
 
     def __init__(self, box, parent,  **kwargs):
         # type: (Union[QGroupBox, QWidget], QWidget) -> None
@@ -42,6 +45,7 @@ class GeneScoringWidget(QWidget):
         # parent widget settings
         self.scoring_method_selection = None
         self.scoring_method_design = None
+        self.scoring_aggregation = None
         self.test_type = None
 
     def set_method_selection_area(self, settings_var):
@@ -58,10 +62,19 @@ class GeneScoringWidget(QWidget):
         self.scoring_method_design = settings_var
 
         radioButtons(self.widget, self.parent, self.scoring_method_design,
-                     ['Cluster vs. rest', 'Cluster vs. cluster (max p-value)'],
+                     ['Cluster vs. rest', 'Cluster vs. cluster'],
                      callback=self.on_design_selection_changed,
                      label='Design')
 
+    def set_aggregation_area(self, settings_var, aggregations, callback=None):
+        # type: (str, list, callable) -> None
+        self.scoring_aggregation = settings_var
+
+        comboBox(self.widget, self.parent, self.scoring_aggregation,
+                 items=[aggregation.title() for aggregation in aggregations],
+                 callback=callback or self.on_aggregation_changed,
+                 label='Aggregation')
+
     def set_test_type(self, settings_var):
         # type: (str) -> None
         self.test_type = settings_var
@@ -90,6 +103,10 @@ class GeneScoringWidget(QWidget):
         """ Override this method if needed """
         self.parent.invalidate()
 
+    def on_aggregation_changed(self):
+        """ Override this method if needed """
+        self.parent.invalidate()
+
     def on_test_type_changed(self):
         """ Override this method if needed """
         self.parent.invalidate()
@@ -31,8 +31,8 @@ def go_gene_sets(org):
     """ Returns gene sets from GO.
     """
 
-    ontology = go.Ontology()
-    annotations = go.Annotations(org, ontology=ontology)
+    annotations = go.Annotations.shared(org)
+    ontology = annotations.ontology
 
     gene_sets = []
     for termn, term in ontology.terms.items():